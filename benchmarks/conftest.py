@@ -0,0 +1,130 @@
+"""Benchmarks of the hakai_qc library hot paths.
+
+Run with `pytest benchmarks` and the dataset sizes listed in the
+BENCHMARK_SIZES environment variable (comma separated, default 10000).
+Timings are collected with pytest-benchmark and the peak memory of a single
+run is stored in each benchmark `extra_info`.
+"""
+
+import os
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pytest
+
+nutrients_sites = [f"NUT{id:02d}" for id in range(40)]
+nutrients_depths = [0, 5, 10, 20, 30, 50, 75, 100, 150, 200, 260]
+ctd_stations = [f"CTD{id:02d}" for id in range(40)]
+ctd_flags = [
+    None,
+    "SVC: temperature_flag_level_1; SVC: sigma0_qartod_density_inversion_test",
+    "SVD: pressure_qartod_bottom_hit_test",
+]
+
+
+def get_benchmark_sizes():
+    return [int(size) for size in os.getenv("BENCHMARK_SIZES", "10000").split(",")]
+
+
+def pytest_generate_tests(metafunc):
+    if "n_rows" in metafunc.fixturenames:
+        metafunc.parametrize("n_rows", get_benchmark_sizes(), scope="session")
+
+
+def generate_nutrients_data(n_rows, n_sites=20, seed=0):
+    """Generate nutrient samples from multiple sites and depths over the
+    years with replicates, spikes, out of range and missing values."""
+    rng = np.random.default_rng(seed)
+    # Replicated samples share site, depth and collection time
+    n_samples = n_rows // 2 + 1
+    site_id = rng.choice(nutrients_sites[:n_sites], n_samples)
+    line_out_depth = rng.choice(nutrients_depths, n_samples)
+    collected = pd.Timestamp("2010-01-01") + pd.to_timedelta(
+        rng.integers(0, 14 * 365 * 24, n_samples), unit="h"
+    )
+    replicate = rng.integers(0, n_samples, n_rows)
+    df = pd.DataFrame(
+        {
+            "hakai_id": [f"HAKAI{id:08d}" for id in range(n_rows)],
+            "site_id": site_id[replicate],
+            "line_out_depth": line_out_depth[replicate],
+            "collected": collected[replicate],
+            "latitude": 50.0 + rng.normal(0, 0.5, n_rows),
+            "longitude": -125.0 + rng.normal(0, 0.5, n_rows),
+        }
+    )
+    for var, mean, std in [("no2_no3_um", 20, 8), ("po4", 2, 0.8), ("sio2", 40, 25)]:
+        values = rng.normal(mean, std, n_rows)
+        values[rng.random(n_rows) < 0.01] *= 10
+        values[rng.random(n_rows) < 0.05] = np.nan
+        df[var] = values
+        df[f"{var.replace('_um', '')}_flag"] = rng.choice(
+            ["AV", "SVC", None], n_rows, p=[0.2, 0.05, 0.75]
+        )
+    return df
+
+
+def generate_ctd_data(n_rows, n_stations=20, cast_depth=200, seed=0):
+    """Generate CTD profiles from multiple stations with automated QARTOD
+    flags and hakai flags reporting bottom hits and density inversions."""
+    rng = np.random.default_rng(seed)
+    n_casts = max(n_rows // cast_depth, 1)
+    cast = np.repeat(np.arange(n_casts), cast_depth)[:n_rows]
+    pressure = np.tile(np.arange(1, cast_depth + 1), n_casts)[:n_rows]
+    station = rng.choice(ctd_stations[:n_stations], n_casts)[cast]
+    start_dt = (
+        pd.Timestamp("2012-01-01")
+        + pd.to_timedelta(rng.integers(0, 12 * 365 * 24, n_casts), unit="h")
+    )[cast]
+    latitude = 50.0 + rng.normal(0, 0.01, n_rows)
+    latitude[rng.random(n_rows) < 0.1] = np.nan
+    df = pd.DataFrame(
+        {
+            "hakai_id": np.char.add("CTD_CAST_", cast.astype(str)),
+            "station": station,
+            "start_dt": start_dt,
+            "direction_flag": "d",
+            "pressure": pressure.astype(float),
+            "depth": pressure * 0.99,
+            "latitude": latitude,
+            "longitude": -125.0 + rng.normal(0, 0.01, n_rows),
+            "station_latitude": 50.0,
+            "station_longitude": -125.0,
+            "temperature": 10 - 4 * pressure / cast_depth + rng.normal(0, 0.1, n_rows),
+            "salinity": 29 + 3 * pressure / cast_depth + rng.normal(0, 0.05, n_rows),
+        }
+    )
+    for var in ["temperature", "salinity"]:
+        df[f"{var}_flag_level_1"] = rng.choice([1, 3, 4], n_rows, p=[0.97, 0.02, 0.01])
+        df[f"{var}_flag"] = rng.choice(ctd_flags, n_rows, p=[0.98, 0.015, 0.005])
+    return df
+
+
+@pytest.fixture(scope="session")
+def nutrients_data(n_rows):
+    return generate_nutrients_data(n_rows)
+
+
+@pytest.fixture(scope="session")
+def ctd_data(n_rows):
+    return generate_ctd_data(n_rows)
+
+
+@pytest.fixture
+def run_benchmark(benchmark):
+    """Record the peak memory of a first run and time the following ones"""
+
+    def run(func, *args, rounds=3, **kwargs):
+        tracemalloc.start()
+        try:
+            func(*args, **kwargs)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        benchmark.extra_info["peak_memory_mb"] = round(peak / 1e6, 2)
+        return benchmark.pedantic(
+            func, args=args, kwargs=kwargs, rounds=rounds, iterations=1
+        )
+
+    return run
@@ -0,0 +1,35 @@
+import pytest
+
+from hakai_qc.analysis import (
+    get_interannual_variability,
+    get_samples_pool_standard_deviation,
+)
+
+variables = ["no2_no3_um", "po4", "sio2"]
+
+
+@pytest.fixture(scope="session")
+def interannual_data(nutrients_data):
+    return (
+        nutrients_data[["site_id", "line_out_depth", "collected", *variables]]
+        .rename(columns={"line_out_depth": "reference_depth", "collected": "time"})
+        .assign(year=lambda x: x["time"].dt.year)
+    )
+
+
+def test_get_interannual_variability(run_benchmark, interannual_data):
+    run_benchmark(
+        get_interannual_variability,
+        interannual_data,
+        groupby=["site_id", "year", "reference_depth"],
+    )
+
+
+def test_get_samples_pool_standard_deviation(run_benchmark, nutrients_data):
+    groupby = ["site_id", "line_out_depth", "collected"]
+    run_benchmark(
+        get_samples_pool_standard_deviation,
+        nutrients_data[[*groupby, *variables]],
+        variables,
+        groupby,
+    )
@@ -0,0 +1,20 @@
+import pytest
+
+from hakai_qc.ctd import (
+    generate_qc_flags,
+    generate_variables_qc_flags,
+    get_derive_variables,
+)
+
+
+@pytest.mark.parametrize("chunk_size", [None, 100_000])
+def test_get_derive_variables(run_benchmark, ctd_data, chunk_size):
+    run_benchmark(get_derive_variables, ctd_data.copy(), chunk_size=chunk_size)
+
+
+def test_generate_qc_flags(run_benchmark, ctd_data):
+    run_benchmark(generate_qc_flags, ctd_data, "temperature")
+
+
+def test_generate_variables_qc_flags(run_benchmark, ctd_data):
+    run_benchmark(generate_variables_qc_flags, ctd_data, ["temperature", "salinity"])
@@ -0,0 +1,10 @@
+import pytest
+
+from hakai_qc_app.figure import get_contour_grid
+
+
+@pytest.mark.parametrize("x_bin", [None, "7D"])
+def test_get_contour_grid(run_benchmark, ctd_data, x_bin):
+    run_benchmark(
+        get_contour_grid, ctd_data, "start_dt", "depth", "temperature", x_bin=x_bin
+    )
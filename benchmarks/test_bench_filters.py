@@ -0,0 +1,21 @@
+import pytest
+
+from hakai_qc_app.filters import FilterIndex
+
+subsets = {"station": ["CTD00", "CTD01"], "direction_flag": ["d"]}
+time_range = ("2015-01-01", "2016-01-01")
+
+
+@pytest.fixture(scope="module")
+def ctd_filter_index(ctd_data):
+    return FilterIndex(ctd_data, list(subsets), "start_dt")
+
+
+def test_filter_query(run_benchmark, ctd_data):
+    query = [f"{var} in {values}" for var, values in subsets.items()]
+    query += ["'{}' < start_dt < '{}'".format(*time_range)]
+    run_benchmark(ctd_data.query, " and ".join(query))
+
+
+def test_filter_index_mask(run_benchmark, ctd_filter_index):
+    run_benchmark(ctd_filter_index.get_mask, subsets, *time_range)
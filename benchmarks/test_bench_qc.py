@@ -0,0 +1,48 @@
+import pandas as pd
+import pytest
+
+from hakai_qc.nutrients import nutrients_qc_configs, run_nutrient_qc
+from hakai_qc.qc import qc_dataframe, update_dataframe
+
+nutrients_axes = dict(
+    time="collected", z="line_out_depth", lat="latitude", lon="longitude"
+)
+
+
+def merge_update_dataframe(df, new_df, on=None, suffix="_new", how="outer"):
+    """update_dataframe implementation prior to the index-aligned update"""
+    df_merge = pd.merge(df, new_df, how=how, suffixes=("", suffix), on=on)
+    drop_cols = []
+    for new_col in [col for col in df_merge.columns if col.endswith(suffix)]:
+        col = new_col[:-4]
+        df_merge[col] = df_merge[new_col].fillna(df_merge[col])
+        drop_cols += [new_col]
+    df_merge.drop(columns=drop_cols, inplace=True)
+    return df_merge
+
+
+def test_run_nutrient_qc(run_benchmark, nutrients_data):
+    run_benchmark(run_nutrient_qc, nutrients_data)
+
+
+@pytest.mark.parametrize("engine", ["vectorized", "ioos_qc"])
+def test_qc_dataframe(run_benchmark, nutrients_data, engine):
+    if engine == "ioos_qc" and len(nutrients_data) > 100_000:
+        pytest.skip("ioos_qc engine is too slow for large datasets")
+    run_benchmark(
+        qc_dataframe,
+        nutrients_data.sort_values(["site_id", "line_out_depth", "collected"]),
+        nutrients_qc_configs,
+        groupby=["site_id", "line_out_depth"],
+        axes=nutrients_axes,
+        engine=engine,
+    )
+
+
+@pytest.mark.parametrize("how", ["left", "outer"])
+@pytest.mark.parametrize("method", [update_dataframe, merge_update_dataframe])
+def test_update_dataframe(run_benchmark, nutrients_data, method, how):
+    new_df = nutrients_data[["hakai_id", "po4", "po4_flag"]].assign(
+        po4_qartod_gross_range_test=1
+    )
+    run_benchmark(method, nutrients_data, new_df, on="hakai_id", how=how)
@@ -1,72 +1,201 @@
 import gsw
+import numpy as np
 import pandas as pd
 
 from hakai_qc.flags import flag_qartod_to_hakai
 
-
-def get_derive_variables(df: pd.DataFrame) -> pd.DataFrame:
+# Derived variables and the variables needed to compute them
+derived_variables = {
+    "absolute_salinity": ["salinity", "pressure", "longitude", "latitude"],
+    "conservative_temperature": ["absolute_salinity", "temperature", "pressure"],
+    "density": ["absolute_salinity", "conservative_temperature", "pressure"],
+    "sigma0": ["absolute_salinity", "conservative_temperature"],
+}
+
+
+def _get_required_variables(variables: list) -> set:
+    required = set(variables)
+    for variable in variables:
+        required |= _get_required_variables(
+            [
+                dependency
+                for dependency in derived_variables[variable]
+                if dependency in derived_variables
+            ]
+        )
+    return required
+
+
+def _derive_chunk(df: pd.DataFrame, variables: set) -> dict:
+    def _get(column):
+        return df[column].to_numpy(dtype=float, na_value=np.nan)
+
+    def _get_position(column):
+        position = _get(column)
+        return np.where(np.isnan(position), _get(f"station_{column}"), position)
+
+    derived = {}
+    pressure = _get("pressure")
+    derived["absolute_salinity"] = gsw.SA_from_SP(
+        _get("salinity"),
+        pressure,
+        _get_position("longitude"),
+        _get_position("latitude"),
+    )
+    if "conservative_temperature" in variables:
+        derived["conservative_temperature"] = gsw.CT_from_t(
+            derived["absolute_salinity"], _get("temperature"), pressure
+        )
+    if "density" in variables:
+        derived["density"] = gsw.rho(
+            derived["absolute_salinity"], derived["conservative_temperature"], pressure
+        )
+    if "sigma0" in variables:
+        derived["sigma0"] = gsw.sigma0(
+            derived["absolute_salinity"], derived["conservative_temperature"]
+        )
+    return derived
+
+
+def get_derive_variables(
+    df: pd.DataFrame, variables: list = None, chunk_size: int = None, dtype=float
+) -> pd.DataFrame:
     """Generate ctd derived variables
 
+    The variables are computed by chunks of rows written into preallocated
+    arrays to bound the memory used by the temporary arrays on large
+    datasets.
+
     Args:
         df (pd.DataFrame): Hakai CTD data dataframe
+        variables (list, optional): Derived variables to compute.
+            Defaults to all the derived_variables.
+        chunk_size (int, optional): Number of rows computed at once.
+            Defaults to all the rows.
+        dtype (optional): Derived variables dtype. Defaults to float.
 
     Returns:
         pd.DataFrame: Same initial dataframe with
             the including derived variables.
     """
+    variables = variables or list(derived_variables)
+    required = _get_required_variables(variables)
+    chunk_size = chunk_size or max(len(df), 1)
+
+    results = {variable: np.empty(len(df), dtype=dtype) for variable in variables}
+    for start in range(0, len(df), chunk_size):
+        rows = slice(start, start + chunk_size)
+        derived = _derive_chunk(df.iloc[rows], required)
+        for variable in variables:
+            results[variable][rows] = derived[variable]
+
+    for variable, values in results.items():
+        df[variable] = values
+    return df
+
 
-    df["absolute_salinity"] = gsw.SA_from_SP(
-        df["salinity"],
-        df["pressure"],
-        df["longitude"].fillna(df["station_longitude"]),
-        df["latitude"].fillna(df["station_latitude"]),
+def _contains(values: pd.Series, pattern: str) -> np.ndarray:
+    """Vectorized str.contains evaluated once per unique value"""
+    codes, uniques = pd.factorize(values)
+    matches = np.append(
+        pd.Series(uniques, dtype=str).str.contains(pattern, regex=False).to_numpy(),
+        False,
     )
-    df["conservative_temperature"] = gsw.CT_from_t(
-        df["absolute_salinity"], df["temperature"], df["pressure"]
+    return matches[codes]
+
+
+ctd_variables = [
+    "temperature",
+    "salinity",
+    "dissolved_oxygen_ml_l",
+    "rinko_do_ml_l",
+    "dissolved_oxygen_percent",
+    "turbidity",
+    "flc",
+    "par",
+    "c_star_at",
+]
+
+
+def _get_comments(bottom_hits: pd.Series, density_inversions: pd.Series):
+    bottom_hit = np.where(bottom_hits > 0, "Instrument seems to have hit bottom.", "")
+    density_inversion = np.select(
+        [density_inversions > 4, density_inversions > 0],
+        [
+            "A significant number of density inversion are present.",
+            "Some density inversion are present.",
+        ],
+        "",
     )
-    df["density"] = gsw.rho(
-        df["absolute_salinity"], df["conservative_temperature"], df["pressure"]
+    separator = np.where((bottom_hit != "") & (density_inversion != ""), "\n", "")
+    return np.char.add(np.char.add(bottom_hit, separator), density_inversion).astype(
+        object
     )
-    df["sigma0"] = gsw.sigma0(df["absolute_salinity"], df["conservative_temperature"])
 
-    return df
 
+def generate_variables_qc_flags(
+    data: pd.DataFrame, variables: list = None
+) -> pd.DataFrame:
+    """Review the automatically generated flags of multiple variables and
+    assign a cast global flag for each of them in a single grouped pass.
 
-def generate_qc_flags(data: pd.DataFrame, variable: str) -> pd.DataFrame:
-    """Review the automatically generated flags and assign a cast global flag.
+    Each variable cast flag is the median of its QARTOD flags unless more than
+    four density inversions were flagged, comments report bottom hits and
+    density inversions.
 
     Args:
         data (pd.DataFrame): Cast data
-        variable (str): Column to review
+        variables (list, optional): Variables to review. Defaults to
+            ctd_variables, variables without flag columns are ignored.
 
     Returns:
-        pd.DataFrame: hakai_id specific flag dataframe
+        pd.DataFrame: hakai_id specific dataframe with the suggested
+            {variable}_flag and {variable}_comments of each variable
     """
+    variables = [
+        variable
+        for variable in (variables or ctd_variables)
+        if f"{variable}_flag" in data and f"{variable}_flag_level_1" in data
+    ]
+
+    columns = {}
+    for variable in variables:
+        flags = data[f"{variable}_flag"]
+        columns[f"{variable}_bottom_hit"] = _contains(flags, "bottom_hit_test")
+        columns[f"{variable}_density_inversion"] = _contains(flags, "density_inversion")
+        columns[f"{variable}_flag_level_1"] = data[f"{variable}_flag_level_1"]
+    grouped = pd.DataFrame(columns, index=data.index).groupby(data["hakai_id"])
+    qartod_flags = [col for col in columns if col.endswith("_flag_level_1")]
+    counts = grouped[[col for col in columns if col not in qartod_flags]].sum()
+    median_flags = grouped[qartod_flags].median().astype(float)
+
+    suggested_flags = {}
+    for variable in variables:
+        density_inversions = counts[f"{variable}_density_inversion"]
+        suggested_flags[f"{variable}_flag"] = (
+            median_flags[f"{variable}_flag_level_1"]
+            .replace(flag_qartod_to_hakai)
+            .astype(object)
+            .where(density_inversions <= 4, "SVC")
+        )
+        suggested_flags[f"{variable}_comments"] = _get_comments(
+            counts[f"{variable}_bottom_hit"], density_inversions
+        )
+    return pd.DataFrame(suggested_flags, index=counts.index)
 
-    def _common_automated_qc_flag(flags):
-        return flags.dropna().median()
-
-    def _review_hakai_flag(flags):
-        flag, comment = None, []
 
-        if flags.str.contains("bottom_hit_test").any():
-            comment += ["Instrument seems to have hit bottom."]
-        if 0 < len(flags.loc[flags.astype(str).str.contains("density_inversion")]) <= 4:
-            comment += ["Some density inversion are present."]
-        if 4 < len(flags.loc[flags.astype(str).str.contains("density_inversion")]):
-            comment += ["A significant number of density inversion are present."]
-            flag = "SVC"
-        return {hakai_flag: flag, "comments": "\n".join(comment)}
+def generate_qc_flags(data: pd.DataFrame, variable: str) -> pd.DataFrame:
+    """Review the automatically generated flags and assign a cast global flag.
 
-    qartod_flag = f"{variable}_flag_level_1"
-    hakai_flag = f"{variable}_flag"
+    Args:
+        data (pd.DataFrame): Cast data
+        variable (str): Column to review
 
-    qc_flags = data.groupby("hakai_id").agg(
-        {qartod_flag: _common_automated_qc_flag, hakai_flag: _review_hakai_flag}
-    )
-    suggested_flags = qc_flags[hakai_flag].apply(pd.Series)
-    suggested_flags[hakai_flag] = suggested_flags[hakai_flag].fillna(
-        qc_flags[qartod_flag].replace(flag_qartod_to_hakai)
+    Returns:
+        pd.DataFrame: hakai_id specific flag dataframe
+    """
+    if f"{variable}_flag" not in data or f"{variable}_flag_level_1" not in data:
+        raise KeyError(f"No {variable} flag columns available")
+    return generate_variables_qc_flags(data, [variable]).rename(
+        columns={f"{variable}_comments": "comments"}
     )
-
-    return suggested_flags
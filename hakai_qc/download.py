@@ -0,0 +1,436 @@
+import hashlib
+import json
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Callable
+
+import orjson
+import pandas as pd
+import requests
+from loguru import logger
+from requests.adapters import HTTPAdapter
+
+RECORDS_BLOCK_SIZE = 50000
+# HTTP errors of an unavailable server which are worth retrying
+TRANSIENT_STATUS_CODES = (502, 503, 504)
+
+
+def _set_dtypes(df: pd.DataFrame, dtypes: dict) -> pd.DataFrame:
+    for field, dtype in dtypes.items():
+        if field not in df:
+            continue
+        try:
+            df[field] = df[field].astype(dtype)
+        except (TypeError, ValueError):
+            logger.warning("Failed to convert {} to {}", field, dtype)
+    return df
+
+
+def read_records(
+    content: bytes | str | list,
+    fields: list = None,
+    dtypes: dict = None,
+    block_size: int = RECORDS_BLOCK_SIZE,
+) -> pd.DataFrame:
+    """Convert a Hakai API json response to a typed dataframe.
+
+    The response is parsed with orjson and the records are consumed by blocks.
+    Each block is converted to a dataframe with explicit dtypes and the parsed
+    records are released right away, which avoids holding the whole list of
+    records and its intermediary object representation in memory at once.
+    A list of records given as `content` is left unchanged.
+
+    Args:
+        content (bytes|str|list): Hakai API response content or parsed records
+        fields (list, optional): Fields to retrieve. Defaults to the keys
+            of the first record.
+        dtypes (dict, optional): Mapping of the fields dtypes. Fields
+            not listed are kept as python objects.
+        block_size (int, optional): Number of records converted at once.
+
+    Returns:
+        pd.DataFrame: Records dataframe
+    """
+    # Records given by the caller are copied to a new list so that only the
+    # references of this function are released
+    records = (
+        orjson.loads(content) if isinstance(content, (bytes, str)) else list(content)
+    )
+    if not records:
+        return pd.DataFrame(columns=fields)
+    fields = fields or list(records[0].keys())
+    dtypes = dtypes or {}
+
+    blocks = []
+    while records:
+        block = records[:block_size]
+        del records[:block_size]
+        blocks.append(_set_dtypes(pd.DataFrame(block, columns=fields), dtypes))
+        del block
+
+    return blocks[0] if len(blocks) == 1 else pd.concat(blocks, ignore_index=True)
+
+
+def normalize_query(query: str) -> str:
+    """Sort the query parameters to generate a unique query string."""
+    return "&".join(sorted(item for item in query.lstrip("?").split("&") if item))
+
+
+def rename_query_filters(query: str, mapping: dict) -> str:
+    """Keep only the query filters on the mapping variables and rename them.
+
+    Args:
+        query (str): Query string (ex: "station=QU39&start_dt>2022-01-01")
+        mapping (dict): Variables mapping (ex: {"station": "site_id"})
+
+    Returns:
+        str: Renamed query (ex: "site_id=QU39")
+    """
+    filters = (
+        re.fullmatch("([^=<>]+)(=|>=|<=|>|<)(.*)", item)
+        for item in query.lstrip("?").split("&")
+    )
+    return "&".join(
+        f"{mapping[match[1]]}{match[2]}{match[3]}"
+        for match in filters
+        if match and match[1] in mapping
+    )
+
+
+def _get_latest_time(times: pd.Series) -> str:
+    return times.loc[pd.to_datetime(times, utc=True).idxmax()]
+
+
+class QueryCache:
+    """Parquet backed cache of the Hakai API query results.
+
+    Each query result is stored as a parquet file under `directory` with a json
+    sidecar file containing the query metadata. When a `time_variable` is
+    given, repeated queries only retrieve the records collected since the
+    latest cached record and merge them to the cached results. Changes made
+    to the records already cached are not retrieved until they expire, use
+    `max_age` to bound how long they can be outdated.
+
+    Args:
+        directory (str|Path): Directory where the query results are stored.
+        max_age (float, optional): Cached results older than `max_age`
+            seconds are fully downloaded again. Defaults to no limit.
+    """
+
+    def __init__(self, directory: str | Path, max_age: float = None):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_age = max_age
+
+    def _get_path(self, endpoint: str, query: str) -> Path:
+        key = hashlib.sha1(f"{endpoint}?{normalize_query(query)}".encode())
+        return self.directory / f"{key.hexdigest()}.parquet"
+
+    def _load(self, path: Path) -> tuple:
+        metadata_path = path.with_suffix(".json")
+        if not path.exists() or not metadata_path.exists():
+            return None, None
+        metadata = json.loads(metadata_path.read_text())
+        if self.max_age and time.time() - metadata["fetched_at"] > self.max_age:
+            logger.debug("Cached query {} is expired", metadata["query"])
+            return None, None
+        return pd.read_parquet(path), metadata
+
+    def _save(self, path: Path, df: pd.DataFrame, endpoint: str, query: str):
+        try:
+            df.to_parquet(path, index=False)
+        except Exception:
+            logger.exception("Failed to cache query {}?{}", endpoint, query)
+            return
+        path.with_suffix(".json").write_text(
+            json.dumps(
+                {"endpoint": endpoint, "query": query, "fetched_at": time.time()}
+            )
+        )
+
+    def get(
+        self,
+        endpoint: str,
+        query: str,
+        fetch: Callable[[str], pd.DataFrame],
+        time_variable: str = None,
+        refresh: bool = False,
+    ) -> pd.DataFrame:
+        """Retrieve the query results from the cache and update them.
+
+        Args:
+            endpoint (str): Hakai API endpoint
+            query (str): Query string
+            fetch (Callable): Function retrieving the records of a query
+                string, returns None if the download failed.
+            time_variable (str, optional): Time variable used to only
+                retrieve the new records. If None, cached results are
+                returned as is.
+            refresh (bool, optional): Ignore cached results.
+
+        Returns:
+            pd.DataFrame: Query results
+        """
+        query = query.lstrip("?")
+        path = self._get_path(endpoint, query)
+        cached, _ = (None, None) if refresh else self._load(path)
+
+        if cached is None:
+            logger.debug("Download {}?{}", endpoint, query)
+            df = fetch(query)
+        elif time_variable is None or time_variable not in cached or cached.empty:
+            logger.debug("Load {}?{} from cache", endpoint, query)
+            return cached
+        else:
+            # Records collected at the latest time may be incomplete,
+            # drop them from the cache and retrieve them again
+            latest = _get_latest_time(cached[time_variable])
+            logger.debug("Download {}?{} records since {}", endpoint, query, latest)
+            new_records = fetch(f"{query}&{time_variable}>={latest}")
+            if new_records is None:
+                return None
+            cached = cached.loc[
+                pd.to_datetime(cached[time_variable], utc=True)
+                < pd.to_datetime(latest, utc=True)
+            ]
+            df = pd.concat(
+                [data for data in (cached, new_records) if not data.empty]
+                or [new_records],
+                ignore_index=True,
+            )
+            logger.info(
+                "Merged {} new records to {} cached records",
+                len(new_records),
+                len(cached),
+            )
+
+        if df is not None:
+            self._save(path, df, endpoint, query)
+        return df
+
+    def invalidate(self, endpoint: str = None):
+        """Delete the cached results of an endpoint or of all endpoints."""
+        for metadata_path in self.directory.glob("*.json"):
+            metadata = json.loads(metadata_path.read_text())
+            if endpoint and metadata["endpoint"] != endpoint:
+                continue
+            logger.debug("Drop cached query {}", metadata["query"])
+            metadata_path.with_suffix(".parquet").unlink(missing_ok=True)
+            metadata_path.unlink()
+
+
+def _format_time(time: pd.Timestamp) -> str:
+    if time.tzinfo is None:
+        return time.strftime("%Y-%m-%dT%H:%M:%S")
+    return time.tz_convert("UTC").strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _to_utc(time: pd.Timestamp) -> pd.Timestamp:
+    return time.tz_localize("UTC") if time.tzinfo is None else time.tz_convert("UTC")
+
+
+def split_query_by_time(query: str, time_variable: str, freq: str) -> list:
+    """Split a query in consecutive time ranges.
+
+    The query needs both a lower and an upper bound on the time variable to be
+    split, otherwise it is returned as is.
+
+    Args:
+        query (str): Query string (ex: "station=QU39&start_dt>2020-01-01")
+        time_variable (str): Time variable used to split the query
+        freq (str): Time range length of each chunk (ex: "180D")
+
+    Returns:
+        list: Query strings of each chunk
+    """
+    items = query.lstrip("?").split("&")
+    bounds = {
+        match[1][0]: (match[1], match[2])
+        for match in (
+            re.fullmatch(f"{time_variable}(>=|<=|>|<)(.+)", item) for item in items
+        )
+        if match
+    }
+    if set(bounds) != {">", "<"}:
+        return [query]
+
+    (lower_op, start), (upper_op, end) = bounds[">"], bounds["<"]
+    try:
+        start_time, end_time = pd.to_datetime(start), pd.to_datetime(end)
+    except (TypeError, ValueError):
+        logger.warning("Failed to parse {} bounds, query is not split", time_variable)
+        return [query]
+    if (start_time.tzinfo is None) != (end_time.tzinfo is None):
+        # Naive bounds are considered as UTC if the other bound is tz-aware
+        start_time, end_time = _to_utc(start_time), _to_utc(end_time)
+    edges = [
+        _format_time(edge)
+        for edge in pd.date_range(start_time, end_time, freq=freq)[1:]
+        if edge < end_time
+    ]
+    if not edges:
+        return [query]
+
+    items = [item for item in items if not re.match(f"{time_variable}[<>]", item)]
+    lower_bounds = [f"{lower_op}{start}", *[f">={edge}" for edge in edges]]
+    upper_bounds = [*[f"<{edge}" for edge in edges], f"{upper_op}{end}"]
+    return [
+        "&".join([*items, f"{time_variable}{lower}", f"{time_variable}{upper}"])
+        for lower, upper in zip(lower_bounds, upper_bounds)
+    ]
+
+
+def _is_transient_error(error: Exception) -> bool:
+    """Check if a failed query is worth retrying."""
+    if isinstance(error, requests.HTTPError):
+        return (
+            error.response is not None
+            and error.response.status_code in TRANSIENT_STATUS_CODES
+        )
+    return error is None or isinstance(
+        error,
+        (requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError),
+    )
+
+
+def fetch_chunks(
+    fetch: Callable[[str], pd.DataFrame],
+    queries: list,
+    max_workers: int = 4,
+    retries: int = 2,
+    progress: Callable[[int, int], None] = None,
+    on_error: Callable[[str, Exception], None] = None,
+) -> pd.DataFrame:
+    """Fetch multiple queries concurrently and concatenate their results.
+
+    Failed queries (None returned by `fetch`, connection errors, timeouts and
+    502/503/504 responses) are retried up to `retries` times, successful ones
+    are not downloaded again. Any other error fails the download right away.
+
+    Args:
+        fetch (Callable): Function retrieving the records of a query string
+        queries (list): Query strings to retrieve
+        max_workers (int, optional): Maximum number of concurrent requests.
+        retries (int, optional): Number of retries of the failed queries.
+        progress (Callable, optional): Called with the number of completed
+            and total queries every time a query is completed.
+        on_error (Callable, optional): Called with the query and the last
+            exception raised for each query which failed after all retries.
+
+    Returns:
+        pd.DataFrame: Concatenated results in the order of the queries, None
+            if any query failed.
+    """
+    results, errors = {}, {}
+    pending = list(range(len(queries)))
+    for attempt in range(retries + 1):
+        failed = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(fetch, queries[id]): id for id in pending}
+            for future in as_completed(futures):
+                id = futures[future]
+                errors.pop(id, None)
+                try:
+                    result = future.result()
+                except Exception as error:
+                    logger.exception("Failed to retrieve {}", queries[id])
+                    errors[id] = error
+                    result = None
+                if result is None:
+                    failed.append(id)
+                    continue
+                results[id] = result
+                if progress:
+                    progress(len(results), len(queries))
+        pending = sorted(failed)
+        if not pending:
+            break
+        elif not all(_is_transient_error(errors.get(id)) for id in pending):
+            logger.error("Do not retry queries which failed with a permanent error")
+            break
+        logger.warning("Retry {} failed queries: {}", len(pending), pending)
+    if pending:
+        logger.error("Failed to retrieve {} queries", len(pending))
+        for id in pending:
+            if on_error and id in errors:
+                on_error(queries[id], errors[id])
+        return None
+    if len(queries) == 1:
+        return results[0]
+    return pd.concat([results[id] for id in range(len(queries))], ignore_index=True)
+
+
+def share_connection_pool(client, max_workers: int):
+    """Let the client reuse up to `max_workers` connections concurrently."""
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    client.mount("https://", adapter)
+    client.mount("http://", adapter)
+
+
+def download_hakai_data(
+    client,
+    endpoint: str,
+    query: str,
+    fields: list = None,
+    dtypes: dict = None,
+    cache: QueryCache = None,
+    time_variable: str = None,
+    timeout: float = 120,
+    chunk_freq: str = None,
+    max_workers: int = 4,
+    progress: Callable[[int, int], None] = None,
+    on_error: Callable[[str, Exception], None] = None,
+) -> pd.DataFrame:
+    """Download Hakai API records as a dataframe.
+
+    Args:
+        client (hakai_api.Client): Hakai API client
+        endpoint (str): Hakai API endpoint (ex: "eims/views/output/nutrients")
+        query (str): Query string (ex: "site_id=QU39&collected>2022-01-01")
+        fields (list, optional): Fields to retrieve.
+        dtypes (dict, optional): Fields dtypes.
+        cache (QueryCache, optional): Cache the query results.
+        time_variable (str, optional): Time variable used to only
+            retrieve new records from the API when the query is cached.
+        timeout (float, optional): Request timeout in seconds.
+        chunk_freq (str, optional): Split the query in time ranges of
+            `chunk_freq` length (ex: "180D") downloaded concurrently.
+        max_workers (int, optional): Maximum number of concurrent requests.
+        progress (Callable, optional): Called with the number of completed
+            and total chunks every time a chunk is downloaded.
+        on_error (Callable, optional): Called with the query and the
+            exception of each chunk which failed to download.
+
+    Returns:
+        pd.DataFrame: Retrieved records, None if the download failed
+    """
+
+    def _fetch_chunk(query):
+        url = f"{client.api_root}/{endpoint}?{query}"
+        url += "&limit=-1" if "limit" not in query else ""
+        url += "&fields=" + ",".join(fields) if fields else ""
+        response = client.get(url, timeout=timeout)
+        response.raise_for_status()
+        return read_records(response.content, fields, dtypes)
+
+    def _fetch(query):
+        return fetch_chunks(
+            _fetch_chunk,
+            (
+                split_query_by_time(query, time_variable, chunk_freq)
+                if chunk_freq and time_variable
+                else [query]
+            ),
+            max_workers=max_workers,
+            progress=progress,
+            on_error=on_error,
+        )
+
+    if chunk_freq:
+        share_connection_pool(client, max_workers)
+
+    if cache is None:
+        return _fetch(query.lstrip("?"))
+    return cache.get(endpoint, query, _fetch, time_variable=time_variable)
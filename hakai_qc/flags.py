@@ -1,3 +1,8 @@
+import re
+
+import numpy as np
+import pandas as pd
+
 # Flag convention
 flag_color_map = {
     "AV": "#2ECC40",
@@ -72,3 +77,85 @@ flag_mapping = {"no2_no3_um": "no2_no3_flag"}
 
 def get_hakai_variable_flag(variable):
     return flag_mapping.get(variable, f"{variable}_flag")
+
+
+# Flag dtypes
+hakai_flags = [
+    *[flag["value"] for flag in flags_conventions["Hakai"]],
+    "MV",
+    "NA",
+    "",
+]
+qartod_flags = [flag["value"] for flag in flags_conventions["QARTOD"]]
+qartod_flag_dtype = "Int8"
+hakai_flag_dtype = pd.CategoricalDtype(hakai_flags)
+
+# QARTOD flag value to hakai flag category code
+_qartod_to_hakai_codes = np.full(max(qartod_flags) + 1, -1, dtype="int8")
+for qartod_flag, hakai_flag in flag_qartod_to_hakai.items():
+    _qartod_to_hakai_codes[qartod_flag] = hakai_flags.index(hakai_flag)
+
+
+def is_hakai_flag_variable(variable):
+    return variable != "direction_flag" and bool(re.match(".*_flag$", variable))
+
+
+def is_qartod_flag_variable(variable):
+    return bool(re.match(".*_flag_level_1$", variable))
+
+
+def to_hakai_flag(values) -> pd.Series:
+    """Convert hakai flags to a categorical series with the hakai vocabulary
+    and any other observed values (ie. CTD flags comments) as categories."""
+    values = pd.Series(values)
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.astype(object)
+    extra_flags = sorted(
+        str(flag) for flag in values.dropna().unique() if flag not in hakai_flags
+    )
+    return values.astype(pd.CategoricalDtype([*hakai_flags, *extra_flags]))
+
+
+def to_qartod_flag(values) -> pd.Series:
+    """Convert QARTOD flags to nullable 1 byte integers"""
+    return pd.Series(values).astype(qartod_flag_dtype)
+
+
+def qartod_to_hakai_flag(values) -> pd.Categorical:
+    """Map QARTOD flags to the hakai flags with a lookup of the category codes"""
+    values = np.asarray(values)
+    codes = np.full(values.shape, -1, dtype="int8")
+    is_qartod = np.isin(values, qartod_flags)
+    codes[is_qartod] = _qartod_to_hakai_codes[values[is_qartod].astype(int)]
+    return pd.Categorical.from_codes(codes, dtype=hakai_flag_dtype)
+
+
+def set_flag_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """Encode the hakai flag columns (*_flag) as categoricals and the QARTOD
+    flag columns (*_flag_level_1) as 1 byte integers.
+
+    QARTOD columns with values that aren't integers are left unchanged.
+    """
+    flag_columns = {}
+    for col in df.columns:
+        if is_hakai_flag_variable(col):
+            flag_columns[col] = to_hakai_flag(df[col])
+        elif is_qartod_flag_variable(col):
+            try:
+                flag_columns[col] = to_qartod_flag(df[col])
+            except (TypeError, ValueError):
+                continue
+    return df.assign(**flag_columns)
+
+
+def flags_to_labels(df: pd.DataFrame) -> pd.DataFrame:
+    """Convert the encoded flag columns back to python objects with None for
+    missing values, to be used at the UI and export edges."""
+    return df.assign(
+        **{
+            col: df[col].astype(object).where(df[col].notna(), None)
+            for col in df.columns
+            if isinstance(df[col].dtype, pd.CategoricalDtype)
+            or df[col].dtype == qartod_flag_dtype
+        }
+    )
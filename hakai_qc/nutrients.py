@@ -2,7 +2,7 @@ import plotly.express as px
 from plotly.subplots import make_subplots
 
 from hakai_qc.analysis import get_samples_pool_standard_deviation
-from hakai_qc.flags import flag_qartod_to_hakai, get_hakai_variable_flag
+from hakai_qc.flags import get_hakai_variable_flag, qartod_to_hakai_flag
 from hakai_qc.qc import qartod_compare, qc_dataframe
 
 variables_flag_mapping = {"no2_no3_um": "no2_no3_flag"}
@@ -77,10 +77,16 @@ def run_nutrient_qc(
     config=None,
     groupby=["site_id", "line_out_depth"],
     overwrite_existing_flags=False,
+    n_jobs=None,
+    executor=None,
 ):
+    """Run Hakai Nutrient automated QC
+
+    The groups qc can be distributed over a pool of `n_jobs` processes or a
+    given `executor`.
+    """
     if config is None:
         config = nutrients_qc_configs
-    """Run Hakai Nutrient automated QC"""
     # Run QARTOD tests
     original_columns = df.columns
     df = df.sort_values(["site_id", "line_out_depth", "collected"])
@@ -91,6 +97,8 @@ def run_nutrient_qc(
         axes=dict(
             time="collected", z="line_out_depth", lat="latitude", lon="longitude"
         ),
+        n_jobs=n_jobs,
+        executor=executor,
     )
 
     # aggregate flags
@@ -103,7 +111,7 @@ def run_nutrient_qc(
             .transpose()
             .to_numpy()
         )
-        df[agg_flag] = df[agg_flag].replace(flag_qartod_to_hakai)
+        df[agg_flag] = qartod_to_hakai_flag(df[agg_flag])
 
         # Apply BDL flag
         if var in nutrients_qc_bdl:
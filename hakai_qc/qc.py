@@ -1,16 +1,304 @@
+import hashlib
+import inspect
+import json
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from textwrap import dedent
+
+import numpy as np
 import pandas as pd
 from ioos_qc import qartod
 from ioos_qc.config import Config
-from ioos_qc.qartod import qartod_compare
+from ioos_qc.qartod import QartodFlags, qartod_compare
 from ioos_qc.stores import PandasStore
 from ioos_qc.streams import PandasStream
+from ioos_qc.utils import cf_safe_name
 from loguru import logger
 
 default_axe_variables = dict(time="time", z="depth", lat="lat", lon="lon")
 
 
-def qc_dataframe(df, configs, groupby=None, axes=None):
-    """Run ioos_qc on subsets of a dataframe"""
+# Parsed ioos_qc configs, their source and parsing time (seconds) by content hash
+compiled_configs = {}
+config_sources = {}
+config_parse_times = {}
+
+
+def get_config_key(config) -> str:
+    """Generate a hash of the config content"""
+    if isinstance(config, str):
+        content = dedent(config).strip()
+    else:
+        content = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def get_config(config) -> Config:
+    """Parse and validate an ioos_qc config once and reuse it afterward.
+
+    Configs are memoized by content hash in each process, a Config object
+    can also be given directly and is returned as is.
+
+    Args:
+        config (str|dict|Config): ioos_qc config (yaml string or dict)
+
+    Returns:
+        Config: Parsed ioos_qc config
+    """
+    if isinstance(config, Config):
+        return config
+    key = get_config_key(config)
+    if key not in compiled_configs:
+        start = time.perf_counter()
+        compiled_configs[key] = Config(config)
+        config_sources[key] = config
+        config_parse_times[key] = time.perf_counter() - start
+        logger.debug(
+            "Parsed ioos_qc config {} in {:.2f} ms",
+            key[:8],
+            config_parse_times[key] * 1000,
+        )
+    return compiled_configs[key]
+
+
+def get_config_source(config):
+    """Retrieve the source of a config parsed by get_config"""
+    if not isinstance(config, Config):
+        return config
+    for key, compiled_config in compiled_configs.items():
+        if compiled_config is config:
+            return config_sources[key]
+    raise ValueError("Config was not parsed with get_config")
+
+
+def compile_configs(configs: dict) -> dict:
+    """Parse all the configs of a {query: config} mapping"""
+    return {query: get_config(config) for query, config in configs.items()}
+
+
+def _gross_range_test(inp, group, fail_span, suspect_span=None):
+    fail_min, fail_max = sorted(fail_span)
+    flags = np.ones(inp.size, dtype="uint8")
+    with np.errstate(invalid="ignore"):
+        if suspect_span is not None:
+            suspect_min, suspect_max = sorted(suspect_span)
+            if suspect_min < fail_min or suspect_max > fail_max:
+                raise ValueError(
+                    f"Suspect {suspect_span} must fall within the Fail {fail_span}"
+                )
+            flags[(inp < suspect_min) | (inp > suspect_max)] = QartodFlags.SUSPECT
+        flags[(inp < fail_min) | (inp > fail_max)] = QartodFlags.FAIL
+    flags[~np.isfinite(inp)] = QartodFlags.MISSING
+    return flags
+
+
+def _spike_test(
+    inp, group, suspect_threshold=None, fail_threshold=None, method="average"
+):
+    # Matches ioos_qc>=2.3 spike_test, ioos_qc 2.2 fails to run the
+    # "differential" method on series without missing values and leaves the
+    # results empty (considered GOOD by run_nutrient_qc).
+    # Neighbours are only considered within the same group
+    same_group = group[1:] == group[:-1]
+    has_neighbours = np.append(False, same_group) & np.append(same_group, False)
+    previous = np.append(np.nan, inp[:-1])
+    following = np.append(inp[1:], np.nan)
+
+    with np.errstate(invalid="ignore"):
+        if method == "average":
+            diff = np.abs(inp - (previous + following) / 2)
+        elif method == "differential":
+            diff_previous, diff_following = inp - previous, following - inp
+            diff = np.minimum(np.abs(diff_previous), np.abs(diff_following))
+            diff[diff_previous * diff_following >= 0] = 0
+        else:
+            raise ValueError(
+                f'Unknown method: "{method}", only "average" and "differential" '
+                "methods are available"
+            )
+
+        flags = np.ones(inp.size, dtype="uint8")
+        if suspect_threshold:
+            flags[diff > suspect_threshold] = QartodFlags.SUSPECT
+        if fail_threshold:
+            flags[diff > fail_threshold] = QartodFlags.FAIL
+    flags[~has_neighbours | ~np.isfinite(diff)] = QartodFlags.UNKNOWN
+    flags[~np.isfinite(inp)] = QartodFlags.MISSING
+    return flags
+
+
+vectorized_tests = {
+    "qartod.gross_range_test": _gross_range_test,
+    "qartod.spike_test": _spike_test,
+}
+
+
+def _is_vectorized_call(call) -> bool:
+    test = vectorized_tests.get(call.method_path)
+    return test is not None and set(call.kwargs) <= set(
+        inspect.signature(test).parameters
+    )
+
+
+def is_vectorized_config(config: Config) -> bool:
+    """Check if all the config tests and their arguments are available in the
+    vectorized engine"""
+    return all(
+        _is_vectorized_call(call)
+        for calls in config.contexts.values()
+        for call in calls
+    )
+
+
+def _run_vectorized_qc(
+    df: pd.DataFrame, config: Config, groupby: list, axes: dict
+) -> pd.DataFrame:
+    """Run the config tests on all the groups at once.
+
+    Equivalent to running ioos_qc PandasStream on each group, with the
+    same window subsets and spike neighbours limited to each group.
+    """
+    group = (
+        df.groupby(groupby, sort=False).ngroup().to_numpy()
+        if groupby
+        else np.zeros(len(df), dtype=int)
+    )
+    df = df.loc[group >= 0]
+    group = group[group >= 0]
+    # Sort by group while keeping the original order within each group
+    order = np.argsort(group, kind="stable")
+    df, group = df.iloc[order], group[order]
+
+    results = {}
+    for context, calls in config.contexts.items():
+        in_window = np.ones(len(df), dtype=bool)
+        if axes["time"] in df:
+            if context.window.starting:
+                in_window &= (df[axes["time"]] >= context.window.starting).to_numpy()
+            if context.window.ending:
+                in_window &= (df[axes["time"]] < context.window.ending).to_numpy()
+        for call in calls:
+            if call.stream_id not in df:
+                logger.warning("{} is not a column in the dataframe", call.stream_id)
+                continue
+            column = cf_safe_name(f"{call.stream_id}.{call.module}.{call.method}")
+            inp = df[call.stream_id].to_numpy(dtype="float64")[in_window]
+            flags = vectorized_tests[call.method_path](
+                inp, group[in_window], **call.kwargs
+            )
+            result = results.setdefault(column, np.full(len(df), np.nan))
+            result[in_window] = flags
+    return df.assign(**results)
+
+
+def _run_qc_batch(
+    columns: dict, group: np.ndarray, config, axes: dict, engine: str
+) -> pd.DataFrame:
+    """Run the qc on a batch of groups given as column arrays sorted by group"""
+    df = pd.DataFrame(columns)
+    parsed_config = get_config(config)
+    if engine == "vectorized" or (
+        engine == "auto" and is_vectorized_config(parsed_config)
+    ):
+        df_qced = _run_vectorized_qc(
+            df.assign(_group=group), parsed_config, ["_group"], axes
+        )
+    else:
+        results = []
+        for _, timeserie in df.groupby(group, sort=False):
+            stream = PandasStream(timeserie.reset_index(drop=True), **axes)
+            store = PandasStore(stream.run(parsed_config), axes=axes)
+            results += [
+                store.save(write_data=False, write_axes=False).set_axis(timeserie.index)
+            ]
+        df_qced = df.join(pd.concat(results))
+    return df_qced.drop(columns=[*columns, "_group"], errors="ignore")
+
+
+def _run_parallel_qc(
+    df: pd.DataFrame,
+    config,
+    groupby: list,
+    axes: dict,
+    engine: str,
+    n_jobs: int = None,
+    executor: Executor = None,
+) -> pd.DataFrame:
+    """Distribute the groups qc in batches over a pool of processes.
+
+    Only the columns needed by the tests are sent to the workers as numpy
+    arrays and the results are reassembled in the original groups order.
+    """
+    parsed_config = get_config(config)
+    config = get_config_source(config)
+    group = df.groupby(groupby, sort=False).ngroup().to_numpy()
+    df = df.loc[group >= 0]
+    group = group[group >= 0]
+    order = np.argsort(group, kind="stable")
+    df, group = df.iloc[order], group[order]
+
+    streams = {
+        call.stream_id for calls in parsed_config.contexts.values() for call in calls
+    }
+    columns = [col for col in df if col in streams or col in axes.values()]
+
+    # Split the groups in batches starting at a group first row
+    n_jobs = n_jobs or os.cpu_count()
+    group_starts = np.flatnonzero(np.diff(group, prepend=-1))
+    bounds = [
+        *[
+            starts[0]
+            for starts in np.array_split(group_starts, 4 * n_jobs)
+            if starts.size
+        ],
+        len(group),
+    ]
+
+    pool = executor or ProcessPoolExecutor(max_workers=n_jobs)
+    try:
+        futures = [
+            pool.submit(
+                _run_qc_batch,
+                {col: df[col].to_numpy()[start:end] for col in columns},
+                group[start:end],
+                config,
+                axes,
+                engine,
+            )
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+        results = [future.result() for future in futures]
+    finally:
+        if executor is None:
+            pool.shutdown()
+    logger.debug("qc ran on {} batches", len(results))
+    return df.join(pd.concat(results, ignore_index=True).set_axis(df.index))
+
+
+def qc_dataframe(
+    df, configs, groupby=None, axes=None, engine="auto", n_jobs=None, executor=None
+):
+    """Run ioos_qc on subsets of a dataframe
+
+    Args:
+        df (pd.DataFrame): data to qc
+        configs (dict): ioos_qc configs for each df.query subset
+        groupby (list, optional): columns defining each timeseries
+        axes (dict, optional): ioos_qc axes columns
+        engine (str, optional): "ioos_qc" runs ioos_qc on each group,
+            "vectorized" runs the tests on all the groups at once and "auto"
+            uses the vectorized engine if all the config tests are supported.
+            The vectorized spike test also flags the series that ioos_qc<2.3
+            fails to test.
+        n_jobs (int, optional): Run the groups qc over a pool of n_jobs
+            processes.
+        executor (Executor, optional): Run the groups qc with this executor
+            instead of a new process pool.
+
+    Returns:
+        pd.DataFrame: df with the qc results columns
+    """
     result_store = []
     if configs is not dict:
         config = {"": configs}
@@ -25,13 +313,23 @@ def qc_dataframe(df, configs, groupby=None, axes=None):
         result_store = []
         df_subset = df.query(query)[original_columns]
         logger.info("run qc on query: {} = len(df)={}", query, len(df_subset))
-        if len(df_subset) > 0:
+        parsed_config = get_config(config)
+        if len(df_subset) > 0 and (n_jobs or executor):
+            df_qced = _run_parallel_qc(
+                df_subset, config, groupby, axes, engine, n_jobs, executor
+            )
+        elif len(df_subset) > 0 and (
+            engine == "vectorized"
+            or (engine == "auto" and is_vectorized_config(parsed_config))
+        ):
+            df_qced = _run_vectorized_qc(df_subset, parsed_config, groupby, axes)
+        elif len(df_subset) > 0:
             for group, timeserie in df_subset.groupby(groupby, as_index=False):
                 # Make sure that the timeseries are sorted chronologically
                 timeserie = timeserie.reset_index()
                 # logger.debug("timeseries to be qc len(df)={}: {}", len(timeserie),timeserie)
                 stream = PandasStream(timeserie, **axes)
-                results = stream.run(Config(config))
+                results = stream.run(parsed_config)
                 store = PandasStore(results, axes=axes)
                 result_store += [
                     timeserie.join(store.save(write_data=False, write_axes=False))
@@ -45,16 +343,73 @@ def qc_dataframe(df, configs, groupby=None, axes=None):
 
 
 def update_dataframe(df, new_df, on=None, suffix="_new", how="outer"):
-    """Merge two dataframes on specified columns and update
-    missing values from the second dataframe by the first one."""
-    # Compbine the two dataframes
-    df_merge = pd.merge(df, new_df, how=how, suffixes=("", suffix), on=on)
-
-    # merge columns
-    drop_cols = []
-    for new_col in [col for col in df_merge.columns if col.endswith(suffix)]:
-        col = new_col[:-4]
-        df_merge[col] = df_merge[new_col].fillna(df_merge[col])
-        drop_cols += [new_col]
-    df_merge.drop(columns=drop_cols, inplace=True)
-    return df_merge
+    """Update a dataframe with the values of a second one matched on key columns.
+
+    Non missing values of `new_df` replace the values of `df`, columns only in
+    `new_df` are added and, with `how="outer"`, rows only in `new_df` are
+    appended. Rows are aligned on the keys index rather than merged, only the
+    overlapping columns with new values are rewritten and the columns
+    untouched by `new_df` keep their dtype.
+
+    Args:
+        df (pd.DataFrame): Dataframe to update.
+        new_df (pd.DataFrame): Dataframe with the new values, only the last
+            row of duplicated keys is used.
+        on (str|list, optional): Key columns. Defaults to the columns
+            common to both dataframes.
+        suffix (str, optional): Unused, kept for backward compatibility.
+        how (str, optional): "left", "inner" or "outer". Defaults to "outer".
+
+    Returns:
+        pd.DataFrame: Updated dataframe with a new range index.
+    """
+    if how not in ("left", "inner", "outer"):
+        raise ValueError(f"Unsupported update method how={how}")
+    if on is None:
+        on = [col for col in df.columns if col in new_df.columns]
+    elif isinstance(on, str):
+        on = [on]
+    else:
+        on = list(on)
+
+    new_keys = _get_keys_index(new_df, on)
+    if new_keys.has_duplicates:
+        logger.warning("Duplicated {} keys in update, keep the last ones", on)
+        new_df = new_df.loc[~new_keys.duplicated(keep="last")]
+        new_keys = _get_keys_index(new_df, on)
+    indexer = new_keys.get_indexer(_get_keys_index(df, on))
+    matched = indexer >= 0
+    if how == "inner":
+        df, indexer, matched = df.loc[matched], indexer[matched], matched[matched]
+
+    # Shallow copy to only replace the updated columns
+    df_updated = df.copy(deep=False)
+    df_updated.index = pd.RangeIndex(len(df))
+    for col in new_df.columns.drop(on):
+        values = pd.Series(
+            pd.api.extensions.take(new_df[col].to_numpy(), indexer, allow_fill=True),
+            index=df_updated.index,
+        )
+        if col not in df:
+            df_updated[col] = values
+            continue
+        has_value = matched & values.notna().to_numpy()
+        if has_value.all():
+            df_updated[col] = values
+        elif has_value.any():
+            df_updated[col] = values.where(has_value, df_updated[col])
+
+    if how == "outer":
+        new_rows = np.ones(len(new_df), dtype=bool)
+        new_rows[indexer[matched]] = False
+        if new_rows.any():
+            df_updated = pd.concat(
+                [df_updated, new_df.loc[new_rows]], ignore_index=True
+            )
+    return df_updated
+
+
+def _get_keys_index(df, on):
+    if len(on) == 1:
+        return pd.Index(df[on[0]])
+    return pd.MultiIndex.from_frame(df[on])
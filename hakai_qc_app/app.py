@@ -11,7 +11,10 @@ from dotenv import load_dotenv
 from sentry_sdk.integrations.loguru import LoguruIntegration
 
 import hakai_qc_app.selection as selection
-from hakai_qc_app.download_hakai import hakai_api_credentials_modal
+from hakai_qc_app.download_hakai import (
+    download_progress_bar,
+    hakai_api_credentials_modal,
+)
 from hakai_qc_app.figure import figure_menu, figure_radio_buttons
 from hakai_qc_app.hakai_plotly_template import hakai_template
 from hakai_qc_app.navbar import data_filter_interface, navbar
@@ -51,6 +54,7 @@ app = Dash(
 app.layout = html.Div(
     [
         navbar,
+        download_progress_bar,
         hakai_api_credentials_modal,
         dbc.Collapse(
             [
@@ -0,0 +1,238 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import pandas as pd
+from loguru import logger
+
+from hakai_qc.download import QueryCache
+
+
+def make_dataset_key(url, credentials=None):
+    """Generate a dataset handle from the query url and the user credentials
+
+    The credentials are hashed with the url so that two users running the
+    same query never share a cached dataset.
+    """
+    return hashlib.sha256(f"{url}|{credentials or ''}".encode()).hexdigest()
+
+
+def _get_size(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    return getattr(value, "nbytes", 0)
+
+
+class DatasetCache:
+    """Server-side LRU cache of the downloaded datasets.
+
+    The dash stores only hold the dataset handle, callbacks retrieve the
+    dataframe from this cache. Entries are evicted when the cache exceeds
+    `max_entries` or `max_size` (bytes) or once they weren't accessed for
+    `ttl` seconds. Sizes include the object columns content and are computed
+    when a dataset is stored.
+
+    Datasets can be stored with lazy columns, given as a mapping of column
+    names to a `compute(df, columns)` function adding these columns to the
+    dataframe. They are computed the first time they are requested with
+    `get(key, columns=[...])` and then kept with the cached dataset.
+
+    Indexes of a dataset are built once with `get_index(key, name, build)`
+    and dropped with the dataset.
+
+    Values for which `is_evictable(value)` is False are only dropped once
+    they weren't accessed for `pinned_ttl` seconds.
+    """
+
+    def __init__(
+        self,
+        max_entries=20,
+        max_size=2e9,
+        ttl=3600 * 6,
+        is_evictable=None,
+        pinned_ttl=None,
+    ):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.ttl = ttl
+        self.is_evictable = is_evictable
+        self.pinned_ttl = pinned_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        return sum(entry["size"] for entry in self._entries.values())
+
+    def _is_evictable(self, entry):
+        return self.is_evictable is None or self.is_evictable(entry["value"])
+
+    def _is_expired(self, entry):
+        idle = time.time() - entry["accessed"]
+        if self.pinned_ttl is not None and idle > self.pinned_ttl:
+            return True
+        return self.ttl is not None and idle > self.ttl and self._is_evictable(entry)
+
+    def _evict(self):
+        expired = [
+            key for key, entry in self._entries.items() if self._is_expired(entry)
+        ]
+        for key in expired:
+            logger.debug("Drop expired dataset {} from cache", key)
+            del self._entries[key]
+        # Least recently used first, the last entry added is always kept
+        evictable = [
+            key
+            for key, entry in list(self._entries.items())[:-1]
+            if self._is_evictable(entry)
+        ]
+        for key in evictable:
+            if len(self._entries) <= self.max_entries and self.size <= self.max_size:
+                break
+            del self._entries[key]
+            logger.debug("Drop least recently used dataset {} from cache", key)
+
+    def set(self, key, value, lazy_columns=None):
+        with self._lock:
+            self._entries[key] = {
+                "value": value,
+                "size": _get_size(value),
+                "accessed": time.time(),
+                "lazy_columns": dict(lazy_columns or {}),
+                "indexes": {},
+            }
+            self._entries.move_to_end(key)
+            self._evict()
+            logger.debug(
+                "Cached dataset {} [{} datasets, {:.1f} MB]",
+                key,
+                len(self._entries),
+                self.size / 1e6,
+            )
+        return key
+
+    def get(self, key, default=None, columns=None):
+        if key is None:
+            return default
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if self._is_expired(entry):
+                logger.debug("Dataset {} is expired", key)
+                del self._entries[key]
+                return default
+            entry["accessed"] = time.time()
+            self._entries.move_to_end(key)
+            df = entry["value"]
+            missing = self._get_missing_lazy_columns(entry, columns)
+        if not missing:
+            return df
+        return self._compute_lazy_columns(key, df, missing)
+
+    @staticmethod
+    def _get_missing_lazy_columns(entry, columns):
+        missing = {}
+        for column in columns or []:
+            compute = entry["lazy_columns"].get(column)
+            if compute is not None and column not in entry["value"]:
+                missing.setdefault(compute, []).append(column)
+        return missing
+
+    def _compute_lazy_columns(self, key, df, missing):
+        """Compute the missing lazy columns on a copy of the dataset, the cache
+        isn't locked meanwhile"""
+        computed = df.copy(deep=False)
+        for compute, lazy_columns in missing.items():
+            logger.debug("Compute lazy columns {} of dataset {}", lazy_columns, key)
+            computed = compute(computed, lazy_columns)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return computed
+            if entry["value"] is not df:
+                # The dataset was updated while computing, keep the stored one
+                # if it already includes the computed columns
+                if computed.columns.difference(entry["value"].columns).empty:
+                    return entry["value"]
+                return computed
+            new_columns = computed[computed.columns.difference(df.columns)]
+            entry["value"] = computed
+            entry["size"] += int(new_columns.memory_usage(index=False, deep=True).sum())
+            self._evict()
+        return computed
+
+    def get_index(self, key, name, build):
+        """Get the index `name` of a dataset, built with `build(df)` the first
+        time it's requested"""
+        with self._lock:
+            df = self.get(key)
+            if df is None:
+                return None
+            indexes = self._entries[key]["indexes"]
+            if name not in indexes:
+                logger.debug("Build {} index of dataset {}", name, key)
+                indexes[name] = build(df)
+            return indexes[name]
+
+    def get_columns(self, key):
+        """List the dataset columns including the lazy ones not computed yet"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return []
+            columns = list(entry["value"].columns)
+            return columns + [
+                column for column in entry["lazy_columns"] if column not in columns
+            ]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return entry["value"] if entry else default
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+dataset_cache = DatasetCache(
+    max_entries=int(os.getenv("DATASET_CACHE_MAX_ENTRIES", 20)),
+    max_size=float(os.getenv("DATASET_CACHE_MAX_SIZE", 2e9)),
+    ttl=float(os.getenv("DATASET_CACHE_TTL", 3600 * 6)),
+)
+
+
+def get_query_cache(user_id=None):
+    """Get the user persistent cache of the Hakai API queries.
+
+    Queries are cached per user since the data available depends on each user
+    permissions. Returns None if HAKAI_QUERY_CACHE_DIR is not defined.
+    """
+    directory = os.getenv("HAKAI_QUERY_CACHE_DIR")
+    if not directory:
+        return None
+    return QueryCache(
+        Path(directory) / hashlib.sha256(str(user_id).encode()).hexdigest()[:16],
+        max_age=float(os.getenv("HAKAI_QUERY_CACHE_MAX_AGE", 3600 * 24)),
+    )
+
+
+def invalidate_query_cache(endpoint):
+    """Drop the cached queries of an endpoint for all users"""
+    directory = os.getenv("HAKAI_QUERY_CACHE_DIR")
+    if not directory or not Path(directory).exists():
+        return
+    for user_directory in Path(directory).iterdir():
+        if user_directory.is_dir():
+            QueryCache(user_directory).invalidate(endpoint)
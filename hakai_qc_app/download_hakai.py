@@ -1,19 +1,36 @@
 import base64
 import binascii
 import json
-import re
+import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from urllib.parse import unquote
 
 import dash_bootstrap_components as dbc
-import pandas as pd
 from dash import Input, Output, State, callback, ctx, dcc, html
 from hakai_api import Client
 from loguru import logger
 
 from hakai_qc import ctd, nutrients
+from hakai_qc.download import (
+    download_hakai_data,
+    rename_query_filters,
+    share_connection_pool,
+)
+from hakai_qc.flags import (
+    flags_to_labels,
+    is_hakai_flag_variable,
+    is_qartod_flag_variable,
+    set_flag_dtypes,
+)
 from hakai_qc_app.__version__ import __version__
-from hakai_qc_app.variables import pages
+from hakai_qc_app.cache import dataset_cache, get_query_cache, make_dataset_key
+from hakai_qc_app.variables import get_fields_dtypes, pages
+
+DOWNLOAD_MAX_WORKERS = int(os.getenv("HAKAI_DOWNLOAD_MAX_WORKERS", 4))
+
+# {endpoint: (completed, total)} chunks of the ongoing downloads
+download_progress = {}
 
 
 def parse_hakai_token(token):
@@ -31,7 +48,7 @@ def parse_hakai_token(token):
 
     message = message_bytes.decode("ascii", "ignore")
     # remove trailing characters after '"}'
-    message = message.rsplit('"}',1)[0] + '"}'
+    message = message.rsplit('"}', 1)[0] + '"}'
     logger.debug("Decoded token={}", message)
     if message is None:
         logger.error("failed to decode token")
@@ -111,16 +128,55 @@ hakai_api_credentials_modal = dbc.Modal(
 )
 
 
+download_progress_bar = html.Div(
+    [
+        dcc.Interval(id="download-progress-interval", interval=1000),
+        dbc.Progress(
+            id="download-progress-bar",
+            label="Downloading...",
+            striped=True,
+            animated=True,
+            style={"display": "none"},
+        ),
+    ]
+)
+
+
+@callback(
+    Output("download-progress-bar", "value"),
+    Output("download-progress-bar", "label"),
+    Output("download-progress-bar", "style"),
+    Output("download-progress-interval", "disabled"),
+    Input("download-progress-interval", "n_intervals"),
+    Input("dataframe", "data"),
+    Input("toast-container", "children"),
+    State("location", "pathname"),
+    State("location", "search"),
+    State("credentials-input", "value"),
+)
+def update_download_progress(n_intervals, data, toast, path, query, credentials):
+    """Display the progress of the chunked downloads"""
+    if data or toast or not path or not query:
+        return 0, None, {"display": "none"}, True
+    progress_key = make_dataset_key(f"{path.split('/')[1]}{query}", credentials)
+    # The main and auxiliary endpoints are downloaded concurrently
+    progress = list(download_progress.get(progress_key, {}).values())
+    completed = sum(completed for completed, _ in progress)
+    total = sum(total for _, total in progress)
+    if not total:
+        return 0, None, {"display": "none"}, False
+    return (
+        100 * completed / total,
+        f"Downloaded {completed}/{total}",
+        {"display": "flex"},
+        False,
+    )
+
+
 def fill_hakai_flag_variables(df):
     """Replace hakai flag variables empty values by (*_flag: "NA", *_flag_level_1:9)"""
-    fill_hakai_flags = {
-        col: "NA"
-        for col in df.columns
-        if col not in ("direction_flag") and re.match(".*_flag$", col)
-    }
-    fill_flags_level_1 = {
-        col: 9 for col in df.columns if re.match(".*_flag_level_1$", col)
-    }
+    fill_hakai_flags = {col: "NA" for col in df.columns if is_hakai_flag_variable(col)}
+    fill_flags_level_1 = {col: 9 for col in df.columns if is_qartod_flag_variable(col)}
     logger.debug('Fill empty flag values: (*_flag: "NA", *_flag_level_1:9)')
     return df.fillna({**fill_hakai_flags, **fill_flags_level_1})
 
@@ -192,29 +248,52 @@ def get_hakai_data(path, query, credentials):
             style={"position": "fixed", "top": 66, "right": 10},
         )
 
-    def _get_data(url, fields=None):
-        url += "&limit=-1" if "limit" not in url else ""
-        url += "&fields=" + ",".join(fields) if fields else ""
-        try:
-            response = client.get(url, timeout=120)
-        except Exception as err:
-            return None, _make_toast_error(f"Failed to retrieve hakai data:\n{err}")
-        if response.status_code == 500:
-            parsed_response = json.loads(response.text)
+    def _make_download_error(error):
+        response = getattr(error, "response", None)
+        if response is None:
+            return f"Failed to retrieve hakai data:\n{error}"
+        elif response.status_code == 500:
+            try:
+                hint = json.loads(response.text).get("hint")
+            except ValueError:
+                hint = None
+            return f"Failed data query: {hint or response.text}"
+        logger.debug("Hakai Error= {} : {}", response.status_code, response.text)
+        return f"Failed to download data: {response}"
+
+    def _get_query_data(endpoint, query):
+        """Retrieve the endpoint query data and use the query cache if
+        the endpoint has a time variable to retrieve only the new records"""
+        errors = []
+
+        def _update_progress(completed, total):
+            name = endpoint["endpoint"]
+            logger.info("Downloaded {}/{} chunks from {}", completed, total, name)
+            download_progress.setdefault(progress_key, {})[name] = (completed, total)
+
+        result = download_hakai_data(
+            client,
+            endpoint["endpoint"],
+            query,
+            fields=endpoint.get("fields"),
+            dtypes=get_fields_dtypes(endpoint.get("fields")),
+            cache=query_cache if endpoint.get("time_variable") else None,
+            time_variable=endpoint.get("time_variable"),
+            chunk_freq=endpoint.get("chunk_freq"),
+            max_workers=DOWNLOAD_MAX_WORKERS,
+            progress=_update_progress,
+            on_error=lambda query, error: errors.append(error),
+        )
+        if result is None:
             return None, _make_toast_error(
-                f"Failed data query: {parsed_response.get('hint') or response.text}"
+                _make_download_error(errors[0]) if errors else "No data available"
             )
-        elif response.status_code != 200:
-            logger.debug("Hakai Error= {} : {}", response.status_code, response.text)
-            return None, _make_toast_error(f"Failed to download data: {response}")
-
-        result = response.json()
+        elif result.empty:
+            return None, _make_toast_error("No Data Retrieved")
         logger.info(
-            "Hakai {} records downloaded from {}", len(result), url.split("&fields")[0]
-        )
-        return (
-            (result, None) if result else (None, _make_toast_error("No Data Retrieved"))
+            "Hakai {} records downloaded from {}", len(result), endpoint["endpoint"]
         )
+        return result, None
 
     logger.debug("load data triggered by {}", ctx.triggered_id)
 
@@ -234,51 +313,61 @@ def get_hakai_data(path, query, credentials):
     endpoints = pages[path]
     main_endpoint = endpoints[0]
     client = Client(credentials=credentials)
+    share_connection_pool(client, DOWNLOAD_MAX_WORKERS)
+    progress_key = make_dataset_key(f"{path}{query}", credentials)
+    user, _ = _test_hakai_api_credentials(credentials)
+    query_cache = get_query_cache(user and user.get("id"))
     query = unquote(query)
     url = f"{client.api_root}/{main_endpoint['endpoint']}?{query[1:]}"
     logger.debug("run hakai query: {}", url)
-    result, toast_error = _get_data(url, main_endpoint.get("fields"))
-    if toast_error:
-        return (
-            None,
-            toast_error or _make_toast_error("No data available"),
-            [],
-        )
+
+    # Retrieve the main and auxiliary endpoints data concurrently
+    queries = [query[1:]] + [
+        rename_query_filters(query[1:], endpoint["query_mapping"])
+        for endpoint in endpoints[1:]
+    ]
+    logger.debug("Retrieve auxiliary data: {}", queries[1:])
+    with ThreadPoolExecutor(max_workers=len(endpoints)) as executor:
+        results = list(executor.map(_get_query_data, endpoints, queries))
+    download_progress.pop(progress_key, None)
+    for endpoint, (result, toast_error) in zip(endpoints, results):
+        if toast_error:
+            logger.debug("failed to get {} data", endpoint["endpoint"])
+            return (
+                None,
+                toast_error or _make_toast_error("No data available"),
+                [],
+            )
     logger.debug("data downloaded")
 
-    # Generate derived variables
+    # Generate derived variables, CTD ones are computed once requested
     logger.debug("Generate derived variables")
-    df = pd.DataFrame(result)
+    df = results[0][0]
+    lazy_columns = {}
     if path == "ctd":
-        df = ctd.get_derive_variables(df)
+        lazy_columns = {
+            variable: ctd.get_derive_variables for variable in ctd.derived_variables
+        }
     elif path == "nutrients":
         df = nutrients.get_derived_variables(df)
-    result = df.to_dict(orient="records")
+    df = set_flag_dtypes(df)
 
-    # Load auxiliary data
-    if path == "ctd":
-        flag_filters = re.findall("(station|start_dt)(=|<|>|>=|<=)([^&]*)", url)
-        flag_filters = [
-            "".join(item).replace("station", "site_id").replace("start_dt", "collected")
-            for item in flag_filters
-        ]
-        url_flags = (
-            f"{client.api_root}/"
-            f"{endpoints[1]['endpoint']}?"
-            f"{'&'.join(flag_filters)}"
-        )
-        logger.debug("Retrieve CTD flags: {}", url_flags)
-        result_flags, toast_error = _get_data(url_flags, endpoints[1].get("fields"))
-        if toast_error:
-            logger.debug("failed to get ctd flag data")
-            return (
-                None,
-                toast_error or _make_toast_error("No data available"),
-                None,
-            )
-        logger.debug("CTD flag downloaded")
-    else:
-        logger.debug("no auxiliary data retrieved")
-        result_flags = result
+    # Keep the dataset server side and only share its handle with the browser
+    dataset_key = dataset_cache.set(
+        make_dataset_key(url, credentials), df, lazy_columns=lazy_columns
+    )
+
+    # QC table source is the auxiliary flag data if available
+    qc_source = next(
+        (
+            result
+            for endpoint, (result, _) in zip(endpoints, results)
+            if endpoint.get("qc_source")
+        ),
+        df,
+    )
+    qc_source_key = dataset_cache.set(
+        make_dataset_key(f"{url}#qc-source", credentials), flags_to_labels(qc_source)
+    )
 
-    return result, None, result_flags
+    return dataset_key, None, qc_source_key
@@ -7,13 +7,28 @@ import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-from dash import ALL, MATCH, Input, Output, State, callback, dcc, html
+from dash import (
+    ALL,
+    MATCH,
+    Input,
+    Output,
+    Patch,
+    State,
+    callback,
+    ctx,
+    dcc,
+    html,
+    no_update,
+)
 from loguru import logger
 
-from hakai_qc.flags import flag_color_map, flag_mapping
+from hakai_qc.flags import flag_color_map, flag_mapping, is_hakai_flag_variable
 from hakai_qc.nutrients import variables_flag_mapping
+from hakai_qc.qc import update_dataframe
+from hakai_qc_app.cache import DatasetCache, dataset_cache, make_dataset_key
 from hakai_qc_app.download_hakai import fill_hakai_flag_variables
-from hakai_qc_app.utils import update_dataframe
+from hakai_qc_app.filters import QUERY_SUBSET, filter_data, get_filter_index
+from hakai_qc_app.qc_table import get_qc_table
 from hakai_qc_app.variables import VARIABLES_LABEL
 
 figure_presets_path = os.path.join(
@@ -25,6 +40,20 @@ with open(figure_presets_path) as file_handle:
 
 FIGURE_GROUPS = ["Timeseries Profiles", "Profile"]
 
+# Scatter and line figures with more points are decimated
+FIGURE_MAX_POINTS = int(os.getenv("FIGURE_MAX_POINTS", 50000))
+# Scatter and line figures with more points are rendered with WebGL
+WEBGL_THRESHOLD = figure_presets["settings"]["webgl_threshold"]
+# Maximum number of bins along each axis of the contour grids
+CONTOUR_MAX_BINS = figure_presets["settings"]["contour_max_bins"]
+# Flags of the points which can be dropped by the decimation
+DECIMATED_FLAGS = ["AV", "1", "NA", "9", ""]
+
+# Data and figure last displayed for each dataset, used to patch the figure
+figure_states = DatasetCache(max_entries=20)
+# Contour grids of the filtered datasets, reused when only the colors change
+contour_grids = DatasetCache(max_entries=20)
+
 figure_radio_buttons = html.Div(
     [
         dbc.Col(
@@ -262,23 +291,84 @@ def get_color_range(var, prc=[0.02, 0.98]):
     return np.floor(10 * min_limit) / 10, np.ceil(10 * max_limit) / 10
 
 
-def get_contour(
+def _get_grid_bins(values, bin_size, max_bins):
+    """Map values to the grid bins, the unique values if there's not too many
+    of them or a regular grid otherwise"""
+    unique = np.sort(pd.unique(values))
+    if bin_size is None and len(unique) <= max_bins:
+        return np.searchsorted(unique, values), unique
+    start, end = unique[0], unique[-1]
+    bin_size = max(bin_size or 0, (end - start) / max(max_bins - 1, 1)) or 1
+    index = ((values - start) // bin_size).astype(int)
+    return index, start + bin_size * np.arange(index.max() + 1)
+
+
+def get_contour_grid(
     df,
     x,
     y,
     color,
-    colorscale="RdYlGn",
-    range_color=None,
+    x_bin=None,
+    y_bin=None,
+    max_x_bins=CONTOUR_MAX_BINS["x"],
+    max_y_bins=CONTOUR_MAX_BINS["y"],
     x_interp_limit=3,
     y_interp_limit=4,
 ):
-    df_pivot = (
-        pd.pivot_table(df, values=color, index=y, columns=x, aggfunc="mean")
-        .interpolate(axis="index", limit=x_interp_limit)
-        .sort_index(axis=0)
-        .sort_index(axis=1)
-        .interpolate(axis="columns", limit=y_interp_limit)
+    """Average a variable on a x-y grid and interpolate the empty cells.
+
+    Each axis is binned on its unique values if there's less than
+    `max_x_bins`/`max_y_bins` of them or on a regular grid of `x_bin`/`y_bin`
+    spacing otherwise. Time axes spacing can be given as a timedelta string
+    (ex: "7D"). Empty cells are linearly interpolated over up to
+    `x_interp_limit` cells along the y axis and then `y_interp_limit` cells
+    along the x axis.
+
+    Returns a dataframe with y as index and x as columns.
+    """
+    is_time = pd.api.types.is_datetime64_any_dtype(df[x])
+    if is_time and x_bin is not None:
+        x_bin = pd.Timedelta(x_bin).value
+    x_values, y_values, values = (_to_float(df[var]) for var in (x, y, color))
+    is_valid = ~(np.isnan(x_values) | np.isnan(y_values) | np.isnan(values))
+    if not is_valid.any():
+        return pd.DataFrame()
+    x_index, x_grid = _get_grid_bins(x_values[is_valid], x_bin, max_x_bins)
+    y_index, y_grid = _get_grid_bins(y_values[is_valid], y_bin, max_y_bins)
+
+    # Mean of the values within each grid cell
+    cells = y_index * len(x_grid) + x_index
+    size = len(x_grid) * len(y_grid)
+    counts = np.bincount(cells, minlength=size)
+    sums = np.bincount(cells, weights=values[is_valid], minlength=size)
+    with np.errstate(invalid="ignore"):
+        means = sums / counts
+    grid = pd.DataFrame(
+        means.reshape(len(y_grid), len(x_grid)),
+        index=y_grid,
+        columns=pd.to_datetime(x_grid.astype("int64")) if is_time else x_grid,
+    )
+    logger.debug("Generated contour grid of {} cells", size)
+    return grid.interpolate(axis="index", limit=x_interp_limit).interpolate(
+        axis="columns", limit=y_interp_limit
     )
+
+
+def get_contour(
+    df,
+    x,
+    y,
+    color,
+    colorscale="RdYlGn",
+    range_color=None,
+    cache_key=None,
+    **grid_kwargs,
+):
+    grid = contour_grids.get(cache_key)
+    if grid is None:
+        grid = get_contour_grid(df, x, y, color, **grid_kwargs)
+        if cache_key:
+            contour_grids.set(cache_key, grid)
     min_color, max_color = get_color_range(df[color])
     if range_color:
         min_color = range_color[0] or min_color
@@ -286,10 +376,10 @@ def get_contour(
 
     fig = go.Figure(
         data=go.Contour(
-            z=df_pivot.values,
-            x=df_pivot.columns,
-            y=df_pivot.index.values,
-            colorbar=dict(title=color, titleside="right"),
+            z=grid.values,
+            x=grid.columns,
+            y=grid.index.values,
+            colorbar=dict(title=dict(text=color, side="right")),
             colorscale=colorscale,
             contours=dict(
                 start=min_color,
@@ -314,6 +404,109 @@ def get_contour(
     return fig
 
 
+def _to_float(values):
+    if pd.api.types.is_datetime64_any_dtype(values):
+        values = values.dt.tz_localize(None)
+        return np.where(values.isna(), np.nan, values.to_numpy().view("int64"))
+    return values.to_numpy(dtype=float, na_value=np.nan)
+
+
+def get_decimation_mask(df, x, y, max_points, groupby=None, keep=None):
+    """Select about max_points rows of df by keeping the rows with the min and
+    max y values within regular bins of x for each trace.
+
+    Args:
+        df (pd.DataFrame): Figure data
+        x (str): Variable binned
+        y (str): Variable for which the extremes are kept in each bin
+        max_points (int): Points budget
+        groupby (list, optional): Variables defining each trace
+        keep (np.ndarray, optional): Mask of the rows always kept
+
+    Returns:
+        np.ndarray: Mask of the rows kept
+    """
+    keep = np.zeros(len(df), dtype=bool) if keep is None else np.asarray(keep, bool)
+    if len(df) <= max_points:
+        return np.ones(len(df), dtype=bool)
+    if not all(
+        pd.api.types.is_numeric_dtype(df[var])
+        or pd.api.types.is_datetime64_any_dtype(df[var])
+        for var in (x, y)
+    ):
+        logger.debug("Can't decimate non numeric {} and {}", x, y)
+        return np.ones(len(df), dtype=bool)
+
+    groups = (
+        df.groupby(groupby, sort=False, dropna=False).ngroup().to_numpy()
+        if groupby
+        else np.zeros(len(df), dtype=int)
+    )
+    x_values, y_values = _to_float(df[x]), _to_float(df[y])
+    rows = np.flatnonzero(~np.isnan(x_values) & ~np.isnan(y_values))
+    if rows.size == 0:
+        return keep
+    x_values, y_values, groups = x_values[rows], y_values[rows], groups[rows]
+
+    n_bins = max((max_points - keep.sum()) // (2 * (groups.max() + 1)), 1)
+    x_min, x_max = x_values.min(), x_values.max()
+    bins = ((x_values - x_min) / ((x_max - x_min) or 1) * n_bins).astype(int)
+    key = groups * (n_bins + 1) + bins
+
+    # Sort by bin and y and keep each bin first and last rows
+    order = np.lexsort((y_values, key))
+    new_bin = np.diff(key[order]) != 0
+    extremes = order[np.concatenate([[True], new_bin]) | np.append(new_bin, True)]
+    mask = keep.copy()
+    mask[rows[extremes]] = True
+    return mask
+
+
+def _get_axis_range(relayout, axis):
+    """Retrieve the zoomed range of an axis from the figure relayoutData"""
+    if not relayout:
+        return None
+    axis_range = relayout.get(f"{axis}.range") or [
+        relayout.get(f"{axis}.range[0]"),
+        relayout.get(f"{axis}.range[1]"),
+    ]
+    if None in axis_range:
+        return None
+    return sorted(axis_range)
+
+
+def _is_same_trace(trace, other):
+    return all(
+        np.array_equal(np.asarray(trace[item]), np.asarray(other[item]))
+        for item in ("x", "y", "customdata")
+    )
+
+
+def _has_hidden_flagged_values(qc_flags, hidden_hakai_ids, flag_columns):
+    """Check if values dropped by the figure decimation were flagged on the
+    flag columns displayed by the figure"""
+    flag_columns = [col for col in flag_columns if col in qc_flags]
+    flags = qc_flags.loc[qc_flags["hakai_id"].isin(hidden_hakai_ids), flag_columns]
+    return (flags.notna() & ~flags.astype(str).isin(DECIMATED_FLAGS)).any(axis=None)
+
+
+def get_figure_patch(figure, new_figure):
+    """Generate a Patch replacing only the traces which differ between two
+    figures. Returns None if the figures don't have the same traces."""
+    if [trace.name for trace in figure.data] != [
+        trace.name for trace in new_figure.data
+    ]:
+        return None
+    patch = Patch()
+    n_updated_traces = 0
+    for index, (trace, new_trace) in enumerate(zip(figure.data, new_figure.data)):
+        if not _is_same_trace(trace, new_trace):
+            patch["data"][index] = new_trace.to_plotly_json()
+            n_updated_traces += 1
+    logger.debug("Patch {} traces", n_updated_traces)
+    return patch if n_updated_traces else no_update
+
+
 def get_flag_var(var, variables):
     if var is None:
         return
@@ -329,7 +522,7 @@ def get_flag_var(var, variables):
     Output("main-graph-spinner", "data"),
     State("location", "pathname"),
     State("dataframe", "data"),
-    Input("qc-table", "data"),
+    Input("qc-table-state", "data"),
     Input({"type": "dataframe-subset", "subset": ALL}, "placeholder"),
     Input({"type": "dataframe-subset", "subset": ALL}, "value"),
     Input("time-filter-range-picker", "start_date"),
@@ -345,19 +538,22 @@ def get_flag_var(var, variables):
     },
     Input("update-figure", "n_clicks"),
     Input("figure-menu-label-spinner", "data"),
+    Input({"type": "graph", "page": "main"}, "relayoutData"),
 )
 def generate_figure(
     location,
     data,
-    selected_data,
+    qc_table_state,
     subset_vars,
     subsets,
     time_min,
     time_max,
     form_inputs,
-    *args,
+    n_clicks,
+    label_spinner,
+    relayout,
 ):
-    def _add_extra_traces(extra_traces):
+    def _add_extra_traces(fig, extra_traces):
         if extra_traces is None:
             return
         for go_object, trace in (
@@ -366,19 +562,134 @@ def generate_figure(
             if go_object == "Scatter":
                 fig.add_trace(go.Scatter(**trace))
 
-    def _convert_variable_to_str(df):
+    def _convert_variable_to_str(df, px_kwargs):
+        # Keep the flag traces in the same order to be able to patch them
+        flags_order = list(dict.fromkeys(str(flag) for flag in flag_color_map))
         if "flag" in px_kwargs.get("color", ""):
             logger.debug("assign color map for object")
             df[px_kwargs["color"]] = df[px_kwargs["color"]].astype(str)
             px_kwargs["color_discrete_map"] = flag_color_map
+            category_orders = px_kwargs.setdefault("category_orders", {})
+            category_orders[px_kwargs["color"]] = flags_order
         if "flag" in px_kwargs.get("symbol", ""):
             df[px_kwargs["symbol"]] = df[px_kwargs["symbol"]].astype(str)
+            category_orders = px_kwargs.setdefault("category_orders", {})
+            category_orders[px_kwargs["symbol"]] = flags_order
         return df
 
+    def _decimate(df, bin_var, value_var, zoom=None):
+        traces = [
+            px_kwargs[item]
+            for item in ("color", "symbol", "line_group", "facet_col", "facet_row")
+            if px_kwargs.get(item) in df
+            and not pd.api.types.is_float_dtype(df[px_kwargs[item]])
+        ]
+        keep = np.zeros(len(df), dtype=bool)
+        for flag_var in {px_kwargs.get(item) for item in ("color", "symbol")}:
+            if flag_var and "flag" in flag_var and flag_var in df:
+                keep |= ~df[flag_var].astype(str).isin(DECIMATED_FLAGS).to_numpy()
+
+        # Zoomed area is decimated separately from the rest of the figure
+        mask = np.zeros(len(df), dtype=bool)
+        in_zoom = np.zeros(len(df), dtype=bool)
+        if zoom:
+            if pd.api.types.is_datetime64_any_dtype(df[bin_var]):
+                zoom = pd.to_datetime(zoom, format="ISO8601").tz_localize(
+                    df[bin_var].dt.tz
+                )
+            in_zoom = df[bin_var].between(*zoom).to_numpy()
+        for part in (in_zoom, ~in_zoom):
+            mask[part] = get_decimation_mask(
+                df.loc[part],
+                bin_var,
+                value_var,
+                FIGURE_MAX_POINTS,
+                groupby=traces,
+                keep=keep[part],
+            )
+        logger.debug("Decimated figure data from {} to {}", len(df), mask.sum())
+        return df.loc[mask]
+
+    def _build_figure(df, px_kwargs):
+        if plot_type == "scatter":
+            px_kwargs["labels"] = VARIABLES_LABEL
+            df = _convert_variable_to_str(df, px_kwargs)
+            px_kwargs.setdefault("render_mode", render_mode)
+            logger.debug("Generate scatter: {}", str(px_kwargs))
+            fig = px.scatter(df, **px_kwargs)
+        elif plot_type == "contour":
+            px_kwargs.pop("hover_data", None)
+            px_kwargs["colorscale"] = px_kwargs.pop("color_continuous_scale", None)
+            grid_inputs = {
+                key: value
+                for key, value in px_kwargs.items()
+                if key not in ("colorscale", "range_color")
+            }
+            px_kwargs["cache_key"] = make_dataset_key(
+                json.dumps(
+                    [subset_vars, subsets, time_min, time_max, grid_inputs],
+                    sort_keys=True,
+                    default=str,
+                ),
+                data,
+            )
+            logger.debug("Generate contour: {}", px_kwargs)
+            fig = get_contour(df, **px_kwargs)
+        elif plot_type == "scatter_mapbox":
+            fig = px.scatter_mapbox(
+                df,
+                lat=px_kwargs.pop("y"),
+                lon=px_kwargs.pop("x"),
+                **px_kwargs,
+                size_max=15,
+                zoom=10,
+                height=600,
+            )
+            fig.update_layout(mapbox_style="open-street-map")
+        elif plot_type == "line":
+            df = _convert_variable_to_str(df, px_kwargs)
+            px_kwargs.setdefault("render_mode", render_mode)
+            fig = px.line(df, **px_kwargs, markers=True)
+            # Show flagged values as dots
+            if "flag" in px_kwargs.get("color", ""):
+                for trace in fig.data:
+                    if trace["name"] not in ("1", "AV"):
+                        trace["mode"] = "markers"
+        else:
+            logger.error("unknown plot_type={}", plot_type)
+            return None
+
+        _add_extra_traces(fig, inputs["extra_traces"] or "[]")
+
+        fig.for_each_trace(lambda t: t.update(name=VARIABLES_LABEL.get(t.name, t.name)))
+        fig.update_layout(
+            height=600,
+        )
+        if re.search("profile", label, re.IGNORECASE) or reverse_y_axis:
+            fig.update_yaxes(autorange="reversed")
+        fig.update_layout(
+            modebar=dict(color="#B52026"),
+            dragmode="select",
+            uirevision=f"{label}:{inputs['x']}:{inputs['y']}",
+        )
+        return fig
+
+    # Only regenerate the figure on zoom if it was decimated
+    zoomed = ctx.triggered_id == {"type": "graph", "page": "main"}
+    if zoomed and not any("range" in key for key in (relayout or {})):
+        return no_update, no_update
+
     # transform data for plotting
     if data is None or not any(form_inputs.get("default")):
         logger.debug("do not generate plot yet")
         return None, None
+    figure_signature = make_dataset_key(
+        json.dumps(
+            [location, subset_vars, subsets, time_min, time_max, form_inputs],
+            default=str,
+        ),
+        data,
+    )
 
     # Parse figure-menu inputs
     px_kwargs_inputs = [
@@ -426,29 +737,77 @@ def generate_figure(
     logger.debug("px_kwarkgs= {}", px_kwargs)
     # Get Data and filter by given subset
     logger.info("Generating figure for subsets={}", list(zip(subset_vars, subsets)))
-    df = pd.DataFrame(data)
-    filter_subsets = [
-        f"{subset_var} in {subset}" if subset_var != "Filter data ..." else subset
-        for subset_var, subset in zip(subset_vars, subsets)
-        if subset
+    query = dict(zip(subset_vars, subsets)).get(QUERY_SUBSET) or ""
+
+    # Flag changes only update the traces of the figure displayed
+    figure_state = figure_states.get(f"{data}{location}")
+    if (
+        ctx.triggered_id == "qc-table-state"
+        and figure_state
+        and figure_state["signature"] == figure_signature
+        and plot_type in ("scatter", "line")
+    ):
+        # CTD figures don't display the qc table flags
+        if location.startswith("/ctd"):
+            return no_update, no_update
+        qc_flags = get_qc_table(qc_table_state)
+        qc_flags = pd.DataFrame() if qc_flags is None else qc_flags
+        flag_columns = [col for col in qc_flags if is_hakai_flag_variable(col)]
+        qc_flags = qc_flags.filter(["hakai_id", *flag_columns])
+        plotted_flags = [
+            px_kwargs[item]
+            for item in ("color", "symbol")
+            if px_kwargs.get(item) and "flag" in px_kwargs[item]
+        ]
+        original_flags = dataset_cache.get(data, columns=["hakai_id"])
+        if (
+            "hakai_id" in qc_flags
+            and original_flags is not None
+            and not _has_hidden_flagged_values(
+                qc_flags, figure_state["hidden_hakai_ids"], plotted_flags
+            )
+        ):
+            logger.debug("Update figure flags from qc table")
+            # Restart from the dataset flags to also reset the emptied ones
+            original_flags = original_flags.filter(["hakai_id", *flag_columns])
+            df = figure_state["data"].drop(columns=flag_columns, errors="ignore")
+            df = update_dataframe(df, original_flags, on="hakai_id", how="left")
+            df = fill_hakai_flag_variables(
+                update_dataframe(df, qc_flags, on="hakai_id", how="left")
+            )
+            reverse_y_axis = px_kwargs.get("y") in ("depth", "pressure")
+            render_mode = figure_state["render_mode"]
+            fig = _build_figure(df, dict(px_kwargs))
+            patch = get_figure_patch(figure_state["figure"], fig)
+            if patch is not None:
+                figure_state.update(data=df, figure=fig)
+                return patch, no_update
+
+    # Retrieve the dataset with the lazy columns used by the figure or filters
+    columns = [
+        *[px_kwargs.get(item) for item in ("x", "y", "color", "symbol")],
+        *[px_kwargs.get(item) for item in ("facet_col", "facet_row")],
+        *(px_kwargs.get("hover_data") or []),
+        *re.findall(r"\w+", query),
     ]
+    df = dataset_cache.get(data, columns=[col for col in columns if col])
+    if df is None:
+        logger.warning("Dataset {} is not available anymore", data)
+        return None, None
 
-    # Filter figure by time
-    if time_min and time_max:
-        time_var = [var for var in ["collected", "start_dt"] if var in df]
-        if not time_var:
-            raise RuntimeError("No time variable available")
-        filter_subsets += [f"'{time_min}' < {time_var[0]} < '{time_max}'"]
-
-    if filter_subsets:
-        logger.debug("filter data with: {}", filter_subsets)
-        df = df.query(" and ".join(filter_subsets))
+    df = filter_data(
+        df,
+        get_filter_index(data, location),
+        subset_vars,
+        subsets,
+        time_min,
+        time_max,
+    )
 
     # apply manual selection flags
-    if selected_data and not location.startswith("/ctd"):
-        df = update_dataframe(
-            df, pd.DataFrame(selected_data), on="hakai_id", how="left"
-        )
+    qc_table = get_qc_table(qc_table_state)
+    if qc_table is not None and not location.startswith("/ctd"):
+        df = update_dataframe(df, qc_table, on="hakai_id", how="left")
 
     # tranform data
     df = fill_hakai_flag_variables(df)
@@ -465,50 +824,36 @@ def generate_figure(
     df = df.sort_values([var for var in sort_by if var in df])
 
     reverse_y_axis = px_kwargs.get("y") in ("depth", "pressure")
+    render_mode = "webgl" if len(df) > WEBGL_THRESHOLD else "svg"
+
+    # Decimate large figures along their time or depth axis
+    hidden_hakai_ids = pd.Index([])
+    if plot_type in ("scatter", "line") and len(df) > FIGURE_MAX_POINTS:
+        bin_axis, value_axis = ("y", "x") if reverse_y_axis else ("x", "y")
+        zoom = zoomed and _get_axis_range(relayout, f"{bin_axis}axis")
+        decimated = _decimate(df, px_kwargs[bin_axis], px_kwargs[value_axis], zoom)
+        if "hakai_id" in df:
+            hidden_hakai_ids = pd.Index(df["hakai_id"]).difference(
+                decimated["hakai_id"]
+            )
+        df = decimated
+    elif zoomed:
+        return no_update, no_update
 
     # Generate plot
-    if plot_type == "scatter":
-        px_kwargs["labels"] = VARIABLES_LABEL
-        df = _convert_variable_to_str(df)
-        logger.debug("Generate scatter: {}", str(px_kwargs))
-        fig = px.scatter(df, **px_kwargs)
-    elif plot_type == "contour":
-        px_kwargs.pop("hover_data", None)
-        px_kwargs["colorscale"] = px_kwargs.pop("color_continuous_scale", None)
-        logger.debug("Generate contour: {}", px_kwargs)
-        fig = get_contour(df, **px_kwargs)
-    elif plot_type == "scatter_mapbox":
-        fig = px.scatter_mapbox(
-            df,
-            lat=px_kwargs.pop("y"),
-            lon=px_kwargs.pop("x"),
-            **px_kwargs,
-            size_max=15,
-            zoom=10,
-            height=600,
-        )
-        fig.update_layout(mapbox_style="open-street-map")
-    elif plot_type == "line":
-        df = _convert_variable_to_str(df)
-        fig = px.line(df, **px_kwargs, markers=True)
-        # Show flagged values as dots
-        if "flag" in px_kwargs.get("color", ""):
-            for trace in fig.data:
-                if trace["name"] not in ("1", "AV"):
-                    trace["mode"] = "markers"
-    else:
-        logger.error("unknown plot_type={}", plot_type)
+    fig = _build_figure(df, dict(px_kwargs))
+    if fig is None:
         return None, None
-
-    _add_extra_traces(inputs["extra_traces"] or "[]")
-
-    fig.for_each_trace(lambda t: t.update(name=VARIABLES_LABEL.get(t.name, t.name)))
-    fig.update_layout(
-        height=600,
+    figure_states.set(
+        f"{data}{location}",
+        {
+            "signature": figure_signature,
+            "data": df,
+            "figure": fig,
+            "render_mode": render_mode,
+            "hidden_hakai_ids": hidden_hakai_ids,
+        },
     )
-    if re.search("profile", label, re.IGNORECASE) or reverse_y_axis:
-        fig.update_yaxes(autorange="reversed")
-    fig.update_layout(modebar=dict(color="#B52026"), dragmode="select")
     logger.debug("output figure: {}", fig)
     return fig, None
 
@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+
+from hakai_qc_app.cache import dataset_cache
+
+SUBSET_VARIABLES = {
+    "nutrients": ["site_id", "line_out_depth"],
+    "ctd": ["station", "direction_flag"],
+}
+TIME_VARIABLES = {"nutrients": "collected", "ctd": "start_dt"}
+# Placeholder of the free query subset
+QUERY_SUBSET = "Filter data ..."
+
+
+def _to_datetime64(time):
+    """Convert a time to a naive UTC datetime64"""
+    time = pd.Timestamp(time)
+    if time.tz is not None:
+        time = time.tz_convert("UTC").tz_localize(None)
+    return time.to_datetime64()
+
+
+class FilterIndex:
+    """Index of the subset and time variables of a dataset.
+
+    Subset variables are factorized to integer codes and the time variable is
+    sorted once, so that the filters are resolved to a boolean mask without
+    evaluating a query on the whole dataset.
+    """
+
+    def __init__(self, df, subset_variables, time_variable):
+        self.n_rows = len(df)
+        self.subsets = {
+            variable: pd.factorize(df[variable], sort=True)
+            for variable in subset_variables
+        }
+        time = (
+            pd.to_datetime(df[time_variable], utc=True, format="ISO8601")
+            .dt.tz_localize(None)
+            .to_numpy()
+        )
+        is_valid = np.flatnonzero(~np.isnat(time))
+        self.time_order = is_valid[np.argsort(time[is_valid], kind="stable")]
+        self.sorted_time = time[self.time_order]
+
+    def get_options(self, variable):
+        """List the sorted unique values of a subset variable"""
+        return self.subsets[variable][1].tolist()
+
+    def get_time_range(self):
+        if len(self.sorted_time) == 0:
+            return None, None
+        return pd.Timestamp(self.sorted_time[0]), pd.Timestamp(self.sorted_time[-1])
+
+    def get_mask(self, subsets=None, time_min=None, time_max=None):
+        """Get the mask of the rows matching the subsets values and within the
+        time range [time_min, time_max), or None if there's no filter"""
+        mask = None
+        for variable, values in (subsets or {}).items():
+            if not values:
+                continue
+            codes, uniques = self.subsets[variable]
+            selected_codes = uniques.get_indexer(values)
+            # Missing values are coded -1 and mapped to the last item
+            is_selected = np.zeros(len(uniques) + 1, dtype=bool)
+            is_selected[selected_codes[selected_codes >= 0]] = True
+            mask = is_selected[codes] if mask is None else mask & is_selected[codes]
+
+        if time_min and time_max:
+            start = np.searchsorted(self.sorted_time, _to_datetime64(time_min))
+            end = np.searchsorted(self.sorted_time, _to_datetime64(time_max))
+            in_range = np.zeros(self.n_rows, dtype=bool)
+            in_range[self.time_order[start:end]] = True
+            mask = in_range if mask is None else mask & in_range
+        return mask
+
+
+def get_filter_index(data, location):
+    """Get the filter index of a cached dataset"""
+    data_type = location.split("/")[1]
+    return dataset_cache.get_index(
+        data,
+        "filter",
+        lambda df: FilterIndex(
+            df, SUBSET_VARIABLES[data_type], TIME_VARIABLES[data_type]
+        ),
+    )
+
+
+def filter_data(df, index, subset_vars, subsets, time_min=None, time_max=None):
+    """Filter a cached dataset with the subset dropdowns and time range.
+
+    The dropdowns and time range are resolved with the dataset filter index,
+    the free query is then evaluated on the remaining rows.
+    """
+    subsets = dict(zip(subset_vars, subsets))
+    query = subsets.pop(QUERY_SUBSET, None)
+    mask = index.get_mask(subsets, time_min, time_max)
+    if mask is not None:
+        df = df[mask]
+    if query:
+        df = df.query(query)
+    return df
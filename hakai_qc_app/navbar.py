@@ -1,9 +1,11 @@
 import dash_bootstrap_components as dbc
 import pandas as pd
-from dash import Input, Output, State, callback, ctx, dcc, html
+from dash import ALL, Input, Output, State, callback, ctx, dcc, html
 from loguru import logger
 
 from hakai_qc.nutrients import get_nutrient_statistics
+from hakai_qc_app.cache import dataset_cache
+from hakai_qc_app.filters import SUBSET_VARIABLES, filter_data, get_filter_index
 from hakai_qc_app.variables import PRIMARY_VARIABLES, VARIABLES_LABEL
 
 stores = dbc.Col(
@@ -13,6 +15,7 @@ stores = dbc.Col(
             dcc.Store(id="dataframe-variables"),
             dcc.Store(id="qc-update-data"),
             dcc.Store(id="qc-source-data"),
+            dcc.Store(id="qc-table-state"),
             dcc.Store(id="main-graph-spinner"),
             dcc.Store(id="auto-qc-nutrient-spinner"),
             dcc.Store(id="figure-menu-label-spinner"),
@@ -145,12 +148,24 @@ data_filter_interface = dbc.Collapse(
     Input("stats-button", "n_clicks"),
     State("location", "pathname"),
     State("dataframe", "data"),
+    State({"type": "dataframe-subset", "subset": ALL}, "placeholder"),
+    State({"type": "dataframe-subset", "subset": ALL}, "value"),
+    State("time-filter-range-picker", "start_date"),
+    State("time-filter-range-picker", "end_date"),
 )
-def open_stats_modal(n_clicks, location, data):  # Generate stats
+def open_stats_modal(
+    n_clicks, location, data, subset_vars, subsets, time_min, time_max
+):  # Generate stats
     if n_clicks is None:
         return False, []
 
-    df = pd.DataFrame(data)
+    df = dataset_cache.get(data)
+    if df is None:
+        logger.warning("Dataset {} is not available anymore", data)
+        return True, "Dataset is not available anymore, please reload the page."
+    df = filter_data(
+        df, get_filter_index(data, location), subset_vars, subsets, time_min, time_max
+    )
     content = None
     if "nutrients" in location:
         stats_items = get_nutrient_statistics(df)
@@ -311,29 +326,19 @@ def generate_filter_pannel(data, path):
     """Parse downloaded data and generate the different subsets and time
     filters
     """
-    if data is None:
+    df = dataset_cache.get(data)
+    if df is None:
         return [], [], None, None
 
-    logger.debug("Load data as dataframe to build filter")
-    df = pd.DataFrame(data)
-    path = path.split("/")[1]
-    if path == "nutrients":
-        subset_variables = ["site_id", "line_out_depth"]
-        time_variable = "collected"
-    elif path == "ctd":
-        subset_variables = ["station", "direction_flag"]
-        time_variable = "start_dt"
-    else:
+    logger.debug("Build filter from cached dataset {}", data)
+    if path.split("/")[1] not in SUBSET_VARIABLES:
         raise RuntimeError("Unknown data type to generate filter")
-
-    # Get time interval
-    time = pd.to_datetime(df[time_variable])
-    time_min = time.min()
-    time_max = time.max()
+    index = get_filter_index(data, path)
+    time_min, time_max = index.get_time_range()
 
     # Retrieve subsets and generate dropdowns
     logger.debug("Retrieve subsets variables")
-    subsets = {var: df[var].unique() for var in subset_variables}
+    subsets = {var: index.get_options(var) for var in index.subsets}
     subset_interface = [
         dbc.Row(
             [
@@ -351,10 +356,10 @@ def generate_filter_pannel(data, path):
         ),
     ]
     return (
-        ",".join(df.columns),
+        ",".join(dataset_cache.get_columns(data)),
         subset_interface,
-        time_min.to_pydatetime(),
-        time_max.to_pydatetime(),
+        time_min and time_min.to_pydatetime(),
+        time_max and time_max.to_pydatetime(),
     )
 
 
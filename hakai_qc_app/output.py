@@ -1,18 +1,42 @@
-
-from pathlib import Path
-from loguru import logger
-from datetime import datetime
+import os
 import shutil
-import pandas as pd
+from datetime import datetime
+from pathlib import Path
 
+import numpy as np
+import pandas as pd
+from loguru import logger
 
 from hakai_qc_app.variables import pages
 
 MODULE_PATH = Path(__file__).parent
+# Maximum number of rows uploaded to the Hakai Portal in a single excel file
+UPLOAD_MAX_ROWS = int(os.getenv("HAKAI_UPLOAD_MAX_ROWS", 5000))
+
+
+def split_upload_batches(df: pd.DataFrame, max_rows: int = UPLOAD_MAX_ROWS):
+    """Split the rows to upload in batches of at most `max_rows` rows.
 
-def generate_excel_output(df:pd.DataFrame, data_type:str, temp_dir:str="temp", file_name:str=None):
+    The rows of a sample are kept in the same batch, a sample with more than
+    `max_rows` rows is uploaded in its own batch.
+    """
+    if df.empty:
+        return []
+    codes, samples = pd.factorize(df["hakai_id"])
+    sample_batches = np.empty(len(samples), dtype=int)
+    batch, n_rows = 0, 0
+    for sample, count in enumerate(np.bincount(codes)):
+        if n_rows and n_rows + count > max_rows:
+            batch, n_rows = batch + 1, 0
+        sample_batches[sample] = batch
+        n_rows += count
+    batches = sample_batches[codes]
+    return [df[batches == index] for index in range(batch + 1)]
 
 
+def generate_excel_output(
+    df: pd.DataFrame, data_type: str, temp_dir: str = "temp", file_name: str = None
+):
     logger.info("Retrieve excel file template for {}", data_type)
     excel_template = MODULE_PATH / f"assets/hakai-template-{data_type}-samples.xlsx"
 
@@ -24,9 +48,9 @@ def generate_excel_output(df:pd.DataFrame, data_type:str, temp_dir:str="temp", f
 
     temp_dir = Path(temp_dir)
     temp_dir.mkdir(parents=True, exist_ok=True)
-    temp_file = (
-        temp_dir
-        / (file_name or f"hakai-qc-{data_type}-{datetime.now().strftime('%Y-%m-%dT%H:%M:%S')}.xlsx")
+    temp_file = temp_dir / (
+        file_name
+        or f"hakai-qc-{data_type}-{datetime.now().strftime('%Y-%m-%dT%H:%M:%S')}.xlsx"
     )
 
     logger.info("Copy {} template/update excel file to: {}", data_type, temp_file)
@@ -39,4 +63,4 @@ def generate_excel_output(df:pd.DataFrame, data_type:str, temp_dir:str="temp", f
         temp_file, engine="openpyxl", mode="a", if_sheet_exists="replace"
     ) as writer:
         df.to_excel(writer, sheet_name="Hakai Data", index=False)
-    return temp_file
\ No newline at end of file
+    return temp_file
@@ -0,0 +1,383 @@
+import math
+import operator
+import os
+import re
+import time
+import uuid
+from collections import deque
+
+import numpy as np
+import pandas as pd
+from dash import Input, Output, Patch, callback, ctx, no_update
+from loguru import logger
+
+from hakai_qc_app.cache import DatasetCache
+
+# Full QC tables kept server side, the qc-table only receives the page displayed.
+# Tables with unsaved edits are only dropped once abandoned for QC_TABLE_UNSAVED_TTL.
+qc_tables = DatasetCache(
+    max_entries=int(os.getenv("QC_TABLE_CACHE_MAX_ENTRIES", 40)),
+    ttl=float(os.getenv("DATASET_CACHE_TTL", 3600 * 6)),
+    is_evictable=lambda table: not table.modified,
+    pinned_ttl=float(os.getenv("QC_TABLE_UNSAVED_TTL", 3600 * 24 * 3)),
+)
+# Number of changesets applied to a QC table which can be undone
+QC_TABLE_MAX_UNDO = int(os.getenv("QC_TABLE_MAX_UNDO", 20))
+EDITABLE_COLUMNS = ("comments", "quality_level", "row_flag", "quality_log")
+
+FILTER_OPERATORS = {
+    "=": operator.eq,
+    "eq": operator.eq,
+    "!=": operator.ne,
+    "ne": operator.ne,
+    "<": operator.lt,
+    "lt": operator.lt,
+    "<=": operator.le,
+    "le": operator.le,
+    ">": operator.gt,
+    "gt": operator.gt,
+    ">=": operator.ge,
+    "ge": operator.ge,
+}
+TEXT_FILTER_OPERATORS = ("contains", "datestartswith")
+filter_part_pattern = re.compile(
+    r"\{(?P<column>[^}]+)\}\s+(?P<operator>\S+)\s*(?P<value>.*)"
+)
+
+
+def is_editable_column(column):
+    return column.endswith("_flag") or column in EDITABLE_COLUMNS
+
+
+def _is_same_value(value, new_value):
+    return value == new_value or (pd.isna(value) and pd.isna(new_value))
+
+
+class QCTable:
+    """QC table of a dataset with its original flags.
+
+    Changes are given as changesets ({hakai_id: {column: value}}). The
+    edited cells which differ from the original flags are kept in a journal
+    ({hakai_id: {column: (original, new)}}) giving the modified samples
+    without comparing the whole table. The last `max_undo` changesets
+    applied can be undone and redone.
+    """
+
+    def __init__(self, original, max_undo=QC_TABLE_MAX_UNDO):
+        self.original = original
+        self.data = original.astype(
+            {col: object for col in original if is_editable_column(col)}
+        ).assign(modified="False")
+        self.journal = {}
+        self.last_changes = None
+        self.version = time.time_ns()
+        self._rows = self.data.groupby("hakai_id", sort=False).indices
+        self._undo = deque(maxlen=max_undo)
+        self._redo = deque(maxlen=max_undo)
+
+    @property
+    def nbytes(self):
+        return int(
+            self.data.memory_usage(index=True).sum()
+            + self.original.memory_usage(index=True).sum()
+        )
+
+    @property
+    def modified(self):
+        """Modified samples hakai_ids"""
+        return self.journal.keys()
+
+    @property
+    def can_undo(self):
+        return bool(self._undo)
+
+    @property
+    def can_redo(self):
+        return bool(self._redo)
+
+    def is_modified(self, hakai_id):
+        return hakai_id in self.journal
+
+    def get_rows(self, hakai_ids):
+        """Get the rows position of the given samples"""
+        rows = [self._rows[hakai_id] for hakai_id in hakai_ids]
+        return np.concatenate(rows) if rows else np.array([], dtype=int)
+
+    def get_modified_data(self):
+        """Get the rows of the modified samples"""
+        return self.data.iloc[np.sort(self.get_rows(self.journal))]
+
+    def reset_changes(self):
+        """Mark the whole table as changed"""
+        self.last_changes = None
+        self.version = time.time_ns()
+
+    def get_page_changes(self, page_data):
+        """Get the changeset of the cells edited on a qc-table page"""
+        changes = {}
+        for record in page_data:
+            rows = self._rows.get(record["hakai_id"])
+            if rows is None:
+                continue
+            row = self.data.iloc[rows[0]]
+            row_changes = {
+                col: value
+                for col, value in record.items()
+                if is_editable_column(col)
+                and col in row
+                and not _is_same_value(row[col], value)
+            }
+            if row_changes:
+                changes[record["hakai_id"]] = row_changes
+        return changes
+
+    def _apply(self, changes):
+        """Apply a changeset and return the changeset reverting it"""
+        columns = {}
+        for hakai_id, row in changes.items():
+            for col, value in row.items():
+                columns.setdefault(col, {})[hakai_id] = value
+
+        previous = {}
+        for col, values in columns.items():
+            if col not in self.data:
+                self.data.insert(len(self.data.columns) - 1, col, None)
+            col_index = self.data.columns.get_loc(col)
+            first_rows = [self._rows[hakai_id][0] for hakai_id in values]
+            counts = [len(self._rows[hakai_id]) for hakai_id in values]
+            previous_values = self.data.iloc[first_rows, col_index].tolist()
+            original_values = (
+                self.original[col].iloc[first_rows].tolist()
+                if col in self.original
+                else [None] * len(values)
+            )
+            self.data.iloc[self.get_rows(values), col_index] = np.repeat(
+                np.array(list(values.values()), dtype=object), counts
+            )
+
+            # Record the cells which differ from the original flags
+            for hakai_id, value, previous_value, original_value in zip(
+                values, values.values(), previous_values, original_values
+            ):
+                previous.setdefault(hakai_id, {})[col] = previous_value
+                cells = self.journal.setdefault(hakai_id, {})
+                if _is_same_value(value, original_value):
+                    cells.pop(col, None)
+                else:
+                    cells[col] = (original_value, value)
+                if not cells:
+                    del self.journal[hakai_id]
+
+        rows = self.get_rows(changes)
+        self.data.iloc[rows, self.data.columns.get_loc("modified")] = [
+            str(self.is_modified(hakai_id))
+            for hakai_id in self.data["hakai_id"].iloc[rows]
+        ]
+        self.last_changes = set(changes)
+        self.version = time.time_ns()
+        logger.debug(
+            "Applied changes to {} samples, {} modified",
+            len(changes),
+            len(self.journal),
+        )
+        return previous
+
+    def apply_changes(self, changes):
+        """Apply a changeset to the table and return the changed samples"""
+        unknown = [hakai_id for hakai_id in changes if hakai_id not in self._rows]
+        if unknown:
+            logger.warning("Ignore changes of unknown samples: {}", unknown)
+        changes = {
+            hakai_id: row
+            for hakai_id, row in changes.items()
+            if hakai_id in self._rows and row
+        }
+        if not changes:
+            self.last_changes = set()
+            return self.last_changes
+        self._undo.append(self._apply(changes))
+        self._redo.clear()
+        return self.last_changes
+
+    def mark_saved(self, hakai_ids):
+        """Use the current values of the given samples as their original flags,
+        once they were uploaded"""
+        saved = [hakai_id for hakai_id in hakai_ids if hakai_id in self.journal]
+        if not saved:
+            return
+        columns = {}
+        for hakai_id in saved:
+            for col in self.journal.pop(hakai_id):
+                columns.setdefault(col, []).append(hakai_id)
+
+        # The original flags are shared with the cached dataset
+        self.original = self.original.copy()
+        for col, hakai_ids in columns.items():
+            rows = self.get_rows(hakai_ids)
+            values = self.original[col].astype(object) if col in self.original else None
+            self.original[col] = values
+            self.original.iloc[rows, self.original.columns.get_loc(col)] = (
+                self.data[col].iloc[rows].to_numpy()
+            )
+        self.data.iloc[
+            self.get_rows(saved), self.data.columns.get_loc("modified")
+        ] = "False"
+        self.last_changes = set(saved)
+        self.version = time.time_ns()
+        logger.debug("Saved {} samples, {} modified", len(saved), len(self.journal))
+
+    def undo(self):
+        """Revert the last changeset applied"""
+        if self._undo:
+            self._redo.append(self._apply(self._undo.pop()))
+
+    def redo(self):
+        """Reapply the last changeset reverted"""
+        if self._redo:
+            self._undo.append(self._apply(self._redo.pop()))
+
+
+def new_qc_table_key(source_key):
+    """Generate the key of a new QC table, each session edits its own table
+    even if the same dataset is loaded elsewhere"""
+    return f"{source_key}#{uuid.uuid4().hex}"
+
+
+def set_qc_table(key, table):
+    """Cache a QC table and return the qc-table-state referencing it"""
+    qc_tables.set(key, table)
+    return {"key": key, "version": table.version, "modified": len(table.modified)}
+
+
+def get_qc_table(state):
+    """Retrieve the QC table data referenced by a qc-table-state"""
+    table = qc_tables.get(state["key"]) if state else None
+    return None if table is None else table.data
+
+
+def split_filter_part(filter_part):
+    """Parse a DataTable filter query expression as (column, operator, value,
+    case_sensitive)"""
+    match = filter_part_pattern.fullmatch(filter_part.strip())
+    if match is None:
+        return None
+    column, operator_name, value = match.groups()
+    case_sensitive = True
+    if operator_name[0] in "is" and (
+        operator_name[1:] in FILTER_OPERATORS
+        or operator_name[1:] in TEXT_FILTER_OPERATORS
+    ):
+        case_sensitive = operator_name[0] == "s"
+        operator_name = operator_name[1:]
+    if value[:1] in ("'", '"', "`") and value[:1] == value[-1:]:
+        value = value[1:-1].replace("\\" + value[0], value[0])
+    return column, operator_name, value, case_sensitive
+
+
+def _get_filter_part_mask(values, operator_name, value, case_sensitive):
+    if operator_name == "is" and value == "blank":
+        return (values.isna() | (values.astype(str) == "")).to_numpy()
+    elif operator_name in TEXT_FILTER_OPERATORS:
+        is_numeric = False
+    elif operator_name in FILTER_OPERATORS:
+        is_numeric = pd.api.types.is_numeric_dtype(values)
+        is_numeric &= not pd.api.types.is_bool_dtype(values)
+    else:
+        return None
+
+    if is_numeric:
+        try:
+            value = float(value)
+        except ValueError:
+            return np.zeros(len(values), dtype=bool)
+    else:
+        values = values.astype("string")
+        if not case_sensitive:
+            values, value = values.str.lower(), value.lower()
+
+    if operator_name == "contains":
+        mask = values.str.contains(value, regex=False)
+    elif operator_name == "datestartswith":
+        mask = values.str.startswith(value)
+    else:
+        mask = FILTER_OPERATORS[operator_name](values, value)
+    return mask.fillna(False).to_numpy(dtype=bool)
+
+
+def filter_table(df, filter_query):
+    """Filter a table with a DataTable filter query"""
+    if not filter_query:
+        return df
+    mask = np.ones(len(df), dtype=bool)
+    for filter_part in filter_query.split(" && "):
+        parsed = split_filter_part(filter_part)
+        part_mask = (
+            _get_filter_part_mask(df[parsed[0]], *parsed[1:])
+            if parsed and parsed[0] in df
+            else None
+        )
+        if part_mask is None:
+            logger.warning("Ignore unsupported qc table filter: {}", filter_part)
+            continue
+        mask &= part_mask
+    return df[mask]
+
+
+def sort_table(df, sort_by):
+    """Sort a table with the DataTable sort_by items"""
+    sort_by = [item for item in sort_by or [] if item["column_id"] in df]
+    if not sort_by:
+        return df
+    return df.sort_values(
+        [item["column_id"] for item in sort_by],
+        ascending=[item["direction"] == "asc" for item in sort_by],
+        kind="stable",
+    )
+
+
+def get_table_view(df, sort_by=None, filter_query=None):
+    """Get the filtered and sorted rows displayed by the qc-table"""
+    return sort_table(filter_table(df, filter_query), sort_by)
+
+
+@callback(
+    Output("qc-table", "data"),
+    Output("qc-table", "page_count"),
+    Input("qc-table-state", "data"),
+    Input("qc-table", "page_current"),
+    Input("qc-table", "page_size"),
+    Input("qc-table", "sort_by"),
+    Input("qc-table", "filter_query"),
+)
+def update_qc_table_page(state, page_current, page_size, sort_by, filter_query):
+    """Send the page of the sorted and filtered QC table displayed"""
+    table = qc_tables.get(state["key"]) if state else None
+    if table is None:
+        return None, None
+    start = (page_current or 0) * page_size
+
+    # Only patch the changed rows if the rows displayed didn't move
+    if (
+        ctx.triggered_id == "qc-table-state"
+        and table.last_changes is not None
+        and not sort_by
+        and not filter_query
+    ):
+        page = table.data.iloc[start : start + page_size]
+        changed_rows = np.flatnonzero(page["hakai_id"].isin(table.last_changes))
+        if len(changed_rows) == 0:
+            return no_update, no_update
+        logger.debug("Patch {} qc table rows", len(changed_rows))
+        patch = Patch()
+        records = page.iloc[changed_rows].assign(id=lambda x: x["hakai_id"])
+        for row, record in zip(changed_rows, records.to_dict("records")):
+            patch[int(row)] = record
+        return patch, no_update
+
+    df = get_table_view(table.data, sort_by, filter_query)
+    page = df.iloc[start : start + page_size]
+    logger.debug("Send qc table rows [{}:{}] of {}", start, start + len(page), len(df))
+    return (
+        page.assign(id=page["hakai_id"]).to_dict("records"),
+        max(math.ceil(len(df) / page_size), 1),
+    )
@@ -2,28 +2,52 @@ import math
 import re
 import shutil
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
 
 import dash_bootstrap_components as dbc
+import numpy as np
 import pandas as pd
-from dash import ALL, Input, Output, State, callback, ctx, dash_table, dcc, html
-from loguru import logger
+from dash import (
+    ALL,
+    Input,
+    Output,
+    State,
+    callback,
+    ctx,
+    dash_table,
+    dcc,
+    html,
+    no_update,
+)
 from hakai_api import Client
+from loguru import logger
 
 from hakai_qc.ctd import generate_qc_flags
 from hakai_qc.flags import (
     flag_color_map,
     flag_tooltips,
     flags_conventions,
+    flags_to_labels,
     get_hakai_variable_flag,
 )
 from hakai_qc.nutrients import nutrient_variables, run_nutrient_qc
-from hakai_qc.qc import update_dataframe
+from hakai_qc_app.cache import dataset_cache, invalidate_query_cache
+from hakai_qc_app.output import generate_excel_output, split_upload_batches
+from hakai_qc_app.qc_table import (
+    QCTable,
+    get_qc_table,
+    get_table_view,
+    is_editable_column,
+    new_qc_table_key,
+    qc_tables,
+    set_qc_table,
+)
 from hakai_qc_app.variables import (
     DEFAULT_HIDDEN_COLUMNS_IN_TABLE,
     VARIABLES_LABEL,
+    pages,
 )
-from hakai_qc_app.output import generate_excel_output
 
 variables_flag_mapping = {"no2_no3_um": "no2_no3_flag"}
 nutrient_variables_flags = [get_hakai_variable_flag(var) for var in nutrient_variables]
@@ -46,8 +70,10 @@ def get_flag_var(var):
 selection_table = dash_table.DataTable(
     id="qc-table",
     page_size=40,
-    sort_action="native",
-    filter_action="native",
+    page_current=0,
+    page_action="custom",
+    sort_action="custom",
+    filter_action="custom",
     row_selectable="multi",
     sort_mode="multi",
     style_header={
@@ -169,9 +195,18 @@ table_extra_buttons = html.Div(
                 html.Div(
                     id="upload-toast-div",
                 ),
+                html.Div(
+                    id="qc-table-toast-div",
+                ),
             ],
             className="me-1",
         ),
+        dbc.Switch(
+            id="upload-modified-only",
+            label="Changes only",
+            value=True,
+            className="me-1 mb-0",
+        ),
         dbc.ButtonGroup(
             [
                 dbc.Button(
@@ -182,6 +217,16 @@ table_extra_buttons = html.Div(
                     "Update",
                     id="update-qc-table",
                 ),
+                dbc.Button(
+                    html.I(className="bi bi-arrow-counterclockwise"),
+                    id="undo-qc-table",
+                    disabled=True,
+                ),
+                dbc.Button(
+                    html.I(className="bi bi-arrow-clockwise"),
+                    id="redo-qc-table",
+                    disabled=True,
+                ),
             ],
             className="me-1",
         ),
@@ -213,7 +258,9 @@ qc_section = dbc.Collapse(
         {"type": "graph", "page": ALL},
         "clickData",
     ),
-    State("qc-table", "derived_virtual_data"),
+    State("qc-table-state", "data"),
+    State("qc-table", "sort_by"),
+    State("qc-table", "filter_query"),
     State("qc-table", "hidden_columns"),
     State("qc-table", "active_cell"),
     State("variable", "value"),
@@ -223,7 +270,9 @@ qc_section = dbc.Collapse(
 )
 def select_qc_table(
     clicked,
-    qc_data,
+    qc_table_state,
+    sort_by,
+    filter_query,
     hidden_qc_columns,
     active_cell,
     column,
@@ -240,14 +289,23 @@ def select_qc_table(
     logger.debug("clicked={}", clicked)
     logger.debug("selected_cells={}", selected_cells)
     selected_hakai_id = clicked[0]["points"][0]["customdata"][0]
-    selected_row = [
-        id for id, row in enumerate(qc_data) if row["hakai_id"] == selected_hakai_id
-    ][0]
+    qc_data = get_qc_table(qc_table_state)
+    if qc_data is None:
+        return active_cell, current_page
+    # Find the row within the sorted and filtered table pages
+    selected_rows = np.flatnonzero(
+        get_table_view(qc_data, sort_by, filter_query)["hakai_id"].to_numpy()
+        == selected_hakai_id
+    )
+    if len(selected_rows) == 0:
+        logger.debug("{} isn't displayed in the qc-table", selected_hakai_id)
+        return active_cell, current_page
+    selected_row = selected_rows[0]
     current_page = math.floor(selected_row / page_size)
     selected_col = {
         col: id
         for id, col in enumerate(
-            col for col in qc_data[0].keys() if col not in hidden_qc_columns
+            col for col in [*qc_data.columns, "id"] if col not in hidden_qc_columns
         )
     }[get_hakai_variable_flag(column)]
     active_cell = {
@@ -349,109 +407,171 @@ def set_selection_apply_options(action, dataSelected, apply, to):
 
 @callback(
     dict(
-        data=Output("qc-table", "data"),
+        state=Output("qc-table-state", "data"),
+        toast=Output("qc-table-toast-div", "children"),
         columns=Output("qc-table", "columns"),
         dropdown=Output("qc-table", "dropdown"),
         hidden_columns=Output("qc-table", "hidden_columns"),
         style_data_conditional=Output("qc-table", "style_data_conditional"),
     ),
+    State("qc-table-state", "data"),
     State("qc-table", "data"),
     Input("qc-source-data", "data"),
     Input("qc-update-data", "data"),
     Input("update-qc-table", "n_clicks"),
+    Input("qc-table", "data_timestamp"),
+    Input("undo-qc-table", "n_clicks"),
+    Input("redo-qc-table", "n_clicks"),
 )
-def update_selected_data(qc_table_data, original_flags, updated_data, update_click):
-    if not qc_table_data and not original_flags:
-        logger.debug("no qc data available")
+def update_selected_data(
+    qc_table_state,
+    page_data,
+    source_key,
+    changes,
+    update_click,
+    edit_time,
+    undo_click,
+    redo_click,
+):
+    # The qc table keeps its original flags, it's only rebuilt from the source
+    # data when new data is loaded or if the qc table isn't available anymore
+    table = qc_tables.get(qc_table_state and qc_table_state["key"])
+    if ctx.triggered_id == "qc-source-data" or table is None:
+        toast = None
+        lost_edits = ctx.triggered_id != "qc-source-data" and qc_table_state
+        if lost_edits and qc_table_state.get("modified"):
+            logger.error("QC table {} is not available anymore", qc_table_state)
+            toast = dbc.Toast(
+                f"The edits of {qc_table_state['modified']} samples were lost, "
+                "the qc table was reset to the original flags.",
+                header="QC Table Error",
+                icon="danger",
+                dismissable=True,
+                is_open=True,
+                style={"position": "fixed", "top": 66, "right": 10},
+            )
+
+        if table is not None:
+            # The session previous table is replaced by the new one
+            if table.modified:
+                logger.warning(
+                    "Drop the {} unsaved edits of qc table {}",
+                    len(table.modified),
+                    qc_table_state["key"],
+                )
+            qc_tables.pop(qc_table_state["key"])
+
+        original_flags = dataset_cache.get(source_key)
+        if original_flags is None:
+            logger.debug("no qc data available")
+            return {
+                "state": None,
+                "toast": toast,
+                "columns": None,
+                "dropdown": None,
+                "hidden_columns": None,
+                "style_data_conditional": None,
+            }
+        logger.debug("add original flags to the qc table {}", original_flags.columns)
+        table = QCTable(original_flags)
         return {
-            "data": None,
-            "columns": None,
-            "dropdown": None,
-            "hidden_columns": None,
-            "style_data_conditional": None,
+            "state": set_qc_table(new_qc_table_key(source_key), table),
+            "toast": toast,
+            **generate_qc_table_style(table.data),
         }
 
-    logger.debug(
-        "Update qc table with qc_table_data={} updated_data={} original_flags= {}",
-        qc_table_data,
-        updated_data,
-        original_flags,
-    )
+    # Apply the changes from the selection interface or the edited page cells
+    columns = table.data.columns
+    if ctx.triggered_id == "qc-update-data" and changes:
+        table.apply_changes(changes)
+    elif ctx.triggered_id == "qc-table" and page_data:
+        table.apply_changes(table.get_page_changes(page_data))
+    elif ctx.triggered_id == "undo-qc-table":
+        table.undo()
+    elif ctx.triggered_id == "redo-qc-table":
+        table.redo()
+    else:
+        table.reset_changes()
 
-    if qc_table_data is None and updated_data is None and original_flags:
-        original_flags = pd.DataFrame(original_flags)
-        original_flags["modified"] = False
-        logger.debug("add original flags to the qc table {}", original_flags.columns)
-        return generate_qc_table_style(original_flags)
-
-    # Convert data to dataframes
-    original_flags = pd.DataFrame(original_flags)
-    qc_table_data = pd.DataFrame(qc_table_data)
-    updated_data = pd.DataFrame(updated_data)
-
-    logger.debug(
-        "Update already existing qc_table[{}]={} with {}",
-        len(qc_table_data),
-        qc_table_data.columns,
-        updated_data.columns,
-    )
+    # Columns metadata and styles are only sent if the columns changed
+    key = qc_table_state["key"]
+    if table.data.columns.equals(columns):
+        return {
+            "state": set_qc_table(key, table),
+            "toast": no_update,
+            "columns": no_update,
+            "dropdown": no_update,
+            "hidden_columns": no_update,
+            "style_data_conditional": no_update,
+        }
+    return {
+        "state": set_qc_table(key, table),
+        "toast": no_update,
+        **generate_qc_table_style(table.data),
+    }
 
-    # Update table form selection interface
-    if ctx.triggered_id == "update-qc-table":
-        df = qc_table_data
-    else:
-        df = update_dataframe(
-            qc_table_data,
-            updated_data,
-            on=["hakai_id"],
-            how="outer",
-        )
 
-    # Find modified rows
-    df["modified"] = (
-        ~df[[col for col in df if col in original_flags]]
-        .compare(original_flags, keep_shape=True)
-        .isna()
-        .all(axis=1)
-    ).astype(str)
-    return generate_qc_table_style(df)
+@callback(
+    Output("undo-qc-table", "disabled"),
+    Output("redo-qc-table", "disabled"),
+    Input("qc-table-state", "data"),
+)
+def activate_undo_buttons(qc_table_state):
+    table = qc_tables.get(qc_table_state and qc_table_state["key"])
+    if table is None:
+        return True, True
+    return not table.can_undo, not table.can_redo
 
 
 def generate_qc_table_style(data):
     if data.empty:
         return {
-            "data": None,
             "columns": None,
             "dropdown": None,
             "hidden_columns": None,
             "style_data_conditional": None,
         }
-    editable_columns = ("comments", "quality_level", "row_flag", "quality_log")
+    return _get_qc_table_style(tuple(data.columns))
+
+
+@lru_cache(maxsize=32)
+def _get_qc_table_style(data_columns):
+    """Generate the qc table columns, dropdowns and style rules of a set of
+    columns"""
     dropdown_columns = ("quality_level", "row_flag")
     columns = [
         {
             "name": VARIABLES_LABEL.get(i, i),
             "id": i,
-            "selectable": i.endswith("_flag") or i in editable_columns,
-            "editable": i.endswith("_flag") or i in editable_columns,
+            "selectable": is_editable_column(i),
+            "editable": is_editable_column(i),
             "hideable": i != "hakai_id",
             "presentation": "dropdown"
             if i.endswith("_flag") or i in dropdown_columns
             else None,
         }
-        for i in data.columns
+        for i in data_columns
     ] + [dict(name="id", id="id")]
-    flag_columns = [col for col in data.columns if col.endswith("_flag")]
+    flag_columns = [col for col in data_columns if col.endswith("_flag")]
     logger.debug("QC columns: {}", columns)
     logger.debug("Flag columns: {}", flag_columns)
+    # Flags sharing a color (ex: AV, 1 and "1") are styled by a single rule
+    color_flags = {}
+    for flag, flag_color in flag_color_map.items():
+        color_flags.setdefault(flag_color, {})[str(flag)] = None
     color_conditional = (
         {
-            "if": {"column_id": col, "filter_query": "{%s} = '%s'" % (col, flag)},
+            "if": {
+                "column_id": col,
+                "filter_query": " || ".join(
+                    "{%s} = '%s'" % (col, flag) for flag in flags
+                ),
+            },
             "backgroundColor": flag_color,
             "color": "white",
         }
         for col in flag_columns
-        for flag, flag_color in flag_color_map.items()
+        for flag_color, flags in color_flags.items()
     )
     blank_conditional = (
         {
@@ -470,7 +590,7 @@ def generate_qc_table_style(data):
         {
             "if": {
                 "column_editable": False,
-                "column_id": [col for col in data if col != "hakai_id"],
+                "column_id": [col for col in data_columns if col != "hakai_id"],
             },
             "color": "grey",
         },
@@ -491,21 +611,20 @@ def generate_qc_table_style(data):
         **{
             col: {"options": flags_conventions[col]}
             for col in ["quality_level", "row_flag"]
-            if col in data
+            if col in data_columns
         },
     }
 
     logger.debug("Dropdown menus: {}", dropdown_menus)
     return dict(
-        data=data.assign(id=data["hakai_id"]).to_dict("records"),
         columns=columns,
         dropdown=dropdown_menus,
         hidden_columns=DEFAULT_HIDDEN_COLUMNS_IN_TABLE,
-        style_data_conditional=(
+        style_data_conditional=[
             *color_conditional,
             *blank_conditional,
             *selection_conditional,
-        ),
+        ],
     )
 
 
@@ -544,7 +663,7 @@ def activate_apply_button(value):
     State({"type": "graph", "page": ALL}, "selectedData"),
     State("variable", "value"),
     State("dataframe", "data"),
-    State("qc-table", "data"),
+    State("qc-table-state", "data"),
     State("location", "pathname"),
     State("user-initials", "value"),
 )
@@ -556,7 +675,7 @@ def apply_to_selection(
     graph_selections,
     variable,
     data,
-    qc_data,
+    qc_table_state,
     location,
     initials,
 ):
@@ -567,10 +686,18 @@ def apply_to_selection(
             return cast["previous_comments"]
         return f"{cast['previous_comments']}; {cast['comments']}"
 
+    def _get_changes(columns):
+        """Get the changeset of the updated samples {hakai_id: {column: value}}"""
+        changes = qc_data.loc[update_hakai_ids, columns]
+        return (
+            changes.astype(object).where(changes.notna(), None).to_dict(orient="index")
+        )
+
     # Ignore empty data
+    qc_data = get_qc_table(qc_table_state)
     if not variable or qc_data is None:
         return None
-    qc_data = pd.DataFrame(qc_data).groupby(["hakai_id"]).first()
+    qc_data = qc_data.groupby(["hakai_id"]).first()
 
     action_variable = {"Quality Level": "quality_level", "Sample Status": "row_flag"}
     update_variable = action_variable.get(action, get_flag_var(variable))
@@ -595,7 +722,7 @@ def apply_to_selection(
     elif action in ("Quality Level", "Sample Status"):
         if update_variable not in qc_data:
             logger.error("No {} column available", update_variable)
-            return qc_data.reset_index().to_dict(orient="records")
+            return None
         if to == "Not Available":
             query = f"{update_variable}.isna() or {update_variable} == '{to}' "
         else:
@@ -615,7 +742,7 @@ def apply_to_selection(
     if action in ("Flag", "Sample Status"):
         logger.debug("Apply {}={} value to the selection", action, apply_value)
         qc_data.loc[update_hakai_ids, update_variable] = apply_value
-        return qc_data.reset_index().to_dict(orient="records")
+        return _get_changes([update_variable])
     elif action == "Quality Level":
         logger.debug("Apply qualit_level value to the selection")
         qc_data.loc[update_hakai_ids, update_variable] = apply_value
@@ -630,21 +757,24 @@ def apply_to_selection(
             qc_data.loc[update_hakai_ids, "quality_log"] += (
                 "\n" + n_log.astype(str) + f": {append_quality_log}"
             )
-
-        return qc_data.reset_index().to_dict(orient="records")
+            return _get_changes([update_variable, "quality_log"])
+        return _get_changes([update_variable])
     elif action != "Automated QC":
         logger.error("Unknown method to apply")
         raise RuntimeError(f"unknown action to apply={action}")
 
     logger.debug("Run Automated QC")
-    data = pd.DataFrame(data)
+    data = dataset_cache.get(data)
+    if data is None:
+        logger.warning("Dataset is not available anymore")
+        return None
     if "nutrient" in location:
         data = data.dropna(subset=nutrient_variables).reset_index()
         data["collected"] = pd.to_datetime(data["collected"], utc=True).dt.tz_localize(
             None
         )
         auto_qced_data = run_nutrient_qc(data, overwrite_existing_flags=True)
-        auto_qced_data = (
+        auto_qced_data = flags_to_labels(
             auto_qced_data[["hakai_id"] + nutrient_variables_flags]
             .groupby("hakai_id")
             .first()
@@ -667,86 +797,134 @@ def apply_to_selection(
         update_hakai_ids, variable_flags
     ]
 
-    return qc_data.reset_index().to_dict(orient="records")
+    return _get_changes(variable_flags)
 
 
 @callback(
     Output("download-qc-excel", "data"),
     Output("hakai-excel-load-spinner", "children"),
     Input("download-qc-excel-button", "n_clicks"),
-    State("qc-table", "data"),
+    State("qc-table-state", "data"),
     State("location", "pathname"),
 )
-def get_qc_excel(n_clicks, data, location):
+def get_qc_excel(n_clicks, qc_table_state, location):
     """Save file to an excel file format compatible with the Hakai Portal upload"""
-    if data is None:
+    df = get_qc_table(qc_table_state)
+    if df is None:
         return None, None
-    df = pd.DataFrame(data)
     data_type = location.split("/")[1]
     temp_file = generate_excel_output(df, data_type)
 
     logger.info("Upload Hakai QC excel file to user")
     return dcc.send_file(temp_file), None
 
+
+def _upload_toast(message, header, icon, duration=None):
+    return dbc.Toast(
+        message,
+        header=header,
+        icon=icon,
+        dismissable=True,
+        is_open=True,
+        duration=duration,
+        style={"position": "fixed", "top": 66, "right": 10},
+    )
+
+
 @callback(
     Output("hakai-upload-to-hakai-spinner", "children"),
     Output("upload-toast-div", "children"),
+    Output("qc-table-state", "data", allow_duplicate=True),
     Input("upload-to-hakai-button", "n_clicks"),
-    State("qc-table", "data"),
+    State("qc-table-state", "data"),
     State("location", "pathname"),
     State("credentials", "data"),
-    State("select-organization","value"),
+    State("select-organization", "value"),
+    State("upload-modified-only", "value"),
+    prevent_initial_call=True,
 )
 @logger.catch(reraise=True)
-def upload_qc_excel(n_clicks, data, location, credentials, organization):
-    """Upload the QC data to the Hakai Portal"""
-    if data is None:
-        return None
-    df = pd.DataFrame(data)
+def upload_qc_excel(
+    n_clicks, qc_table_state, location, credentials, organization, modified_only
+):
+    """Upload the QC data to the Hakai Portal
+
+    Only the modified samples are uploaded if `modified_only`, the rows are
+    uploaded in excel files of at most UPLOAD_MAX_ROWS rows. The samples of
+    each file uploaded are then considered as saved.
+    """
+    table = qc_tables.get(qc_table_state and qc_table_state["key"])
+    if table is None:
+        return None, None, no_update
+    df = table.get_modified_data() if modified_only else table.data
+    if df.empty:
+        toast = _upload_toast(
+            "No changes to upload", header="Upload", icon="warning", duration=4000
+        )
+        return None, toast, no_update
+
     data_type = location.split("/")[1]
-    temp_file = generate_excel_output(df, data_type)
+    batches = split_upload_batches(df)
     client = Client(credentials)
-    logger.debug("Upload Hakai QC excel file to Hakai Portal")
-    response = client.post(
-        f"{client.api_root or 'https://hecate.hakai.org/api'}/eims/forms/xlsx/form-data",
-        files={"file": open(temp_file, "rb")},
-        headers={"organization": organization},
-    )
-
-    
-    response_json = response.json()
-    if response.status_code != 200:
-        logger.error("Upload failed: {}", response_json)
-        return None, dbc.Toast(
-            "Upload failed: {}".format(response_json),
-            header="Error",
-            icon="danger",
-            dismissable=True,
-            is_open=True,
-            style={"position": "fixed", "top": 66, "right": 10},
+    api_root = client.api_root or "https://hecate.hakai.org/api"
+    url = f"{api_root}/eims/forms/xlsx/form-data"
+    timestamp = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    n_samples, n_rows = 0, 0
+    for index, batch in enumerate(batches, 1):
+        temp_file = generate_excel_output(
+            batch,
+            data_type,
+            file_name=f"hakai-qc-{data_type}-{timestamp}-{index}.xlsx",
         )
-    return None, dbc.Toast(
-            "Upload successful",
-            header="Success",
-            icon="success",
-            dismissable=True,
-            is_open=True,
-            duration=4000,
-            style={"position": "fixed", "top": 66, "right": 10},
+        logger.debug(
+            "Upload Hakai QC excel file {}/{} to Hakai Portal", index, len(batches)
         )
+        with open(temp_file, "rb") as file:
+            response = client.post(
+                url, files={"file": file}, headers={"organization": organization}
+            )
+        if response.status_code != 200:
+            response_json = response.json()
+            logger.error("Upload failed: {}", response_json)
+            toast = _upload_toast(
+                f"Upload failed for file {index}/{len(batches)}, {n_samples} samples "
+                f"({n_rows} rows) were uploaded: {response_json}",
+                header="Error",
+                icon="danger",
+            )
+            if not n_rows:
+                return None, toast, no_update
+            # Cached queries do not include the uploaded flags anymore
+            invalidate_query_cache(pages[data_type][0]["endpoint"])
+            return None, toast, set_qc_table(qc_table_state["key"], table)
+        table.mark_saved(batch["hakai_id"].unique())
+        n_samples += batch["hakai_id"].nunique()
+        n_rows += len(batch)
+
+    # Cached queries do not include the uploaded flags anymore
+    invalidate_query_cache(pages[data_type][0]["endpoint"])
+    logger.info("Uploaded {} samples ({} rows) to Hakai Portal", n_samples, n_rows)
+    toast = _upload_toast(
+        f"Uploaded {n_samples} {'modified ' if modified_only else ''}samples "
+        f"({n_rows} rows) in {len(batches)} file{'s' if len(batches) > 1 else ''}",
+        header="Upload successful",
+        icon="success",
+        duration=4000,
+    )
+    return None, toast, set_qc_table(qc_table_state["key"], table)
 
 
 @callback(
     Output("flag-progress-bar", "children"),
-    Input("qc-table", "data"),
+    Input("qc-table-state", "data"),
     Input("variable", "value"),
 )
-def update_progress_bar(data, variable):
-    if data is None:
+def update_progress_bar(qc_table_state, variable):
+    df = get_qc_table(qc_table_state)
+    if df is None:
         return []
     flags = {"green": 50, "warning": 20, "danger": 10.5, "grey": 20}
     flag_variable = get_flag_var(variable)
-    df = pd.DataFrame(data)
     if variable in df:
         df = df.query(f"{variable}.notna()")
 
@@ -32,6 +32,14 @@ tooltips = html.Div(
             "Update qc table modified columns (this is useful when manual corrections are made directely on the table itself)",
             target="update-qc-table",
         ),
+        dbc.Tooltip(
+            "Undo the last change made to the qc table",
+            target="undo-qc-table",
+        ),
+        dbc.Tooltip(
+            "Redo the last change undone in the qc table",
+            target="redo-qc-table",
+        ),
         dbc.Tooltip(
             "Clear hakai_id selection filter in qc-table",
             target="clear-selected-row-table",
@@ -44,5 +52,9 @@ tooltips = html.Div(
             "Upload Excel file with QC data directly to the hakai database",
             target="upload-to-hakai-button",
         ),
+        dbc.Tooltip(
+            "Upload only the samples modified in the qc table",
+            target="upload-modified-only",
+        ),
     ]
 )
@@ -1,16 +1,8 @@
+from hakai_qc.ctd import ctd_variables
+
 PRIMARY_VARIABLES = {
     "nutrients": ["sio2", "po4", "no2_no3_um"],
-    "ctd": [
-        "temperature",
-        "salinity",
-        "dissolved_oxygen_ml_l",
-        "rinko_do_ml_l",
-        "dissolved_oxygen_percent",
-        "turbidity",
-        "flc",
-        "par",
-        "c_star_at",
-    ],
+    "ctd": ctd_variables,
 }
 
 VARIABLES_LABEL = {
@@ -30,10 +22,15 @@ VARIABLES_LABEL = {
     "row_flag": "Sample Status",
 }
 
+# Each page retrieves its main endpoint data (first item) and the auxiliary
+# endpoints data concurrently. Auxiliary endpoints queries are generated from the
+# main query filters renamed with "query_mapping". The endpoint with "qc_source"
+# is used to generate the qc table, the main endpoint data otherwise.
 pages = {
     "nutrients": [
         {
             "endpoint": "eims/views/output/nutrients",
+            "time_variable": "collected",
             "fields": [
                 "work_area",
                 "organization",
@@ -81,6 +78,8 @@ pages = {
     "ctd": [
         {
             "endpoint": "ctd/views/file/cast/data",
+            "time_variable": "start_dt",
+            "chunk_freq": "180D",
             "fields": [
                 "hakai_id",
                 "station",
@@ -141,6 +140,8 @@ pages = {
         },
         {
             "endpoint": "eims/views/output/ctd_qc",
+            "query_mapping": {"station": "site_id", "start_dt": "collected"},
+            "qc_source": True,
             "fields": [
                 "hakai_id",
                 "collected",
@@ -241,3 +242,35 @@ DEFAULT_HIDDEN_COLUMNS_IN_TABLE = [
     "id",
     "depth",
 ]
+
+# Fields parsed as float64 when downloaded from the Hakai API,
+# other fields are kept as python objects
+NUMERIC_FIELDS = [
+    # nutrients
+    "lat",
+    "long",
+    "gather_lat",
+    "gather_long",
+    "line_out_depth",
+    "pressure_transducer_depth",
+    "no2_no3_um",
+    "po4",
+    "sio2",
+    # ctd
+    "latitude",
+    "longitude",
+    "station_longitude",
+    "station_latitude",
+    "depth",
+    "pressure",
+    *[
+        f"{variable}{suffix}"
+        for variable in ["conductivity", *PRIMARY_VARIABLES["ctd"]]
+        for suffix in ("", "_flag_level_1")
+    ],
+]
+
+
+def get_fields_dtypes(fields):
+    """Get the dtypes of the given Hakai API fields"""
+    return {field: "float64" for field in fields or [] if field in NUMERIC_FIELDS}
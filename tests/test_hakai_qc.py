@@ -1,9 +1,16 @@
 from pathlib import Path
 
+import gsw
+import numpy as np
 import pandas as pd
 from hakai_api import Client
 
-from hakai_qc.ctd import generate_qc_flags
+from hakai_qc.ctd import (
+    generate_qc_flags,
+    generate_variables_qc_flags,
+    get_derive_variables,
+)
+from hakai_qc.flags import flag_qartod_to_hakai
 
 
 def get_ctd_test_file():
@@ -32,3 +39,127 @@ class TestSugestedFlagCTD:
 
         assert not df_qced.empty
         assert (df_qced["temperature_flag"] == "SVC").all()
+
+
+def legacy_generate_qc_flags(data, variable):
+    def _common_automated_qc_flag(flags):
+        return flags.dropna().median()
+
+    def _review_hakai_flag(flags):
+        flag, comment = None, []
+        if flags.str.contains("bottom_hit_test").any():
+            comment += ["Instrument seems to have hit bottom."]
+        n_inversions = flags.astype(str).str.contains("density_inversion").sum()
+        if 0 < n_inversions <= 4:
+            comment += ["Some density inversion are present."]
+        if 4 < n_inversions:
+            comment += ["A significant number of density inversion are present."]
+            flag = "SVC"
+        return {hakai_flag: flag, "comments": "\n".join(comment)}
+
+    qartod_flag = f"{variable}_flag_level_1"
+    hakai_flag = f"{variable}_flag"
+    qc_flags = data.groupby("hakai_id").agg(
+        {qartod_flag: _common_automated_qc_flag, hakai_flag: _review_hakai_flag}
+    )
+    suggested_flags = qc_flags[hakai_flag].apply(pd.Series)
+    suggested_flags[hakai_flag] = suggested_flags[hakai_flag].fillna(
+        qc_flags[qartod_flag].replace(flag_qartod_to_hakai)
+    )
+    return suggested_flags
+
+
+class TestVectorizedSuggestedFlagCTD:
+    def test_same_flags_as_aggregation(self):
+        df = get_ctd_test_file()
+        pd.testing.assert_frame_equal(
+            generate_qc_flags(df, "temperature"),
+            legacy_generate_qc_flags(df, "temperature"),
+        )
+
+    def test_comments_thresholds(self):
+        df = get_ctd_test_file()
+        hakai_ids = df["hakai_id"].unique()
+        cast = df["hakai_id"] == hakai_ids[0]
+        df.loc[cast, "temperature_flag"] = "SVC: sigma0_qartod_density_inversion_test"
+        df.loc[
+            cast & (df["pressure"] < 5), "temperature_flag"
+        ] = "SVD: pressure_qartod_bottom_hit_test"
+        df.loc[df["hakai_id"] == hakai_ids[1], "temperature_flag_level_1"] = 4
+
+        df_qced = generate_qc_flags(df, "temperature")
+        pd.testing.assert_frame_equal(
+            df_qced, legacy_generate_qc_flags(df, "temperature")
+        )
+        assert df_qced.loc[hakai_ids[0], "temperature_flag"] == "SVC"
+        assert df_qced.loc[hakai_ids[0], "comments"] == (
+            "Instrument seems to have hit bottom.\n"
+            "A significant number of density inversion are present."
+        )
+        assert df_qced.loc[hakai_ids[1], "temperature_flag"] == "SVD"
+
+
+class TestMultiVariablesSuggestedFlagCTD:
+    def test_same_flags_as_single_variable(self):
+        df = get_ctd_test_file()
+        df.loc[
+            df.index[:20], "salinity_flag"
+        ] = "SVC: sigma0_qartod_density_inversion_test"
+        df_qced = generate_variables_qc_flags(df, ["temperature", "salinity"])
+        assert df_qced.columns.tolist() == [
+            "temperature_flag",
+            "temperature_comments",
+            "salinity_flag",
+            "salinity_comments",
+        ]
+        for variable in ["temperature", "salinity"]:
+            pd.testing.assert_frame_equal(
+                df_qced[[f"{variable}_flag", f"{variable}_comments"]].rename(
+                    columns={f"{variable}_comments": "comments"}
+                ),
+                legacy_generate_qc_flags(df, variable),
+            )
+
+    def test_default_variables(self):
+        df = get_ctd_test_file()
+        df_qced = generate_variables_qc_flags(df)
+        assert "rinko_do_ml_l_flag" in df_qced
+        assert len(df_qced) == df["hakai_id"].nunique()
+
+
+class TestDeriveVariablesCTD:
+    def get_expected_variables(self, df):
+        absolute_salinity = gsw.SA_from_SP(
+            df["salinity"],
+            df["pressure"],
+            df["longitude"].fillna(df["station_longitude"]),
+            df["latitude"].fillna(df["station_latitude"]),
+        )
+        conservative_temperature = gsw.CT_from_t(
+            absolute_salinity, df["temperature"], df["pressure"]
+        )
+        return {
+            "absolute_salinity": absolute_salinity,
+            "conservative_temperature": conservative_temperature,
+            "density": gsw.rho(
+                absolute_salinity, conservative_temperature, df["pressure"]
+            ),
+            "sigma0": gsw.sigma0(absolute_salinity, conservative_temperature),
+        }
+
+    def test_chunked_derive_variables(self):
+        df = get_ctd_test_file()
+        df.loc[df.index[:100], ["latitude", "longitude"]] = np.nan
+        expected = self.get_expected_variables(df)
+        df = get_derive_variables(df, chunk_size=100)
+        for variable, values in expected.items():
+            np.testing.assert_allclose(df[variable], values, equal_nan=True)
+
+    def test_derive_requested_variables(self):
+        df = get_derive_variables(
+            get_ctd_test_file(), variables=["sigma0"], dtype="float32"
+        )
+        assert "sigma0" in df
+        assert df["sigma0"].dtype == "float32"
+        assert "density" not in df
+        assert "conservative_temperature" not in df
@@ -0,0 +1,138 @@
+import threading
+import time
+
+import pandas as pd
+from test_hakai_qc import get_ctd_test_file
+
+from hakai_qc.ctd import derived_variables, get_derive_variables
+from hakai_qc_app.cache import DatasetCache, make_dataset_key
+
+
+def test_dataset_key_depends_on_credentials():
+    url = "https://hecate.hakai.org/api/ctd/views/file/cast/data?station=QU39"
+    assert make_dataset_key(url, "token_a") == make_dataset_key(url, "token_a")
+    assert make_dataset_key(url, "token_a") != make_dataset_key(url, "token_b")
+
+
+class TestDatasetCache:
+    def test_get_cached_dataframe(self):
+        cache = DatasetCache()
+        df = pd.DataFrame({"hakai_id": ["a", "b"], "value": [1.0, 2.0]})
+        key = cache.set("key", df)
+        assert cache.get(key) is df
+        assert cache.get("unknown") is None
+        assert cache.get(None) is None
+
+    def test_lru_eviction(self):
+        cache = DatasetCache(max_entries=2)
+        for key in "abc":
+            cache.set(key, pd.DataFrame({"value": [1.0]}))
+            if key == "b":
+                cache.get("a")
+        assert "a" in cache
+        assert "b" not in cache
+        assert "c" in cache
+
+    def test_size_eviction(self):
+        df = pd.DataFrame({"value": range(1000)}, dtype=float)
+        cache = DatasetCache(max_size=1.5 * df.memory_usage().sum())
+        cache.set("a", df)
+        cache.set("b", df.copy())
+        assert len(cache) == 1
+        assert "b" in cache
+
+    def test_ttl_expiration(self):
+        cache = DatasetCache(ttl=0.01)
+        cache.set("a", pd.DataFrame({"value": [1.0]}))
+        time.sleep(0.02)
+        assert cache.get("a") is None
+        assert len(cache) == 0
+
+    def test_ttl_is_refreshed_on_access(self):
+        cache = DatasetCache(ttl=0.05)
+        cache.set("a", pd.DataFrame({"value": [1.0]}))
+        for _ in range(4):
+            time.sleep(0.02)
+            assert cache.get("a") is not None
+
+    def test_size_includes_object_columns(self):
+        df = pd.DataFrame({"comments": ["A long comment on this sample"] * 1000})
+        cache = DatasetCache()
+        cache.set("a", df)
+        assert cache.size > df.memory_usage(index=True, deep=False).sum() * 2
+
+    def test_entries_not_evictable(self):
+        cache = DatasetCache(max_entries=1, ttl=0.01, is_evictable=lambda df: df.empty)
+        cache.set("a", pd.DataFrame({"value": [1.0]}))
+        cache.set("b", pd.DataFrame())
+        cache.set("c", pd.DataFrame())
+        assert "b" not in cache
+        time.sleep(0.02)
+        assert "a" in cache
+        assert "c" not in cache
+
+    def test_pinned_entries_expiration(self):
+        cache = DatasetCache(
+            ttl=0.01, is_evictable=lambda df: df.empty, pinned_ttl=0.05
+        )
+        cache.set("a", pd.DataFrame({"value": [1.0]}))
+        time.sleep(0.02)
+        assert "a" in cache
+        time.sleep(0.06)
+        assert "a" not in cache
+
+
+class TestLazyColumns:
+    def test_lazy_columns_computed_once(self):
+        calls = []
+
+        def compute(df, columns):
+            calls.append(columns)
+            for column in columns:
+                df[column] = df["value"] * 2
+            return df
+
+        cache = DatasetCache()
+        df = pd.DataFrame({"value": [1.0, 2.0]})
+        cache.set("a", df, lazy_columns={"double": compute, "other": compute})
+        assert cache.get_columns("a") == ["value", "double", "other"]
+        assert "double" not in cache.get("a")
+        assert cache.get("a", columns=["value", "double"])["double"].tolist() == [
+            2.0,
+            4.0,
+        ]
+        cache.get("a", columns=["double"])
+        assert calls == [["double"]]
+        assert cache.get_columns("a") == ["value", "double", "other"]
+
+    def test_lazy_columns_computed_on_copy(self):
+        def compute(df, columns):
+            # Other datasets can be retrieved while the columns are computed
+            thread = threading.Thread(target=cache.get, args=("b",))
+            thread.start()
+            thread.join(timeout=1)
+            assert not thread.is_alive()
+            return df.assign(double=df["value"] * 2)
+
+        cache = DatasetCache()
+        df = pd.DataFrame({"value": [1.0, 2.0]})
+        cache.set("a", df, lazy_columns={"double": compute})
+        cache.set("b", df)
+        assert "double" in cache.get("a", columns=["double"])
+        assert "double" not in df
+        assert cache.get("a") is not df
+
+    def test_lazy_ctd_derived_variables(self):
+        df = get_ctd_test_file()
+        cache = DatasetCache()
+        cache.set(
+            "ctd",
+            df,
+            lazy_columns={
+                variable: get_derive_variables for variable in derived_variables
+            },
+        )
+        df_cached = cache.get("ctd", columns=["temperature", "sigma0"])
+        assert "sigma0" in df_cached
+        assert "density" not in df_cached
+        assert cache.size >= df_cached.memory_usage().sum()
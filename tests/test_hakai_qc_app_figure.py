@@ -0,0 +1,229 @@
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import pytest
+from dash import Patch, no_update
+from dash._callback_context import context_value
+from dash._utils import AttributeDict
+from test_hakai_qc_qc import generate_nutrients_data
+
+from hakai_qc.flags import set_flag_dtypes
+from hakai_qc_app.cache import dataset_cache
+from hakai_qc_app.figure import (
+    WEBGL_THRESHOLD,
+    _get_axis_range,
+    _has_hidden_flagged_values,
+    contour_grids,
+    figure_states,
+    generate_figure,
+    get_contour,
+    get_contour_grid,
+    get_decimation_mask,
+    get_figure_patch,
+)
+from hakai_qc_app.qc_table import QCTable, set_qc_table
+
+
+def generate_timeseries(n_rows=100_000, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "time": pd.Timestamp("2020-01-01", tz="UTC")
+            + pd.to_timedelta(np.arange(n_rows), unit="min"),
+            "value": rng.normal(10, 1, n_rows),
+            "station": rng.choice(["QU39", "QU24"], n_rows),
+            "flag": rng.choice(["AV", "SVC"], n_rows, p=[0.999, 0.001]),
+        }
+    )
+
+
+class TestDecimation:
+    def test_small_figures_are_not_decimated(self):
+        df = generate_timeseries(100)
+        assert get_decimation_mask(df, "time", "value", 1000).all()
+
+    def test_decimation_keeps_extremes_and_flags(self):
+        df = generate_timeseries()
+        keep = (df["flag"] != "AV").to_numpy()
+        mask = get_decimation_mask(
+            df, "time", "value", 5000, groupby=["station"], keep=keep
+        )
+        assert mask.sum() <= 5000 + keep.sum()
+        assert mask[keep].all()
+        for _, station in df.groupby("station"):
+            assert mask[station["value"].idxmax()]
+            assert mask[station["value"].idxmin()]
+
+    def test_get_axis_range(self):
+        assert _get_axis_range({"xaxis.autorange": True}, "xaxis") is None
+        assert _get_axis_range(
+            {"yaxis.range[0]": 100, "yaxis.range[1]": 0}, "yaxis"
+        ) == [0, 100]
+        assert _get_axis_range({"xaxis.range": [1, 2]}, "xaxis") == [1, 2]
+
+
+def generate_nutrients_figure(
+    n_samples, qc_table_state=None, trigger="update-figure.n_clicks"
+):
+    """Generate the nutrients time series figure of a cached dataset"""
+    df = generate_nutrients_data(n_samples)
+    key = dataset_cache.set(f"figure-test-{n_samples}", set_flag_dtypes(df))
+    items = dict(
+        label="Time Series",
+        type="line",
+        x="collected",
+        y="po4",
+        color="po4_flag",
+        symbol=None,
+        facet_col=None,
+        facet_row=None,
+        color_continuous_scale=None,
+        hover_data="hakai_id,po4_flag",
+        kwargs='{"line_group":"line_out_depth"}',
+        color_min=None,
+        color_max=None,
+        extra_traces=None,
+    )
+    form_inputs = {
+        "id": [{"item": item} for item in items],
+        "value": [None] * len(items),
+        "default": list(items.values()),
+    }
+    context_value.set(
+        AttributeDict(triggered_inputs=[{"prop_id": trigger, "value": None}])
+    )
+    fig, _ = generate_figure(
+        "/nutrients/po4",
+        key,
+        qc_table_state,
+        [],
+        [],
+        None,
+        None,
+        form_inputs,
+        1,
+        None,
+        None,
+    )
+    return fig
+
+
+@pytest.mark.parametrize(
+    "n_samples,trace_type",
+    [(WEBGL_THRESHOLD // 2, "scatter"), (WEBGL_THRESHOLD * 2, "scattergl")],
+)
+def test_webgl_figures_keep_selection_customdata(n_samples, trace_type):
+    fig = generate_nutrients_figure(n_samples)
+    assert {trace.type for trace in fig.data} == {trace_type}
+    assert all(trace.customdata is not None for trace in fig.data)
+    assert fig.layout.dragmode == "select"
+
+
+class TestFigurePatch:
+    def get_figure(self, df):
+        return px.scatter(df, x="time", y="value", color="flag", hover_data=["id"])
+
+    def test_patch_only_changed_traces(self):
+        df = generate_timeseries(1000).assign(
+            id=lambda x: x.index.astype(str),
+            flag=lambda x: np.where(x["value"] > 12, "SVC", "AV"),
+        )
+        df.loc[0, "flag"] = "AV"
+        new_df = df.copy()
+        new_df.loc[new_df["flag"] == "SVC", "flag"] = "SVD"
+        assert get_figure_patch(self.get_figure(df), self.get_figure(new_df)) is None
+
+        new_df = df.copy()
+        new_df.loc[10, "flag"] = "SVC" if df.loc[10, "flag"] == "AV" else "AV"
+        patch = get_figure_patch(self.get_figure(df), self.get_figure(new_df))
+        assert len(patch.to_plotly_json()["operations"]) == 2
+        assert get_figure_patch(self.get_figure(df), self.get_figure(df)) is no_update
+
+    def test_patch_emptied_flags(self):
+        table = QCTable(generate_nutrients_data(200))
+        hakai_ids = table.data["hakai_id"].iloc[[5, 6]].tolist()
+        for hakai_id in hakai_ids:
+            table.apply_changes({hakai_id: {"po4_flag": "SVD"}})
+        generate_nutrients_figure(200, set_qc_table("figure-test", table))
+
+        table.undo()
+        state = set_qc_table("figure-test", table)
+        patch = generate_nutrients_figure(200, state, "qc-table-state.data")
+        assert isinstance(patch, Patch)
+        data = figure_states.get("figure-test-200/nutrients/po4")["data"]
+        flags = data.set_index("hakai_id").loc[hakai_ids, "po4_flag"]
+        assert flags.tolist() == ["SVD", "NA"]
+
+    def test_hidden_values_flagged_on_plotted_variable(self):
+        qc_flags = pd.DataFrame(
+            {"hakai_id": ["a", "b"], "po4_flag": ["AV", "AV"], "sio2_flag": "SVC"}
+        )
+        hidden = pd.Index(["a"])
+        assert not _has_hidden_flagged_values(qc_flags, hidden, ["po4_flag"])
+        qc_flags.loc[0, "po4_flag"] = "SVD"
+        assert _has_hidden_flagged_values(qc_flags, hidden, ["po4_flag"])
+        assert not _has_hidden_flagged_values(qc_flags, hidden, [])
+
+
+def generate_profiles(n_casts=50, n_depths=20, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "start_dt": np.repeat(
+                pd.Timestamp("2020-01-01")
+                + pd.to_timedelta(np.sort(rng.integers(0, 3650, n_casts)), unit="D"),
+                n_depths,
+            ),
+            "depth": np.tile(np.arange(n_depths, dtype=float), n_casts),
+            "temperature": rng.normal(10, 1, n_casts * n_depths),
+        }
+    )
+
+
+class TestContourGrid:
+    def test_grid_matches_pivot_table(self):
+        df = generate_profiles()
+        pivot = pd.pivot_table(
+            df, values="temperature", index="depth", columns="start_dt"
+        )
+        grid = get_contour_grid(df, "start_dt", "depth", "temperature")
+        pd.testing.assert_frame_equal(grid, pivot, check_names=False)
+
+    def test_grid_interpolation(self):
+        df = generate_profiles()
+        rng = np.random.default_rng(0)
+        df = df.loc[rng.random(len(df)) > 0.3]
+        expected = (
+            pd.pivot_table(df, values="temperature", index="depth", columns="start_dt")
+            .interpolate(axis="index", limit=3)
+            .interpolate(axis="columns", limit=4)
+        )
+        grid = get_contour_grid(df, "start_dt", "depth", "temperature")
+        pd.testing.assert_frame_equal(grid, expected, check_names=False)
+
+    def test_grid_size_is_capped(self):
+        df = generate_profiles(n_casts=200)
+        grid = get_contour_grid(
+            df, "start_dt", "depth", "temperature", max_x_bins=50, max_y_bins=10
+        )
+        assert grid.shape[0] <= 10
+        assert grid.shape[1] <= 50
+        assert np.isclose(np.nanmean(grid.values), df["temperature"].mean(), atol=0.1)
+
+    def test_regular_time_grid(self):
+        df = generate_profiles()
+        grid = get_contour_grid(df, "start_dt", "depth", "temperature", x_bin="30D")
+        assert (grid.columns.to_series().diff().dropna() == pd.Timedelta("30D")).all()
+
+    def test_grid_is_cached(self):
+        df = generate_profiles()
+        fig = get_contour(df, "start_dt", "depth", "temperature", cache_key="grid")
+        assert "grid" in contour_grids
+        fig_cached = get_contour(
+            df.assign(temperature=0.0),
+            "start_dt",
+            "depth",
+            "temperature",
+            cache_key="grid",
+        )
+        np.testing.assert_array_equal(fig_cached.data[0].z, fig.data[0].z)
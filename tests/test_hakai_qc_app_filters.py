@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+import pytest
+from test_hakai_qc_qc import generate_nutrients_data
+
+from hakai_qc_app.cache import DatasetCache
+from hakai_qc_app.filters import QUERY_SUBSET, FilterIndex, filter_data
+
+
+@pytest.fixture
+def nutrients():
+    df = generate_nutrients_data(1000).reset_index(drop=True)
+    df.loc[::50, "site_id"] = None
+    # Times are retrieved from the Hakai API as ISO strings
+    df["collected"] = df["collected"].dt.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    return df
+
+
+def get_index(df):
+    return FilterIndex(df, ["site_id", "line_out_depth"], "collected")
+
+
+@pytest.mark.parametrize(
+    "subsets,time_min,time_max",
+    [
+        ({"site_id": ["QU39", "KC10"]}, None, None),
+        ({"site_id": ["QU39", "UNKNOWN"], "line_out_depth": [0, 5]}, None, None),
+        ({}, "2010-01-01", "2011-06-01"),
+        ({"line_out_depth": [260]}, "2010-01-01", "2010-01-01T12:00:00+00:00"),
+    ],
+)
+def test_filter_mask_matches_query(nutrients, subsets, time_min, time_max):
+    query = [f"{var} in {values}" for var, values in subsets.items()]
+    if time_min:
+        query += [f"'{time_min}' < collected < '{time_max}'"]
+    mask = get_index(nutrients).get_mask(subsets, time_min, time_max)
+    expected = nutrients.query(" and ".join(query)).index
+    np.testing.assert_array_equal(np.flatnonzero(mask), expected.sort_values())
+
+
+def test_no_filter(nutrients):
+    assert get_index(nutrients).get_mask({"site_id": None}) is None
+
+
+def test_options_and_time_range(nutrients):
+    index = get_index(nutrients)
+    assert index.get_options("site_id") == ["KC10", "PRUTH", "QU24", "QU39", "SINGLE"]
+    assert index.get_time_range() == (
+        pd.Timestamp(nutrients["collected"].min()[:10]),
+        pd.Timestamp(nutrients["collected"].max()[:10]),
+    )
+
+
+def test_filter_data_with_query(nutrients):
+    df = filter_data(
+        nutrients,
+        get_index(nutrients),
+        ["site_id", QUERY_SUBSET],
+        [["QU39"], "po4 > 2"],
+    )
+    assert (df["site_id"] == "QU39").all()
+    assert (df["po4"] > 2).all()
+
+
+def test_index_is_cached_with_dataset(nutrients):
+    cache = DatasetCache()
+    cache.set("a", nutrients)
+    index = cache.get_index("a", "filter", get_index)
+    assert cache.get_index("a", "filter", get_index) is index
+    cache.set("a", nutrients.iloc[:10])
+    assert cache.get_index("a", "filter", get_index).n_rows == 10
+    assert cache.get_index("unknown", "filter", get_index) is None
@@ -0,0 +1,31 @@
+import pandas as pd
+import pytest
+
+from hakai_qc_app.output import split_upload_batches
+
+
+@pytest.fixture
+def upload_data():
+    # CTD like data with multiple rows per sample
+    return pd.DataFrame(
+        {
+            "hakai_id": ["a"] * 3 + ["b"] * 2 + ["c"] * 6 + ["d"],
+            "depth_flag": "AV",
+        }
+    )
+
+
+def test_split_upload_batches(upload_data):
+    batches = split_upload_batches(upload_data, max_rows=5)
+    assert [batch["hakai_id"].unique().tolist() for batch in batches] == [
+        ["a", "b"],
+        ["c"],
+        ["d"],
+    ]
+    pd.testing.assert_frame_equal(pd.concat(batches), upload_data)
+
+
+def test_split_upload_in_single_batch(upload_data):
+    batches = split_upload_batches(upload_data, max_rows=len(upload_data))
+    assert len(batches) == 1
+    assert split_upload_batches(upload_data.iloc[:0]) == []
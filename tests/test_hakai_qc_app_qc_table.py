@@ -0,0 +1,266 @@
+import pandas as pd
+import pytest
+from dash import Patch, no_update
+from dash._callback_context import context_value
+from dash._utils import AttributeDict
+from test_hakai_qc_qc import generate_nutrients_data
+
+from hakai_qc.flags import flag_color_map
+from hakai_qc_app.cache import dataset_cache
+from hakai_qc_app.qc_table import (
+    QCTable,
+    filter_table,
+    get_qc_table,
+    get_table_view,
+    qc_tables,
+    set_qc_table,
+    split_filter_part,
+    update_qc_table_page,
+)
+from hakai_qc_app.selection import (
+    generate_qc_table_style,
+    select_qc_table,
+    update_selected_data,
+)
+
+
+@pytest.fixture
+def qc_table():
+    df = generate_nutrients_data(200).reset_index(drop=True)
+    df["po4_flag"] = ["AV", "SVC", "SVD", None] * 50
+    df["comments"] = "Sample OK"
+    return df
+
+
+@pytest.mark.parametrize(
+    "filter_part,expected",
+    [
+        ("{po4_flag} = AV", ("po4_flag", "=", "AV", True)),
+        (
+            '{comments} icontains "sample ok"',
+            ("comments", "contains", "sample ok", False),
+        ),
+        ("{po4} >= 2.5", ("po4", ">=", "2.5", True)),
+        ("{po4_flag} is blank", ("po4_flag", "is", "blank", True)),
+    ],
+)
+def test_split_filter_part(filter_part, expected):
+    assert split_filter_part(filter_part) == expected
+
+
+@pytest.mark.parametrize(
+    "filter_query,query",
+    [
+        ("{po4_flag} = AV", "po4_flag == 'AV'"),
+        (
+            "{po4_flag} contains SV && {po4} > 2",
+            "po4_flag in ('SVC', 'SVD') & po4 > 2",
+        ),
+        ("{site_id} ieq qu39", "site_id == 'QU39'"),
+        ("{po4_flag} is blank", "po4_flag.isna()"),
+        ("{line_out_depth} = 5", "line_out_depth == 5"),
+    ],
+)
+def test_filter_table(qc_table, filter_query, query):
+    pd.testing.assert_frame_equal(
+        filter_table(qc_table, filter_query), qc_table.query(query)
+    )
+
+
+def test_unsupported_filter_is_ignored(qc_table):
+    assert len(filter_table(qc_table, "{unknown} = 1 && {po4} bad 2")) == len(qc_table)
+
+
+def set_triggered_id(prop_id):
+    context_value.set(
+        AttributeDict(triggered_inputs=[{"prop_id": prop_id, "value": None}])
+    )
+
+
+def test_qc_table_page(qc_table):
+    table = QCTable(qc_table)
+    state = set_qc_table("table", table)
+    assert get_qc_table(state) is table.data
+    sort_by = [{"column_id": "po4", "direction": "desc"}]
+    set_triggered_id("qc-table.page_current")
+    page, page_count = update_qc_table_page(state, 1, 40, sort_by, "{po4_flag} = AV")
+    expected = qc_table.query("po4_flag == 'AV'").sort_values("po4", ascending=False)
+    assert page_count == 2
+    assert [row["hakai_id"] for row in page] == expected["hakai_id"].tolist()[40:]
+    assert all(row["id"] == row["hakai_id"] for row in page)
+
+
+def test_select_qc_table_page(qc_table):
+    state = set_qc_table("table", QCTable(qc_table))
+    sort_by = [{"column_id": "hakai_id", "direction": "desc"}]
+    view = get_table_view(qc_table, sort_by)
+    hakai_id = view["hakai_id"].iloc[45]
+    clicked = [{"points": [{"customdata": [hakai_id]}]}]
+    active_cell, page = select_qc_table(
+        clicked, state, sort_by, None, [], None, "po4", 0, 40, None
+    )
+    assert page == 1
+    assert active_cell["row"] == 5
+    assert active_cell["row_id"] == hakai_id
+    assert active_cell["column"] == qc_table.columns.get_loc("po4_flag")
+
+
+class TestQCTable:
+    def test_apply_changes(self, qc_table):
+        table = QCTable(qc_table)
+        hakai_ids = qc_table["hakai_id"].iloc[:3].tolist()
+        changes = table.apply_changes(
+            {
+                hakai_ids[0]: {"po4_flag": "SVD", "comments": "Spike"},
+                hakai_ids[1]: {"po4_flag": qc_table["po4_flag"].iloc[1]},
+                hakai_ids[2]: {"no2_no3_flag": "AV"},
+                "UNKNOWN": {"po4_flag": "AV"},
+            }
+        )
+        assert changes == set(hakai_ids)
+        assert table.modified == {hakai_ids[0], hakai_ids[2]}
+        assert table.data["modified"].iloc[:4].tolist() == [
+            "True",
+            "False",
+            "True",
+            "False",
+        ]
+        assert table.data["comments"].iloc[0] == "Spike"
+
+        # Reverting a change removes the sample from the modified ones
+        table.apply_changes({hakai_ids[0]: {"po4_flag": "AV", "comments": "Sample OK"}})
+        assert table.modified == {hakai_ids[2]}
+        assert (table.data["modified"] == "True").sum() == 1
+
+    def test_page_changes(self, qc_table):
+        table = QCTable(qc_table)
+        page = table.data.iloc[:5].to_dict("records")
+        page[1]["po4_flag"] = "BDL"
+        page[1]["po4"] = 0
+        page[2]["comments"] = None
+        assert table.get_page_changes(page) == {
+            page[1]["hakai_id"]: {"po4_flag": "BDL"},
+            page[2]["hakai_id"]: {"comments": None},
+        }
+
+    def test_journal(self, qc_table):
+        table = QCTable(qc_table)
+        hakai_ids = qc_table["hakai_id"].iloc[[8, 3]].tolist()
+        original_flag = qc_table["po4_flag"].iloc[8]
+        table.apply_changes({hakai_ids[0]: {"po4_flag": "SVD"}})
+        table.apply_changes({hakai_ids[1]: {"comments": "Spike"}})
+        assert table.journal == {
+            hakai_ids[0]: {"po4_flag": (original_flag, "SVD")},
+            hakai_ids[1]: {"comments": (qc_table["comments"].iloc[3], "Spike")},
+        }
+        assert table.get_modified_data()["hakai_id"].tolist() == hakai_ids[::-1]
+
+    def test_undo_redo(self, qc_table):
+        table = QCTable(qc_table, max_undo=2)
+        hakai_id = qc_table["hakai_id"].iloc[0]
+        assert not table.can_undo
+        for flag in ["SVC", "SVD", "BDL"]:
+            table.apply_changes({hakai_id: {"po4_flag": flag}})
+
+        table.undo()
+        assert table.data["po4_flag"].iloc[0] == "SVD"
+        assert table.last_changes == {hakai_id}
+        table.undo()
+        assert table.data["po4_flag"].iloc[0] == "SVC"
+        assert not table.can_undo
+        assert table.is_modified(hakai_id)
+
+        table.redo()
+        assert table.data["po4_flag"].iloc[0] == "SVD"
+        assert table.can_redo
+        table.apply_changes({hakai_id: {"comments": "Spike"}})
+        assert not table.can_redo
+
+    def test_undo_restores_original(self, qc_table):
+        table = QCTable(qc_table)
+        hakai_id = qc_table["hakai_id"].iloc[0]
+        table.apply_changes({hakai_id: {"po4_flag": "SVD", "comments": "Spike"}})
+        table.undo()
+        assert not table.modified
+        assert table.data["modified"].eq("False").all()
+        assert table.get_modified_data().empty
+
+    def test_mark_saved(self, qc_table):
+        table = QCTable(qc_table)
+        hakai_ids = qc_table["hakai_id"].iloc[:2].tolist()
+        table.apply_changes({hakai_id: {"po4_flag": "SVD"} for hakai_id in hakai_ids})
+        table.mark_saved(hakai_ids[:1])
+        assert table.modified == {hakai_ids[1]}
+        assert table.data["modified"].iloc[:2].tolist() == ["False", "True"]
+        assert table.original["po4_flag"].iloc[0] == "SVD"
+        assert qc_table["po4_flag"].iloc[0] == "AV"
+
+        # Changes are now compared to the saved flags
+        table.undo()
+        assert table.modified == {hakai_ids[0]}
+
+    def test_patch_changed_page_rows(self, qc_table):
+        table = QCTable(qc_table)
+        state = set_qc_table("table", table)
+        table.apply_changes({qc_table["hakai_id"].iloc[42]: {"po4_flag": "SVD"}})
+        set_triggered_id("qc-table-state.data")
+        patch, page_count = update_qc_table_page(state, 1, 40, None, None)
+        assert isinstance(patch, Patch)
+        assert page_count is no_update
+        assert update_qc_table_page(state, 0, 40, None, None) == (no_update, no_update)
+
+
+class TestQCTableSession:
+    def load_qc_table(self, source_key, qc_table_state=None, changes=None):
+        if changes:
+            set_triggered_id("qc-update-data.data")
+        else:
+            set_triggered_id("qc-source-data.data")
+        return update_selected_data(
+            qc_table_state, None, source_key, changes, None, None, None, None
+        )
+
+    def test_qc_table_per_session(self, qc_table):
+        source_key = dataset_cache.set("qc-source", qc_table)
+        state = self.load_qc_table(source_key)["state"]
+        hakai_id = qc_table["hakai_id"].iloc[0]
+        state = self.load_qc_table(source_key, state, {hakai_id: {"po4_flag": "SVD"}})[
+            "state"
+        ]
+        assert state["modified"] == 1
+
+        # The same dataset loaded in another session gets its own qc table
+        other_state = self.load_qc_table(source_key)["state"]
+        assert other_state["key"] != state["key"]
+        assert qc_tables.get(state["key"]).is_modified(hakai_id)
+        assert not qc_tables.get(other_state["key"]).modified
+
+    def test_reload_drops_previous_qc_table(self, qc_table):
+        source_key = dataset_cache.set("qc-source", qc_table)
+        state = self.load_qc_table(source_key)["state"]
+        new_state = self.load_qc_table(source_key, state)["state"]
+        assert new_state["key"] != state["key"]
+        assert state["key"] not in qc_tables
+        assert new_state["key"] in qc_tables
+
+    def test_lost_qc_table_edits(self, qc_table):
+        source_key = dataset_cache.set("qc-source", qc_table)
+        state = {"key": "unknown", "version": 0, "modified": 3}
+        set_triggered_id("update-qc-table.n_clicks")
+        output = update_selected_data(
+            state, None, source_key, None, 1, None, None, None
+        )
+        assert "3 samples were lost" in output["toast"].children
+        assert output["state"]["key"] != "unknown"
+
+
+def test_qc_table_style_is_cached_and_deduplicated(qc_table):
+    style = generate_qc_table_style(qc_table)
+    assert generate_qc_table_style(qc_table.copy()) is style
+    rules = [
+        rule["if"]["filter_query"]
+        for rule in style["style_data_conditional"]
+        if rule["if"].get("column_id") == "po4_flag" and "filter_query" in rule["if"]
+    ]
+    assert len(rules) == len(set(rules)) == len(set(flag_color_map.values())) + 1
+    assert "{po4_flag} = 'AV' || {po4_flag} = '1'" in rules
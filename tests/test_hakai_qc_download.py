@@ -0,0 +1,270 @@
+import orjson
+import pandas as pd
+import pytest
+import requests
+
+from hakai_qc.download import (
+    QueryCache,
+    download_hakai_data,
+    fetch_chunks,
+    normalize_query,
+    read_records,
+    rename_query_filters,
+    split_query_by_time,
+)
+
+records = [
+    {"hakai_id": "a", "temperature": 10.1, "temperature_flag": "AV", "depth": 1},
+    {"hakai_id": "b", "temperature": None, "temperature_flag": None, "depth": 2},
+    {"hakai_id": "c", "temperature": 9.8, "temperature_flag": "SVC", "depth": 3},
+]
+
+
+class TestReadRecords:
+    def test_read_records_as_typed_columns(self):
+        df = read_records(
+            orjson.dumps(records),
+            dtypes={"temperature": "float64", "depth": "float64"},
+            block_size=2,
+        )
+        expected = pd.DataFrame(records).astype({"depth": "float64"})
+        pd.testing.assert_frame_equal(df, expected)
+
+    def test_read_parsed_records_is_not_consumed(self):
+        parsed_records = [dict(record) for record in records]
+        df = read_records(parsed_records, block_size=2)
+        assert parsed_records == records
+        assert df["hakai_id"].tolist() == ["a", "b", "c"]
+
+    def test_read_selected_fields(self):
+        df = read_records(orjson.dumps(records), fields=["hakai_id", "salinity"])
+        assert df.columns.tolist() == ["hakai_id", "salinity"]
+        assert df["salinity"].isna().all()
+
+    def test_read_empty_response(self):
+        df = read_records(b"[]", fields=["hakai_id"])
+        assert df.empty
+        assert df.columns.tolist() == ["hakai_id"]
+
+
+class FakeHakaiAPI:
+    """Local stand-in for a Hakai API endpoint"""
+
+    def __init__(self, records):
+        self.records = records
+        self.queries = []
+
+    def fetch(self, query):
+        self.queries.append(query)
+        records = self.records
+        for item in query.split("&"):
+            if item.startswith("collected>="):
+                records = [
+                    record
+                    for record in records
+                    if record["collected"] >= item.split(">=")[1]
+                ]
+        return pd.DataFrame(records)
+
+
+nutrients_records = [
+    {"hakai_id": "a", "collected": "2022-01-01T10:00:00Z", "po4": 1.0},
+    {"hakai_id": "b", "collected": "2022-02-01T10:00:00Z", "po4": 2.0},
+    {"hakai_id": "c", "collected": "2022-02-01T10:00:00Z", "po4": 3.0},
+]
+
+
+class TestQueryCache:
+    def test_normalize_query(self):
+        assert normalize_query("?b=1&a=2") == normalize_query("a=2&b=1")
+
+    def test_cache_query_results(self, tmp_path):
+        api = FakeHakaiAPI(nutrients_records)
+        cache = QueryCache(tmp_path)
+        df = cache.get("eims/views/output/nutrients", "site_id=QU39", api.fetch)
+        df_cached = cache.get("eims/views/output/nutrients", "site_id=QU39", api.fetch)
+        assert len(api.queries) == 1
+        pd.testing.assert_frame_equal(df, df_cached)
+
+    def test_incremental_refresh(self, tmp_path):
+        api = FakeHakaiAPI(nutrients_records[:2])
+        cache = QueryCache(tmp_path)
+        args = ("eims/views/output/nutrients", "site_id=QU39", api.fetch)
+        cache.get(*args, time_variable="collected")
+
+        api.records = nutrients_records
+        df = cache.get(*args, time_variable="collected")
+        assert api.queries[-1] == "site_id=QU39&collected>=2022-02-01T10:00:00Z"
+        assert df["hakai_id"].tolist() == ["a", "b", "c"]
+
+    def test_failed_refresh_is_not_cached(self, tmp_path):
+        api = FakeHakaiAPI(nutrients_records)
+        cache = QueryCache(tmp_path)
+        args = ("eims/views/output/nutrients", "site_id=QU39")
+        cache.get(*args, api.fetch, time_variable="collected")
+        assert cache.get(*args, lambda query: None, time_variable="collected") is None
+        df = cache.get(*args, api.fetch, time_variable="collected")
+        assert len(df) == 3
+
+    def test_invalidate(self, tmp_path):
+        api = FakeHakaiAPI(nutrients_records)
+        cache = QueryCache(tmp_path)
+        cache.get("eims/views/output/nutrients", "site_id=QU39", api.fetch)
+        cache.invalidate("eims/views/output/nutrients")
+        cache.get("eims/views/output/nutrients", "site_id=QU39", api.fetch)
+        assert len(api.queries) == 2
+
+
+def test_rename_query_filters():
+    query = "station=QU39&start_dt>=2020-01-01&start_dt<2021-01-01&direction_flag=d"
+    assert rename_query_filters(
+        query, {"station": "site_id", "start_dt": "collected"}
+    ) == ("site_id=QU39&collected>=2020-01-01&collected<2021-01-01")
+
+
+class TestChunkedDownload:
+    def test_split_query_by_time(self):
+        queries = split_query_by_time(
+            "station=QU39&start_dt>2020-01-01&start_dt<2021-01-01",
+            "start_dt",
+            "180D",
+        )
+        assert queries == [
+            "station=QU39&start_dt>2020-01-01&start_dt<2020-06-29T00:00:00",
+            "station=QU39&start_dt>=2020-06-29T00:00:00&start_dt<2020-12-26T00:00:00",
+            "station=QU39&start_dt>=2020-12-26T00:00:00&start_dt<2021-01-01",
+        ]
+
+    def test_do_not_split_unbounded_query(self):
+        query = "station=QU39&start_dt>2020-01-01"
+        assert split_query_by_time(query, "start_dt", "180D") == [query]
+
+    def test_fetch_chunks_retry_failed_chunks(self):
+        queries = [f"chunk={id}" for id in range(6)]
+        fetched = []
+
+        def _fetch(query):
+            fetched.append(query)
+            if query == "chunk=3" and fetched.count(query) == 1:
+                raise ConnectionError("timeout")
+            return pd.DataFrame({"chunk": [query]})
+
+        progress = []
+        df = fetch_chunks(
+            _fetch, queries, max_workers=3, progress=lambda *args: progress.append(args)
+        )
+        assert df["chunk"].tolist() == queries
+        assert len(fetched) == 7
+        assert progress[-1] == (6, 6)
+
+    def test_split_query_with_naive_and_aware_bounds(self):
+        queries = split_query_by_time(
+            "station=QU39&start_dt>2020-01-01&start_dt<2021-01-01T00:00:00Z",
+            "start_dt",
+            "180D",
+        )
+        assert queries[0] == (
+            "station=QU39&start_dt>2020-01-01&start_dt<2020-06-29T00:00:00Z"
+        )
+        assert queries[-1].endswith("start_dt<2021-01-01T00:00:00Z")
+        assert len(queries) == 3
+
+    def test_do_not_split_invalid_bounds(self):
+        query = "station=QU39&start_dt>2020-01-01&start_dt<tomorrow"
+        assert split_query_by_time(query, "start_dt", "180D") == [query]
+
+    def test_fetch_chunks_failure(self):
+        df = fetch_chunks(lambda query: None, ["a", "b"], retries=1)
+        assert df is None
+
+    @pytest.mark.parametrize("status_code,n_requests", [(500, 1), (503, 3)])
+    def test_only_retry_transient_errors(self, status_code, n_requests):
+        fetched = []
+
+        def _fetch(query):
+            fetched.append(query)
+            response = requests.Response()
+            response.status_code = status_code
+            response.raise_for_status()
+
+        errors = []
+        df = fetch_chunks(
+            _fetch, ["a", "b"], on_error=lambda *args: errors.append(args)
+        )
+        assert df is None
+        assert fetched.count("a") == n_requests
+        assert [query for query, _ in errors] == ["a", "b"]
+
+
+class FakeHakaiClient:
+    """Local stand-in for the hakai_api Client of a CTD endpoint"""
+
+    api_root = "https://hakai.api"
+
+    def __init__(self, records, status_code=200):
+        self.records = records
+        self.status_code = status_code
+        self.urls = []
+
+    def mount(self, prefix, adapter):
+        pass
+
+    def get(self, url, timeout=None):
+        self.urls.append(url)
+        start, end = "", "9999"
+        for item in url.split("?")[1].split("&"):
+            if item.startswith("start_dt>"):
+                start = item.split(">")[1].lstrip("=")
+            elif item.startswith("start_dt<"):
+                end = item.split("<")[1]
+        response = requests.Response()
+        response.status_code = self.status_code
+        response.url = url
+        response._content = orjson.dumps(
+            [record for record in self.records if start <= record["start_dt"] < end]
+            if self.status_code == 200
+            else {"hint": "bad query"}
+        )
+        return response
+
+
+ctd_records = [
+    {"hakai_id": f"cast{id}", "start_dt": f"2020-{month:02d}-01T00:00:00"}
+    for id, month in enumerate(range(1, 13))
+]
+
+
+class TestDownloadHakaiData:
+    query = "station=QU39&start_dt>=2020-01-01&start_dt<2021-01-01"
+
+    def test_download_chunks(self, tmp_path):
+        client = FakeHakaiClient(ctd_records)
+        progress = []
+        kwargs = dict(
+            cache=QueryCache(tmp_path),
+            time_variable="start_dt",
+            chunk_freq="90D",
+            progress=lambda *args: progress.append(args),
+        )
+        endpoint = "ctd/views/file/cast/data"
+        df = download_hakai_data(client, endpoint, self.query, **kwargs)
+        assert df["hakai_id"].tolist() == [record["hakai_id"] for record in ctd_records]
+        assert len(client.urls) == 5
+        assert progress[-1] == (5, 5)
+        assert all(url.endswith("&limit=-1") for url in client.urls)
+
+        # Cached results only retrieve the records since the latest cast
+        download_hakai_data(client, endpoint, self.query, **kwargs)
+        assert client.urls[-1].endswith("start_dt>=2020-12-01T00:00:00&limit=-1")
+
+    def test_download_error(self):
+        errors = []
+        df = download_hakai_data(
+            FakeHakaiClient(ctd_records, status_code=500),
+            "ctd/views/file/cast/data",
+            self.query,
+            on_error=lambda query, error: errors.append((query, error)),
+        )
+        assert df is None
+        assert errors[0][0] == self.query
+        assert errors[0][1].response.json() == {"hint": "bad query"}
@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+from test_hakai_qc import get_ctd_test_file
+from test_hakai_qc_qc import generate_nutrients_data
+
+from hakai_qc.flags import (
+    flag_qartod_to_hakai,
+    flags_to_labels,
+    hakai_flag_dtype,
+    qartod_to_hakai_flag,
+    set_flag_dtypes,
+)
+from hakai_qc.nutrients import run_nutrient_qc
+
+
+def test_qartod_to_hakai_flag():
+    qartod = np.array([1, 2, 3, 4, 9, np.nan, 5])
+    flags = qartod_to_hakai_flag(qartod)
+    assert flags.dtype == hakai_flag_dtype
+    assert list(flags.astype(object)[:5]) == list(flag_qartod_to_hakai.values())
+    assert flags.isna()[5:].all()
+
+
+class TestFlagDtypes:
+    def test_set_flag_dtypes(self):
+        df = get_ctd_test_file()
+        df_encoded = set_flag_dtypes(df)
+        assert isinstance(df_encoded["temperature_flag"].dtype, pd.CategoricalDtype)
+        assert df_encoded["temperature_flag_level_1"].dtype == "Int8"
+        assert df_encoded["direction_flag"].dtype == df["direction_flag"].dtype
+        assert (
+            df_encoded.memory_usage(deep=True).sum() < df.memory_usage(deep=True).sum()
+        )
+
+    def test_flags_to_labels_roundtrip(self):
+        df = get_ctd_test_file()
+        df_labels = flags_to_labels(set_flag_dtypes(df))
+        flag_columns = [col for col in df if col.endswith(("_flag", "_level_1"))]
+        for col in flag_columns:
+            assert df_labels[col].dtype == object
+            assert (
+                df_labels[col].isna().tolist() == df[col].isna().tolist()
+            ), f"{col} missing values changed"
+            assert (
+                df_labels[col].dropna().tolist() == df[col].dropna().tolist()
+            ), f"{col} values changed"
+
+    def test_run_nutrient_qc_on_encoded_flags(self):
+        df = generate_nutrients_data(500)
+        df_qced = run_nutrient_qc(set_flag_dtypes(df))
+        pd.testing.assert_frame_equal(
+            flags_to_labels(df_qced)[["hakai_id", "po4_flag", "sio2_flag"]],
+            run_nutrient_qc(df)[["hakai_id", "po4_flag", "sio2_flag"]],
+        )
@@ -0,0 +1,173 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from hakai_qc.nutrients import nutrients_qc_configs, run_nutrient_qc
+from hakai_qc.qc import (
+    compile_configs,
+    config_parse_times,
+    get_config,
+    get_config_key,
+    is_vectorized_config,
+    qc_dataframe,
+    update_dataframe,
+)
+
+nutrients_axes = dict(time="collected", z="line_out_depth", lat="lat", lon="long")
+
+
+def generate_nutrients_data(n_samples=2000, seed=0):
+    """Generate random nutrient samples with spikes, out of range and missing
+    values over multiple sites and depths"""
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(
+        {
+            "hakai_id": [f"HAKAI{id:06d}" for id in range(n_samples)],
+            "site_id": rng.choice(["QU39", "QU24", "KC10", "PRUTH"], n_samples),
+            "line_out_depth": rng.choice([0, 5, 10, 30, 100, 260], n_samples),
+            "collected": pd.to_datetime("2009-06-01")
+            + pd.to_timedelta(rng.integers(0, 4 * 365, n_samples), unit="D"),
+            "lat": 50.0,
+            "long": -125.0,
+            "no2_no3_um": rng.normal(20, 8, n_samples),
+            "po4": rng.normal(2, 0.8, n_samples),
+            "sio2": rng.normal(40, 25, n_samples),
+            "no2_no3_flag": None,
+            "po4_flag": None,
+            "sio2_flag": None,
+        }
+    )
+    for var in ["no2_no3_um", "po4", "sio2"]:
+        df.loc[rng.random(n_samples) < 0.05, var] = np.nan
+    # Add a single sample timeserie
+    df.loc[0, ["site_id", "line_out_depth"]] = ["SINGLE", 75]
+    return df.sort_values(["site_id", "line_out_depth", "collected"])
+
+
+class TestVectorizedQC:
+    @pytest.mark.parametrize("seed", [0, 1, 2])
+    def test_vectorized_qc_parity(self, seed):
+        df = generate_nutrients_data(seed=seed)
+        kwargs = dict(
+            configs=nutrients_qc_configs,
+            groupby=["site_id", "line_out_depth"],
+            axes=nutrients_axes,
+        )
+        df_ioos = qc_dataframe(df, engine="ioos_qc", **kwargs)
+        df_vectorized = qc_dataframe(df, engine="vectorized", **kwargs)
+
+        qartod_columns = [col for col in df_ioos if "_qartod_" in col]
+        assert qartod_columns
+        assert set(qartod_columns) <= set(df_vectorized.columns)
+        expected = (
+            df_ioos.set_index("hakai_id")[qartod_columns].sort_index().astype(float)
+        )
+        result = df_vectorized.set_index("hakai_id")[qartod_columns].sort_index()
+        # ioos_qc<2.3 fails to run the spike test on series without missing
+        # values and leaves them empty, the vectorized engine always runs it
+        pd.testing.assert_frame_equal(
+            result.where(expected.notna() | result.isna()),
+            expected,
+            check_dtype=False,
+        )
+
+    def test_unsupported_arguments_are_not_vectorized(self):
+        config = nutrients_qc_configs["50<=line_out_depth"]
+        assert is_vectorized_config(get_config(config))
+        assert not is_vectorized_config(
+            get_config(config.replace("method: 'differential'", "n_dev: 2"))
+        )
+
+    def test_run_nutrient_qc(self):
+        df = generate_nutrients_data()
+        df_qced = run_nutrient_qc(df)
+        assert df_qced.columns.tolist() == df.columns.tolist()
+        assert df_qced["po4_flag"].notna().all()
+        assert set(df_qced["po4_flag"]) <= {"AV", "SVC", "SVD", "NA", "BDL", ""}
+
+
+class TestConfigRegistry:
+    def test_config_is_parsed_once(self):
+        config = nutrients_qc_configs["50<=line_out_depth"]
+        assert get_config(config) is get_config(config)
+        assert get_config_key(config) in config_parse_times
+
+    def test_config_key_depends_on_content(self):
+        config = nutrients_qc_configs["50<=line_out_depth"]
+        assert get_config_key(config) == get_config_key("\n" + config + "  ")
+        assert get_config_key(config) != get_config_key(
+            nutrients_qc_configs["-5 < line_out_depth < 50"]
+        )
+
+    def test_compiled_configs_are_reused(self):
+        compiled = compile_configs(nutrients_qc_configs)
+        df = generate_nutrients_data(200)
+        kwargs = dict(groupby=["site_id", "line_out_depth"], axes=nutrients_axes)
+        pd.testing.assert_frame_equal(
+            qc_dataframe(df, compiled, **kwargs),
+            qc_dataframe(df, nutrients_qc_configs, **kwargs),
+        )
+
+
+class TestParallelQC:
+    @pytest.mark.parametrize("engine", ["vectorized", "ioos_qc"])
+    def test_parallel_qc(self, engine):
+        df = generate_nutrients_data(500)
+        kwargs = dict(
+            configs=nutrients_qc_configs,
+            groupby=["site_id", "line_out_depth"],
+            axes=nutrients_axes,
+            engine=engine,
+        )
+        df_serial = qc_dataframe(df, **kwargs).set_index("hakai_id")
+        df_parallel = qc_dataframe(df, n_jobs=2, **kwargs).set_index("hakai_id")
+        qartod_columns = [col for col in df_serial if "_qartod_" in col]
+        pd.testing.assert_frame_equal(
+            df_parallel[qartod_columns].astype(float),
+            df_serial[qartod_columns].astype(float),
+        )
+
+    def test_parallel_run_nutrient_qc(self):
+        df = generate_nutrients_data(500)
+        pd.testing.assert_frame_equal(
+            run_nutrient_qc(df, n_jobs=2), run_nutrient_qc(df)
+        )
+
+
+def legacy_update_dataframe(df, new_df, on=None, suffix="_new", how="outer"):
+    df_merge = pd.merge(df, new_df, how=how, suffixes=("", suffix), on=on)
+    for new_col in [col for col in df_merge.columns if col.endswith(suffix)]:
+        col = new_col[: -len(suffix)]
+        df_merge[col] = df_merge[new_col].fillna(df_merge[col])
+    return df_merge.drop(columns=[col for col in df_merge if col.endswith(suffix)])
+
+
+class TestUpdateDataframe:
+    @pytest.mark.parametrize("how", ["left", "inner", "outer"])
+    def test_update_dataframe_matches_merge(self, how):
+        df = generate_nutrients_data(200)
+        new_df = df.sample(80, random_state=0)[["hakai_id", "po4", "po4_flag"]]
+        new_df["po4_flag"] = "SVC"
+        new_df.loc[new_df.index[:10], "po4"] = np.nan
+        new_df["po4_qartod_flag"] = 1
+        new_df = pd.concat([new_df, pd.DataFrame({"hakai_id": ["NEW"], "po4": [1.0]})])
+        sort = ["hakai_id"]
+        pd.testing.assert_frame_equal(
+            update_dataframe(df, new_df, on="hakai_id", how=how)
+            .sort_values(sort)
+            .reset_index(drop=True),
+            legacy_update_dataframe(df, new_df, on="hakai_id", how=how)
+            .sort_values(sort)
+            .reset_index(drop=True),
+            check_dtype=False,
+        )
+
+    def test_update_preserves_row_order_and_dtypes(self):
+        df = pd.DataFrame(
+            {"hakai_id": ["c", "a", "b"], "count": [1, 2, 3], "flag": ["AV"] * 3}
+        )
+        new_df = pd.DataFrame({"hakai_id": ["a"], "flag": ["SVC"]})
+        df_updated = update_dataframe(df, new_df, on="hakai_id")
+        assert df_updated["hakai_id"].tolist() == ["c", "a", "b"]
+        assert df_updated["flag"].tolist() == ["AV", "SVC", "AV"]
+        assert df_updated["count"].dtype == df["count"].dtype